@@ -0,0 +1,279 @@
+"""
+
+Copyright 2012 University Of Southern California
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+                                                                                                                             
+Unless required by applicable law or agreed to in writing,                                                                 
+software distributed under the License is distributed on an "AS IS" BASIS,                                                 
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.                                                   
+See the License for the specific language governing permissions and                                                        
+limitations under the License. 
+
+"""
+
+import re
+import threading
+import time
+import uuid
+
+from precip.experiment import Experiment, Instance, _TimedProxy, _traced, logger
+
+
+class AzureExperiment(Experiment):
+
+    _cloud_name = "azure"
+    _poll_max_interval = 20
+    _expected_boot_time = 240
+
+    def __init__(self, azure_config, skip_setup = False, name = None):
+        Experiment.__init__(self, name = name)
+        
+        self.config = azure_config
+        self.skip_setup = skip_setup
+        
+        self._conn = None
+        self._get_connection()
+        
+        self.counter = 0
+        
+    def _get_connection(self):
+        """
+        Establishes a connection to the cloud endpoint
+        """
+        if (self._conn != None):
+            return
+        
+        # the Azure SDK is only imported when it is needed
+        from azure_resource_manager import AzureResourceManager
+
+        self._conn = _TimedProxy(AzureResourceManager(
+            self.config,
+            self.skip_setup
+        ), self._metrics)
+        
+    def _start_instance(self, name, tags, has_public_ip):
+        self._conn.create_vm(
+            name,
+            self._ssh_pubkey,
+            tags=tags,
+            has_public_ip=has_public_ip
+        )
+
+    def _boot_instance(self, instance):
+        """
+        Starts an instance - this is run in a separate thread per instance. Errors are recorded
+        on the instance, and wait() is notified when the instance is done.
+        """
+        try:
+            self._start_instance(instance.id,
+                                 instance.inst_param['tags'],
+                                 instance.inst_param['has_public_ip'])
+        except Exception as e:
+            instance.azure_boot_error = e
+        self._notify_instance(instance)
+    
+    @_traced("finish_instanciation")
+    def _finish_instanciation(self, instance):
+        """
+        Checks if an instance has finished booting, and fills in its addresses
+        
+        :param instance: the instance to check
+        :return: True if the instance is ready to be bootstrapped, otherwise False
+        """
+        
+        # check if we are already done
+        if instance.is_fully_instanciated:
+            return True
+        
+        if instance.not_instanciated_correctly:
+            return False
+        
+        # there is no boot thread for instances picked up with reattach()
+        if instance.azure_boot_thread is not None and instance.azure_boot_thread.is_alive():
+            logger.debug("Instance %s is still pending" % instance.id)
+            return False
+
+        if instance.azure_boot_error is not None:
+            logger.debug("Instance %s state is 'error - scheduling for possible retry" %instance.id)
+            logger.debug("%s" % str(instance.azure_boot_error))
+            instance.not_instanciated_correctly = True
+            return False
+        
+        # DONE
+        self._phase(instance, "running")
+        
+        # get public and private addresses
+        instance.pub_addr = self._conn.get_pub_addr(instance.id)
+        instance.priv_addr = self._conn.get_priv_addr(instance.id) 
+        self._phase(instance, "address")
+        return True
+
+    def _admin_user(self):
+        return self.config.admin_username
+
+    def _bootstrap(self, instance):
+        """
+        Bootstraps an instance which has finished booting. Instances without a public address
+        can not be reached, and are not bootstrapped.
+        """
+        if instance.pub_addr == '':
+            return True
+        return Experiment._bootstrap(self, instance)
+
+    def _complete_instanciation(self, instance):
+        """
+        Marks a bootstrapped instance as ready
+        """
+        logger.info("Instance %s has booted, priv address: %s, public address: %s" % (instance.id, instance.priv_addr, instance.pub_addr))
+        Experiment._complete_instanciation(self, instance)
+
+    @_traced("retry")
+    def _retry(self, instance):
+        
+        """
+        In case of reaching timeout for an instance, retry will terminate the previous instance and 
+        replace it with a new instance.
+        
+        :param instance: the instance to terminate and replace with a new one
+        :param image_id: The image id as specified by the cloud infrastructure
+        :param instance_type: The instance type (m1.small, m1.large, ...)
+        :param tags: Tags to add to the new instance - this is important as tags are used throughout the API 
+                     to find and manipulate instances
+        """
+        
+        logger.info("Instance %s has reached timeout, and will be replaced with a new instance" % instance.id)
+        try:
+            self._conn.delete_vm(instance.id)
+        except Exception as e:
+            logger.info('Could not delete instance: %s' % instance.id)
+            logger.debug("%s" % str(e))
+            
+        instance.azure_boot_thread = threading.Thread(
+            target=self._boot_instance,
+            args=(instance,),
+        )
+        
+        instance.num_starts = instance.num_starts + 1
+        instance.boot_time = int(time.time())
+        instance.not_instanciated_correctly = False
+        instance.azure_boot_error = None
+        
+        instance.azure_boot_thread.start()
+    
+    @_traced("provision", write=True)
+    def provision(self, tags=None, has_public_ip=True, count=1, boot_timeout=400):
+        """
+        Provision a new instance. Note that this method starts the provisioning cycle, but does not
+        block for the instance to finish booting - for that, see wait()
+        
+        :param image_id: The image id as specified by the cloud infrastructure
+        :param instance_type: The instance type (m1.small, m1.large, ...)
+        :param count: Number of instances to provision. The default is 1.
+        :param tags: Tags to add to the instance - this is important as tags are used throughout the API 
+                     to find and manipulate instances
+        :param boot_timeout: The amount of allowed time in seconds for an instance to boot
+        :param boot_max_tries: The number of tries an instance is given to successfully boot
+        """   
+      
+        name = self._name.replace('_', '')
+        if re.search('^(?:[a-z](?:[-a-z0-9]{0,61}[a-z0-9])?)$', name) is None:
+            name = str(uuid.uuid4().get_hex())
+    
+        for _i in range(count):
+            inst_id = name + '-' + str(self.counter)
+            self.counter += 1
+            
+            inst_tags = list(tags)
+            inst_tags.append("precip")
+            inst_tags.append(inst_id)
+            
+            instance = Instance(inst_id)
+            self._add_instance(instance)
+            for t in inst_tags:
+                instance.add_tag(t)
+            
+            instance.azure_boot_thread = threading.Thread(
+                target=self._boot_instance,
+                args=(instance,),
+            )
+                
+            # keep track of parameters - we might need them for restarts later
+            instance.num_starts = 1
+            instance.boot_time = int(time.time())
+            instance.boot_timeout = boot_timeout
+            instance.boot_max_tries = 3
+            instance.inst_param = {
+                'tags' : inst_tags,
+                'has_public_ip' : has_public_ip
+            }
+        
+            instance.azure_boot_thread.start()
+
+        self._save_journal()
+
+
+    def _reattach_instances(self, instances):
+        """
+        Checks that the journaled instances still exist
+        """
+        alive = []
+        for i in instances:
+            try:
+                self._conn.get_priv_addr(i.id)
+            except Exception as e:
+                logger.info("Instance %s no longer exists" % i.id)
+                logger.debug("%s" % str(e))
+                continue
+            # the thread which created the instance is gone, and the instance exists - there is
+            # no creation to wait for
+            i.azure_boot_thread = None
+            alive.append(i)
+        return alive
+
+    def _deprovision(self, instance):
+        attempts=3
+        instance.is_fully_instanciated = False
+        done = False
+        while (done == False):
+            try:
+                logger.info("Deprovisioning instance: %s" % instance.id)
+                self._conn.delete_vm(instance.id)
+                done = True
+            except Exception as e:
+                logger.info('Could not deprovision instance: %s' % instance.id)
+                logger.debug("%s" % str(e))
+                
+                if (attempts > 0):
+                    logger.info('Retrying in some secs..')
+                    time.sleep(20)
+                    attempts = attempts-1
+                else:
+                    logger.info('Not retrying anymore')
+                    done = True
+                    
+
+    @_traced("deprovision", write=True)
+    def deprovision(self, tags=[]):
+        """
+        Deprovisions (terminates) instances with the matching tags
+        
+        :param tags: set of tags to match against
+        """
+        threads = {}
+        subset = self._instance_subset(tags)
+        for i in subset:
+            threads[i] = threading.Thread(target=self._deprovision, args=(i,),)
+            threads[i].start()
+        
+        logger.info("Waiting for deprovisioning to complete")
+        for i in subset:
+            threads[i].join()
+            self._forget_instance(i)
+        self._save_journal()
+
+        logger.info("Deprovisioning done")
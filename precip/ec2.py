@@ -0,0 +1,808 @@
+"""
+
+Copyright 2012 University Of Southern California
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+                                                                                                                             
+Unless required by applicable law or agreed to in writing,                                                                 
+software distributed under the License is distributed on an "AS IS" BASIS,                                                 
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.                                                   
+See the License for the specific language governing permissions and                                                        
+limitations under the License. 
+
+"""
+
+import re
+import threading
+import time
+
+from precip.experiment import Experiment, ExperimentException, Instance, _TimedProxy, _traced, \
+                              _is_throttled, _parallel_map, logger
+
+
+def _import_boto():
+    """
+    Imports boto. This is done when the first EC2 experiment is created, instead of when precip
+    is imported.
+    """
+    global boto, RegionInfo, EBSBlockDeviceType, BlockDeviceMapping, EC2ResponseError
+    import boto
+    from boto.ec2.regioninfo import RegionInfo
+    from boto.ec2.blockdevicemapping import EBSBlockDeviceType, BlockDeviceMapping
+    from boto.exception import EC2ResponseError
+
+
+class _AddressPool:
+    """
+    Floating ips for the instances of an experiment which do not get a public address of their
+    own. Addresses are allocated in bulk, an address is only handed to one instance, and the
+    address of an instance which goes away is recycled. Addresses allocated by the pool are
+    released again when they are no longer needed, while unassociated addresses which were in
+    the account already are used, but left alone. Thread safe.
+    """
+
+    # the largest number of addresses to allocate at the same time
+    _max_parallel_allocations = 10
+
+    def __init__(self, conn):
+        self._conn = conn
+        self._lock = threading.Lock()
+        self._reserve_lock = threading.Lock()
+        self._listed = False
+        self._free = []
+        # instance id -> address
+        self._assigned = {}
+        # the addresses allocated by the pool
+        self._allocated = set()
+
+    def reserve(self, count):
+        """
+        Makes sure there are at least count free addresses. The unassociated addresses of the
+        account are listed the first time, and the rest are allocated in one go.
+        
+        :param count: the number of addresses which are about to be needed
+        """
+        with self._reserve_lock:
+            with self._lock:
+                listed = self._listed
+                self._listed = True
+            if not listed:
+                addresses = self._conn.get_all_addresses()
+                with self._lock:
+                    taken = set(self._assigned.values())
+                    for address in addresses:
+                        if (address.instance_id is None or address.instance_id == "") and \
+                           address.public_ip not in taken:
+                            self._free.append(address.public_ip)
+            with self._lock:
+                missing = count - len(self._free)
+            if missing <= 0:
+                return
+            logger.debug("Allocating %d public IP addresses" % missing)
+            allocated = _parallel_map(self._allocate, range(missing), self._max_parallel_allocations)
+            with self._lock:
+                for addr in allocated:
+                    if addr is not None:
+                        self._free.append(addr)
+                        self._allocated.add(addr)
+
+    def _allocate(self, n):
+        try:
+            return self._conn.allocate_address().public_ip
+        except EC2ResponseError, e:
+            # most likely the address quota - the instances which do not get one will wait
+            logger.warn("Unable to allocate a public IP address: %s" % str(e))
+            return None
+
+    def acquire(self, instance_id):
+        """
+        :return: a free address for the instance, or None if there are no free addresses
+        """
+        with self._lock:
+            addr = self._assigned.get(instance_id)
+            if addr is None and len(self._free) > 0:
+                addr = self._free.pop(0)
+                self._assigned[instance_id] = addr
+            return addr
+
+    def assigned(self, instance_id):
+        """
+        :return: the address handed to the instance, or None
+        """
+        with self._lock:
+            return self._assigned.get(instance_id)
+
+    def allocated_to(self, instance_id):
+        """
+        :return: the address handed to the instance, if it was allocated by the pool, or None
+        """
+        with self._lock:
+            addr = self._assigned.get(instance_id)
+            if addr in self._allocated:
+                return addr
+            return None
+
+    def adopt(self, instance_id, addr):
+        """
+        Takes over an address which was allocated for an instance by another experiment, such as
+        the address of an instance taken from the warm pool, so that it is released in the end
+        """
+        with self._lock:
+            self._assigned[instance_id] = addr
+            self._allocated.add(addr)
+
+    def discard(self, instance_id):
+        """
+        Takes back the address of an instance, which could not be associated with it. Addresses
+        allocated by the pool go back to the free ones, so that they are released in the end.
+        Addresses from the account are forgotten, as someone else might have got to them first.
+        """
+        with self._lock:
+            addr = self._assigned.pop(instance_id, None)
+            if addr in self._allocated:
+                self._free.append(addr)
+
+    def recycle(self, instance_id):
+        """
+        Puts the address of an instance which has been terminated back into the pool
+        """
+        with self._lock:
+            addr = self._assigned.pop(instance_id, None)
+            if addr is not None:
+                self._free.append(addr)
+
+    def hand_over(self, instance_id):
+        """
+        Lets the address stay with an instance which lives on outside of the experiment, such as
+        an instance parked in the warm pool
+        """
+        with self._lock:
+            addr = self._assigned.pop(instance_id, None)
+            self._allocated.discard(addr)
+
+    def release(self, addrs=None):
+        """
+        Releases the free addresses which were allocated by the pool
+        
+        :param addrs: addresses to release instead, such as the ones of parked instances which
+                      are being terminated
+        """
+        if addrs is not None:
+            release = addrs
+        else:
+            with self._lock:
+                release = [addr for addr in self._free if addr in self._allocated]
+                self._free = [addr for addr in self._free if addr not in self._allocated]
+                self._allocated.difference_update(release)
+        for addr in release:
+            logger.debug("Releasing public IP address %s" % addr)
+            try:
+                # the address might still be associated with the instance it was recycled from
+                self._conn.disassociate_address(public_ip=addr)
+            except EC2ResponseError:
+                pass
+            try:
+                self._conn.release_address(public_ip=addr)
+            except EC2ResponseError, e:
+                logger.warn("Unable to release public IP address %s: %s" % (addr, str(e)))
+
+
+class EC2Experiment(Experiment):
+
+    _cloud_name = "ec2"
+    _expected_boot_time = 90
+
+    # the largest number of instances to ask for in a single run_instances request
+    _max_instances_per_request = 100
+    
+    def __init__(self, region, endpoint, access_key, secret_key, name = None):
+        """
+        Initializes an EC2 experiment
+        
+        :param region: Amazon EC2 region, for example us-west-2c
+        :param endpoint: Amazon EC2 endpoint, for example ec2.us-west-2.amazonaws.com
+        :param access_keys: Amazon EC2 access key
+        :param secret_keys: Amazon EC2 secret key
+        """        
+        _import_boto()
+        Experiment.__init__(self, name = name)
+    
+        self._region = region
+        self._endpoint = endpoint
+        self._access_key = access_key
+        self._secret_key = secret_key
+    
+        self._conn = None
+
+        # image lookups are cached, as they are the same for all the instances of a provision call
+        self._images = {}
+
+        # some infrastructures do not support security groups
+        self._security_groups_support = True
+    
+        self._get_connection()
+
+        # floating ips for instances which do not get a public address of their own
+        self._addresses = _AddressPool(self._conn)
+
+        self._ssh_keys_setup()
+        self._security_groups_setup()
+
+    def _get_connection(self):
+        """
+        Establishes a connection to the cloud endpoint
+        """
+        if (self._conn != None):
+            return
+                                                                                                                    
+        logger.info("Connecting to endpoint " + self._endpoint)
+        
+        re_endpoint = re.compile(r'(([\w]+)://)?([\w\.\-]*)(?::(\d+))?(/[\S]*)?')
+        r = re_endpoint.search(self._endpoint)
+        if not r:
+            raise ExperimentException("Unable to parse endpoint: %s" % (self._endpoint))
+
+        # Parse successful
+        proto = r.group(2)
+        host = r.group(3)
+        port = r.group(4)
+        path = r.group(5)
+        
+        if proto is None:
+            proto = "http"
+        
+        if port is None:
+            if proto == "http":
+                port = 80
+            else:
+                port = 443
+        else:
+            port = int(port)
+            
+        if path is None:
+            path = ""
+            
+        is_secure=(proto == "https")
+        # Nimbus wants is_secure to be true
+        if self._region == "nimbus":
+            is_secure = True
+                                                                                  
+        region = RegionInfo(name=self._region, endpoint=host)   
+                                                
+        self._conn = _TimedProxy(boto.connect_ec2(
+                        self._access_key,
+                        self._secret_key,
+                        is_secure=is_secure,
+                        region=region,
+                        port=port,
+                        path=path), self._metrics)
+    
+        # this next line is due to a bug in early boto versions
+        self._conn.host = host
+    
+        # do a query to validate that the connection works
+        try:
+            self._conn.get_all_instances()
+        except EC2ResponseError, e:
+            self.ec2_conn = None
+            raise ExperimentException("Unable to talk to the service", e) 
+             
+    def _ssh_keys_setup(self):
+        
+        """
+        Makes sure we have our experiment keypair registered
+        """
+        uid = self._get_account_id()
+        keypairs = None
+        try:
+            keypairs = self._conn.get_key_pair("precip_"+uid)
+
+            # TODO: verify that the existing keypair matches the one in ~/.precip
+        except IndexError, ie:
+            # not found on eucalyptus
+            pass
+        except EC2ResponseError, e:
+            if e.error_code in ["InvalidKeyPair.NotFound", "KeypairNotFound", "EC2APIError"]:
+                keypairs = None
+            else:
+                raise ExperimentException("Unable to query for key pair", e)
+  
+         
+        if keypairs is None:
+            logger.info("Registering ssh pubkey as 'precip_"+uid+"'")
+            f = open(self._ssh_pubkey)
+            contents = f.read()
+            f.close()
+            self._conn.import_key_pair("precip_"+uid, contents) 
+              
+    def _security_groups_setup(self):
+        """
+        Sets up the default security group
+        """
+        sgroups = None
+        try:
+            sgroups = self._conn.get_all_security_groups(["precip"])
+        except EC2ResponseError, e:
+            if e.error_code in ["InvalidGroup.NotFound", "SecurityGroupNotFoundForProject"]:
+                sgroups = None
+            else:
+                raise ExperimentException("Unable to find security group", e)
+        
+        if sgroups is None:
+            try:
+                logger.info("Registering default security group 'precip'")
+                sg = self._conn.create_security_group("precip", "FutureGrid Experiment Mangement default group")
+                sg.authorize(ip_protocol='tcp', from_port=22, to_port=22, cidr_ip='0.0.0.0/0')
+                sg.authorize(src_group=sg)
+            except Exception:
+                logger.warn("Security group seems to be broken - disabling support")
+                self._security_groups_support = False
+                pass
+
+    def _get_image(self, image_id):
+        """
+        Looks up an image, and caches it so that it only has to be looked up once
+        
+        :return: the image Boto object
+        """
+        if image_id not in self._images:
+            image_obj = self._conn.get_image(image_id)
+            if image_obj is None:
+                raise ExperimentException("Image %s does not exist" %(image_id))
+            self._images[image_id] = image_obj
+        return self._images[image_id]
+
+    def _start_instances(self, image_id, instance_type, ebs_size, count):
+        """
+        Creates a set of new instances with a single request
+        
+        :param count: the number of instances to start, at most _max_instances_per_request
+        :return: list of instance Boto objects
+        """
+        uid = self._get_account_id()
+        try:
+            # block device maps is only needed if the user wants to specify ebs_size
+            block_device_map = None
+            if ebs_size is not None:
+                dev_sda1 = EBSBlockDeviceType(delete_on_termination = True)
+                dev_sda1.size = int(ebs_size)
+                block_device_map = BlockDeviceMapping()
+                block_device_map['/dev/sda1'] = dev_sda1
+            #else:
+            #    block_device_map = self._conn.get_image_attribute(image_id, 
+            #                                                      attribute = 'blockDeviceMapping')
+
+            # make sure the image exists
+            image_obj = self._get_image(image_id)
+
+            if self._security_groups_support:
+                res = self._conn.run_instances(image_obj.id,
+                                               min_count = count,
+                                               max_count = count,
+                                               instance_type = instance_type,
+                                               key_name = "precip_"+uid,
+                                               instance_initiated_shutdown_behavior = "terminate",
+                                               block_device_map = block_device_map,
+                                               security_groups = ["precip"])
+            else:
+                res = self._conn.run_instances(image_obj.id,
+                                               min_count = count,
+                                               max_count = count,
+                                               instance_type = instance_type,
+                                               key_name = "precip_"+uid,
+                                               instance_initiated_shutdown_behavior = "terminate",
+                                               block_device_map = block_device_map)
+
+            for boto_instance in res.instances:
+                logger.info("Started instance %s, type %s" % (boto_instance.id, instance_type))        
+        except ExperimentException:
+            raise
+        except Exception as e:
+            raise ExperimentException("Unable to provision a new instance", e)
+        return res.instances
+
+    def _start_instance(self, image_id, instance_type, ebs_size):
+        """
+        Creates a new instance
+        
+        :return: the instance Boto object
+        """
+        return self._start_instances(image_id, instance_type, ebs_size, 1)[0]
+
+    @_traced("finish_instanciation")
+    def _finish_instanciation(self, instance):
+        """
+        Checks if an instance has finished booting, and fills in its addresses
+        
+        :param instance: the instance to check
+        :return: True if the instance is ready to be bootstrapped, otherwise False
+        """
+        instance_record = []
+        count_ing = 0
+        # check if we are already done
+        if instance.is_fully_instanciated:
+            return True
+            
+        # now, let's wait until the instance i up and running - the state has been refreshed
+        # for all pending instances at the same time by _refresh_instances()
+        ec2inst = instance.ec2_instance
+        
+        if ec2inst.state == "error":
+            logger.debug("Instance %s state is 'error - scheduling for possible retry" %instance.id)
+            instance.not_instanciated_correctly = True
+            return False
+        
+        if ec2inst.state != "pending" and ec2inst.state != "running":
+            
+            #raise ExperimentException("Unexpected instance state for instance %s: %s" % (instance.id, ec2inst.state))
+            logger.debug("Unexpected instance state for instance %s: %s" % (instance.id, ec2inst.state))
+            return False             
+        
+        if ec2inst.state == "pending":
+            logger.debug("Instance %s is still pending" % instance.id)
+            return False
+        self._phase(instance, "running")
+        
+        if self._needs_address(instance):
+            # we did not get a public address assigned to us, do it now
+            if self._addresses.assigned(instance.id) is not None:
+                logger.debug("Waiting for the public IP of instance %s to show up" % instance.id)
+                return False
+
+            # make sure there are addresses for all the running instances without one, so that
+            # they are allocated in one go instead of one per instance and wait cycle
+            needed = [i for i in self._instances
+                      if not i.is_fully_instanciated and self._needs_address(i) and \
+                         self._addresses.assigned(i.id) is None]
+            self._addresses.reserve(len(needed))
+            addr_to_use = self._addresses.acquire(instance.id)
+            if addr_to_use is None:
+                logger.debug("No public IP address available for instance %s" % instance.id)
+                return False
+
+            logger.debug("Setting public ip: %s" %(addr_to_use))
+            try:
+                ec2inst.use_ip(addr_to_use)
+            except EC2ResponseError, e:
+                logger.debug("Unable to associate %s with instance %s: %s" \
+                             % (addr_to_use, instance.id, str(e)))
+                self._addresses.discard(instance.id)
+            return False
+    
+        if not self._is_valid_hostaddr(ec2inst.public_dns_name):
+            logger.debug("Waiting for instance %s to boot and be assigned a public IP address" % instance.id)
+            return False
+        
+        # fill out instance fields
+        instance.priv_addr = ec2inst.private_dns_name
+        instance.pub_addr = ec2inst.public_dns_name
+        self._phase(instance, "address")
+        return True
+
+    def _needs_address(self, instance):
+        """
+        :return: True if the instance is running, but does not have a public address
+        """
+        ec2inst = getattr(instance, "ec2_instance", None)
+        if ec2inst is None or ec2inst.state != "running":
+            return False
+        return ec2inst.public_dns_name is None or \
+               ec2inst.public_dns_name == "" or \
+               ec2inst.public_dns_name.startswith('10.')
+
+    def _complete_instanciation(self, instance):
+        """
+        Marks a bootstrapped instance as ready, and tags it in the cloud
+        """
+        ec2inst = instance.ec2_instance
+        logger.info("Instance %s has booted, public address: %s" % (instance.id, instance.pub_addr))
+
+        # add our tags
+        try:
+            ec2inst.add_tag("Name", "PRECIP - " + self._name)
+            # can only add 10 on EC2
+            tag_count = 1
+            for t in instance.tags:
+                if tag_count >= 10:
+                    break
+                ec2inst.add_tag(t, "1")
+                tag_count += 1
+        except Exception, e:
+            # ignore - the infrastructure might not support user tags
+            pass
+        
+        Experiment._complete_instanciation(self, instance)
+
+    def _refresh_instances(self, instances):
+        """
+        Updates the state of a set of instances with a single request
+        
+        :param instances: the instances to update
+        """
+        if len(instances) == 0:
+            return
+        try:
+            reservations = self._conn.get_all_instances(instance_ids=[i.id for i in instances])
+        except EC2ResponseError, e:
+            # instances which have just been started might not be known to the API yet, in
+            # which case the whole request fails - fall back to updating them one by one. Other
+            # errors, such as throttling, are left to wait().
+            if e.error_code != "InvalidInstanceID.NotFound":
+                raise
+            logger.debug("Unable to update instances in one request: %s" % str(e))
+            for i in instances:
+                try:
+                    i.ec2_instance.update()
+                except (EC2ResponseError, ValueError), e:
+                    if _is_throttled(e):
+                        raise
+                    logger.debug("Unable to update instance %s: %s" % (i.id, str(e)))
+            return
+        latest = {}
+        for reservation in reservations:
+            for boto_inst in reservation.instances:
+                latest[boto_inst.id] = boto_inst
+        for i in instances:
+            if i.id in latest:
+                i.ec2_instance = latest[i.id]
+
+    @_traced("retry")
+    def _retry(self, instance):
+        
+        """
+        In case of reaching timeout for an instance, retry will terminate the previous instance and 
+        replace it with a new instance.
+        
+        :param instance: the instance to terminate and replace with a new one
+        :param image_id: The image id as specified by the cloud infrastructure
+        :param instance_type: The instance type (m1.small, m1.large, ...)
+        :param tags: Tags to add to the new instance - this is important as tags are used throughout the API 
+                     to find and manipulate instances
+        """
+        
+        uid = self._get_account_id()
+        self._get_connection()
+        
+        logger.info("Instance %s has reached timeout, and will be replaced with a new instance" % instance.id)
+        try:
+            self._conn.terminate_instances(instance_ids=[instance.id])
+        except AttributeError as e:
+            logger.warn("Terminating issued an attribute warning")
+        except Exception as e:
+            logger.warn("Ignoring error while terminating instance", e)
+        self._addresses.recycle(instance.id)
+
+        boto_inst = self._start_instance(instance.image_id, instance.instance_type, instance.ebs_size)
+        instance.replace_tag(instance.id, boto_inst.id)
+        instance.id = boto_inst.id
+        instance.ec2_instance = boto_inst
+        instance.num_starts = instance.num_starts + 1
+        instance.boot_time = int(time.time())
+        instance.not_instanciated_correctly = False
+
+            
+    @_traced("provision", write=True)
+    def provision(self, image_id, instance_type='m1.small', count=1, ebs_size=None, tags=None,
+                  boot_timeout=900, boot_max_tries=3):
+        """
+        Provision a new instance. Note that this method starts the provisioning cycle, but does not
+        block for the instance to finish booting - for that, see wait()
+        
+        :param image_id: The image id as specified by the cloud infrastructure
+        :param instance_type: The instance type (m1.small, m1.large, ...)
+        :param count: Number of instances to provision. The default is 1.
+        :param tags: Tags to add to the instance - this is important as tags are used throughout the API 
+                     to find and manipulate instances
+        :param boot_timeout: The amount of allowed time in seconds for an instance to boot
+        :param boot_max_tries: The number of tries an instance is given to successfully boot
+        """   
+        
+        uid = self._get_account_id()
+        
+        self._get_connection()
+
+        pool_config = {"image_id": image_id, "instance_type": instance_type, "ebs_size": ebs_size}
+        for instance in self._take_from_warm_pool(pool_config, count):
+            instance.num_starts = 1
+            instance.boot_time = int(time.time())
+            instance.boot_timeout = boot_timeout
+            instance.boot_max_tries = 3
+            instance.add_tag("precip")
+            instance.add_tag(instance.id)
+            for t in tags:
+                instance.add_tag(t)
+            if instance.allocated_addr is not None:
+                self._addresses.adopt(instance.id, instance.allocated_addr)
+                instance.allocated_addr = None
+            self._add_instance(instance)
+            try:
+                instance.ec2_instance.remove_tag("precip-parked")
+            except Exception:
+                pass
+            self._complete_instanciation(instance)
+            count -= 1
+
+        # start the instances in as few requests as possible, and register each batch as it
+        # comes back so that they get cleaned up even if a later request fails
+        remaining = count
+        while remaining > 0:
+            batch_size = min(remaining, self._max_instances_per_request)
+            for boto_inst in self._start_instances(image_id, instance_type, ebs_size, batch_size):
+                instance = Instance(boto_inst.id)
+                instance.ec2_instance = boto_inst
+
+                # keep track of parameters - we might need them for restarts later
+                instance.num_starts = 1
+                instance.boot_time = int(time.time())
+                instance.boot_timeout = boot_timeout
+                instance.boot_max_tries = 3
+                instance.image_id = image_id
+                instance.instance_type = instance_type
+                instance.ebs_size = ebs_size
+                instance.pool_config = pool_config
+                
+                # add basic tags
+                instance.add_tag("precip")
+                instance.add_tag(instance.id)
+                for t in tags:
+                    instance.add_tag(t)
+                
+                self._add_instance(instance)
+            remaining -= batch_size
+            self._save_journal()
+
+
+    def wait(self, tags=[]):
+        """
+        Barrier for all currently instances to finish booting and be accessible via external
+        addresses. See Experiment.wait(). Once all the instances are up, the public addresses
+        which were allocated but not needed are released.
+        
+        :param tags: set of tags to match against
+        """
+        Experiment.wait(self, tags)
+        if len([i for i in self._instances if not i.is_fully_instanciated]) == 0:
+            self._addresses.release()
+
+    def _warm_pool_key(self):
+        return "ec2:%s:%s:%s" % (self._region, self._endpoint, self._access_key)
+
+    def _tag_parked(self, instance):
+        try:
+            instance.ec2_instance.add_tag("Name", "PRECIP - parked")
+            instance.ec2_instance.add_tag("precip-parked", str(int(time.time())))
+        except Exception:
+            # ignore - the infrastructure might not support user tags
+            pass
+
+    def _terminate_parked(self, records):
+        if len(records) == 0:
+            return
+        instance_ids = [r["id"] for r in records]
+        logger.info("Terminating parked instances %s" % ", ".join(instance_ids))
+        try:
+            self._conn.terminate_instances(instance_ids=instance_ids)
+        except Exception as e:
+            logger.warn("Unable to terminate parked instances: %s" % str(e))
+        # the addresses precip allocated for the instances went into the pool with them
+        addrs = [r["allocated_addr"] for r in records if r.get("allocated_addr") is not None]
+        self._addresses.release(addrs)
+
+    def _reattach_instances(self, instances):
+        """
+        Looks up the journaled instances, and drops the ones which have been terminated
+        """
+        self._get_connection()
+        boto_instances = {}
+        try:
+            for reservation in self._conn.get_all_instances(instance_ids=[i.id for i in instances]):
+                for boto_inst in reservation.instances:
+                    boto_instances[boto_inst.id] = boto_inst
+        except EC2ResponseError:
+            # the request fails if any of the instances is gone - look them up one by one
+            for i in instances:
+                try:
+                    for reservation in self._conn.get_all_instances(instance_ids=[i.id]):
+                        for boto_inst in reservation.instances:
+                            boto_instances[boto_inst.id] = boto_inst
+                except EC2ResponseError:
+                    pass
+
+        alive = []
+        for i in instances:
+            boto_inst = boto_instances.get(i.id)
+            if boto_inst is None or boto_inst.state in ["shutting-down", "terminated"]:
+                logger.info("Instance %s no longer exists" % i.id)
+                continue
+            i.ec2_instance = boto_inst
+            alive.append(i)
+        return alive
+
+    @_traced("deprovision", write=True)
+    def deprovision(self, tags=[]):
+        """
+        Deprovisions (terminates) instances with the matching tags
+        
+        :param tags: set of tags to match against
+        """
+        self._get_connection()
+        subset = self._instance_subset(tags)
+        # parked instances keep their address, which has to be released when they are terminated
+        for i in subset:
+            i.allocated_addr = self._addresses.allocated_to(i.id)
+        parked = self._park_instances(subset)
+        for i in subset:
+            if i in parked:
+                self._addresses.hand_over(i.id)
+                self._forget_instance(i)
+                continue
+            logger.info("Deprovisioning instance: %s" % i.id)
+            try:
+                self._conn.terminate_instances(instance_ids=[i.id])
+            except AttributeError as e:
+                logger.warn("Deprovisioning issued an attribute warning")
+            self._addresses.recycle(i.id)
+            self._forget_instance(i)
+        self._save_journal()
+
+        # keep the spare addresses while other instances might still need them
+        if len([i for i in self._instances if not i.is_fully_instanciated]) == 0:
+            self._addresses.release()
+
+
+class OpenStackExperiment(EC2Experiment):
+    """
+    A class defining an experiment running on top of OpenStack
+    """
+
+    _cloud_name = "openstack"
+    
+    def __init__(self, endpoint, access_key, secret_key, name = None):
+        """
+        Initializes an OpenStack experiment
+        
+        :param endpoint: OpenStack endpoint
+        :param access_keys: OpenStack access key
+        :param secret_keys: OpenStack secret key
+        """        
+        EC2Experiment.__init__(self, "openstack", endpoint, access_key, secret_key)
+
+
+class EucalyptusExperiment(EC2Experiment):
+    """
+    A class defining an experiment running on top of Eucalyptus
+    """
+
+    _cloud_name = "eucalyptus"
+    
+    def __init__(self, endpoint, access_key, secret_key, name = None):
+        """
+        Initializes an Eucalyptus experiment
+        
+        :param endpoint: Eucalyptus endpoint
+        :param access_keys: Eucalyptus access key
+        :param secret_keys: Eucalyptus secret key
+        """        
+        EC2Experiment.__init__(self, "eucalyptus", endpoint, access_key, secret_key)
+
+
+class NimbusExperiment(EC2Experiment):
+    """
+    A class defining an experiment running on top of Nimbus
+    """
+
+    _cloud_name = "nimbus"
+    
+    def __init__(self, endpoint, access_key, secret_key, name = None):
+        """
+        Initializes a Nimbus experiment
+        
+        :param endpoint: Nimbus endpoint
+        :param access_keys: Nimbus access key
+        :param secret_keys: Nimbus secret key
+        """       
+        EC2Experiment.__init__(self, "nimbus", endpoint, access_key, secret_key)
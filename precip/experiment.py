@@ -17,28 +17,33 @@ limitations under the License.
 
 """
 
+import atexit
+import base64
+import collections
+import fcntl
+import functools
+import hashlib
+import imp
+import importlib
+import json
 import logging
 import os
+import pipes
+import Queue
 import random
 import re
+import select
 import socket
+import StringIO
 import subprocess
+import sys
+import tempfile
 import time
 import uuid
 import threading
+import weakref
+from distutils.spawn import find_executable
 
-import paramiko
-
-import boto
-#from boto.ec2.connection import EC2Connection
-from boto.ec2.regioninfo import RegionInfo
-from boto.ec2.blockdevicemapping import EBSBlockDeviceType, BlockDeviceMapping
-from boto.exception import EC2ResponseError
-
-from oauth2client.client import GoogleCredentials
-from googleapiclient.discovery import build
-
-from azure_resource_manager import AzureResourceManager
 
 __all__ = ["ExperimentException",
            "EC2Experiment",
@@ -49,6 +54,32 @@ __all__ = ["ExperimentException",
            "AzureExperiment"]
 
 
+class _LazyModule:
+    """
+    Stands in for a module, which is imported when one of its attributes is first used. This
+    keeps importing precip fast, and the cloud SDKs are only imported by the backends which use
+    them (see ec2.py, gcloud.py and azure.py).
+    """
+
+    def __init__(self, name):
+        self.__dict__["_name"] = name
+        self.__dict__["_module"] = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self.__dict__["_module"] = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+paramiko = _LazyModule("paramiko")
+
+
+_RESOURCES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "resources")
+
+# the block checksumming helper is run both locally and on the instances
+_blocksum = imp.load_source("precip_blocksum", os.path.join(_RESOURCES_DIR, "blocksum.py"))
+
+
 #logging.basicConfig(level=logging.WARN)
 logger = logging.getLogger('precip')
 
@@ -69,561 +100,2303 @@ boto_logger = logging.getLogger('boto')
 boto_logger.setLevel(level=logging.FATAL)
 
 
-class SSHConnection:
-    """ 
-    Helper class for simple ssh functionality such as copying files and running commands.
-    
-    The only authentication method supported is ssh pub/priv key authentication.
+def _parallel_map(func, items, parallelism=1):
     """
+    Calls func for each of the items, using up to parallelism worker threads. The results are
+    returned in the same order as the items. If a call raises an exception, no new calls are started,
+    the calls already running are allowed to finish, and then the first exception is raised again.
     
-    def _new_connection(self, privkey, host, user):
+    :param func: function taking a single item
+    :param items: list of items
+    :param parallelism: maximum number of concurrent calls
+    :return: list of results
+    """
+    results = [None] * len(items)
+    if parallelism is None or parallelism <= 1 or len(items) <= 1:
+        for n, item in enumerate(items):
+            results[n] = func(item)
+        return results
+
+    work = Queue.Queue()
+    for n, item in enumerate(items):
+        work.put((n, item))
+    errors = []
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                if len(errors) > 0:
+                    return
+            try:
+                n, item = work.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[n] = func(item)
+            except Exception:
+                with lock:
+                    errors.append(sys.exc_info())
+                return
+
+    threads = []
+    for _i in range(min(parallelism, len(items))):
+        t = threading.Thread(target=worker)
+        t.daemon = True
+        t.start()
+        threads.append(t)
+    for t in threads:
+        # join with a timeout so that the main thread stays responsive to KeyboardInterrupt
+        while t.is_alive():
+            t.join(1)
+
+    if len(errors) > 0:
+        if work.qsize() > 0:
+            logger.info("Cancelled %d remaining tasks due to an earlier failure" % work.qsize())
+        exc_type, exc_value, exc_tb = errors[0]
+        raise exc_type, exc_value, exc_tb
+    return results
+
+
+class BandwidthLimiter:
+    """
+    Token bucket which caps the combined throughput of all the transfers sharing it
+    """
+
+    def __init__(self, rate):
         """
-        Internal method for setting up a ssh connection. As the instances come up with different
-        host keys all the time, the host key validation has been disabled.
-        
-        :return: a handle to the ssh connection
-        """ 
-        ssh = paramiko.SSHClient()
-        hkeys = ssh.get_host_keys()
-        hkeys.clear()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh.connect(host, 22, username=user, key_filename=privkey, allow_agent=False, look_for_keys=False)
-        transport = ssh.get_transport()
-        transport.set_keepalive(30)
-        return ssh
-    
-    def run(self, privkey, host, user, cmd):
+        :param rate: maximum number of bytes per second
         """
-        Runs a command on the remote machine.
-        
-        :return: exit code, stdout and stderr from the command
+        self._rate = float(rate)
+        self._lock = threading.Lock()
+        self._allowance = 0.0
+        self._last = time.time()
+
+    def consume(self, nbytes):
         """
-        logger.debug("Running command on host %s as user %s: %s" % (host, user, cmd))
-        out = ""
-        err = ""
-        ssh = self._new_connection(privkey, host, user)
-        chan = ssh.get_transport().open_session()
-        chan.get_pty()
-        stdin = chan.makefile("wb", -1)
-        stdout = chan.makefile("rb", -1)
-        stderr = chan.makefile_stderr("rb", -1)
-        chan.exec_command(cmd)
-        stdin.flush()
-        exit_code = chan.recv_exit_status()
-        for line in stdout:
-            out += line
-        for line in stderr:
-            err += line
-        ssh.close()        
-        return exit_code, out, err
-
-    def put(self, privkey, host, user, local_path, remote_path):
-        """
-        Copies file from the local machine to the remote machine
+        Accounts for nbytes being transferred, and sleeps if the rate is exceeded
         """
-        ssh = self._new_connection(privkey, host, user)
-        ftp = ssh.open_sftp()
-        ftp.put(local_path, remote_path)
-        ftp.close()
-        ssh.close()
+        with self._lock:
+            now = time.time()
+            # allow bursts of up to one second worth of data
+            self._allowance = min(self._rate, self._allowance + (now - self._last) * self._rate)
+            self._last = now
+            self._allowance -= nbytes
+            delay = 0
+            if self._allowance < 0:
+                delay = -self._allowance / self._rate
+        if delay > 0:
+            time.sleep(delay)
+
+
+class _WorkerPool:
+    """
+    A bounded set of background threads running queued tasks. The threads are started as needed.
+    """
 
-    def get(self, privkey, host, user, remote_path, local_path):
+    def __init__(self, size):
         """
-        Copies file from the remote machine to the local machine
+        :param size: maximum number of threads
         """
-        ssh = self._new_connection(privkey, host, user)
-        ftp = ssh.open_sftp()
-        ftp.get(remote_path, local_path)
-        ftp.close()
-        ssh.close()
+        self._size = size
+        self._tasks = Queue.Queue()
+        self._lock = threading.Lock()
+        self._threads = 0
+        self._idle = 0
+
+    def submit(self, func, *args):
+        """
+        Queues func(*args) to be run by one of the threads
+        """
+        with self._lock:
+            start_thread = self._idle == 0 and self._threads < self._size
+            if start_thread:
+                self._threads += 1
+            else:
+                self._idle -= 1
+        self._tasks.put((func, args))
+        if start_thread:
+            t = threading.Thread(target=self._worker)
+            t.daemon = True
+            t.start()
+
+    def _worker(self):
+        while True:
+            func, args = self._tasks.get()
+            try:
+                func(*args)
+            except Exception, e:
+                logger.warn("Background task failed: %s" % e)
+            with self._lock:
+                self._idle += 1
 
 
-class ExperimentException(Exception):
+class _OutputTail:
     """
-    Class for grouping the most common experiment failures 
+    Collects output from a remote command, optionally only keeping the last max_bytes of it
     """
-    pass
 
+    def __init__(self, max_bytes=None):
+        self._max_bytes = max_bytes
+        self._chunks = collections.deque()
+        self._size = 0
 
-class Instance:
+    def add(self, data):
+        self._chunks.append(data)
+        self._size += len(data)
+        if self._max_bytes is None:
+            return
+        # drop whole chunks which are out of the window, and trim the first one left
+        while self._chunks and self._size - len(self._chunks[0]) >= self._max_bytes:
+            self._size -= len(self._chunks.popleft())
+        if self._size > self._max_bytes:
+            excess = self._size - self._max_bytes
+            self._chunks[0] = self._chunks[0][excess:]
+            self._size -= excess
+
+    def value(self):
+        return "".join(self._chunks)
+
+
+class _OutputWriter:
     """
-    Representation of an instance, and a few common attributes of that instance
+    Passes the output of a remote command on to output files and/or a callback as it arrives.
+    Output files are only created if the command produces output on that stream.
+    """
+
+    def __init__(self, instance_id, output_base_name, callback):
+        self._instance_id = instance_id
+        self._output_base_name = output_base_name
+        self._callback = callback
+        self._files = {}
+
+    def stdout(self, data):
+        self._write("stdout", data)
+
+    def stderr(self, data):
+        self._write("stderr", data)
+
+    def _write(self, stream_name, data):
+        if self._output_base_name is not None:
+            fname = "%s.%s.%s" %(self._output_base_name, self._instance_id, stream_name)
+            try:
+                if stream_name not in self._files:
+                    self._files[stream_name] = open(fname, 'wb')
+                self._files[stream_name].write(data)
+            except Exception, e:
+                raise ExperimentException("Unable to write to " + fname, e)
+        if self._callback is not None:
+            self._callback(self._instance_id, stream_name, data)
+
+    def close(self):
+        for f in self._files.values():
+            f.close()
+        self._files = {}
+
+
+class _Metrics:
+    """
+    Counters and latency histograms, keyed by metric name and labels. The labels given to the
+    constructor are added to every metric. Thread safe.
+    """
+
+    # upper bounds, in seconds, of the histogram buckets
+    _buckets = [0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600]
+
+    def __init__(self, labels=None):
+        self._labels = labels or {}
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        # when set, timers are also recorded as trace spans
+        self.tracer = None
+
+    def _key(self, name, labels):
+        merged = dict(self._labels)
+        merged.update(labels)
+        return name, tuple(sorted(merged.items()))
+
+    def inc(self, name, value=1, **labels):
+        """
+        Adds to a counter
+        """
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        """
+        Records a duration in a histogram
+        """
+        key = self._key(name, labels)
+        with self._lock:
+            h = self._histograms.get(key)
+            if h is None:
+                h = {"count": 0, "sum": 0.0, "min": seconds, "max": seconds,
+                     "buckets": [0] * (len(self._buckets) + 1)}
+                self._histograms[key] = h
+            h["count"] += 1
+            h["sum"] += seconds
+            h["min"] = min(h["min"], seconds)
+            h["max"] = max(h["max"], seconds)
+            n = 0
+            while n < len(self._buckets) and seconds > self._buckets[n]:
+                n += 1
+            h["buckets"][n] += 1
+
+    def timer(self, name, **labels):
+        """
+        :return: a context manager which records the time spent in it. Errors are also counted,
+                 in a counter named like the histogram but ending in _errors instead of _seconds.
+        """
+        return _Timer(self, name, labels)
+
+    def snapshot(self):
+        """
+        :return: dictionary with lists of counters and histograms
+        """
+        with self._lock:
+            counters = [{"name": k[0], "labels": dict(k[1]), "value": v}
+                        for k, v in sorted(self._counters.items())]
+            histograms = []
+            for k, h in sorted(self._histograms.items()):
+                buckets = {}
+                total = 0
+                for bound, count in zip(self._buckets + ["+Inf"], h["buckets"]):
+                    total += count
+                    buckets[str(bound)] = total
+                histograms.append({"name": k[0], "labels": dict(k[1]), "count": h["count"],
+                                   "sum": h["sum"], "min": h["min"], "max": h["max"],
+                                   "buckets": buckets})
+        return {"counters": counters, "histograms": histograms}
+
+    def to_prometheus(self):
+        """
+        :return: the metrics in the Prometheus text exposition format
+        """
+        def fmt_labels(labels, extra=None):
+            items = sorted(labels.items()) + (extra or [])
+            if len(items) == 0:
+                return ""
+            return "{" + ",".join(['%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+                                   for k, v in items]) + "}"
+
+        snapshot = self.snapshot()
+        lines = []
+        typed = set()
+        for c in snapshot["counters"]:
+            name = "precip_" + c["name"] + "_total"
+            if name not in typed:
+                lines.append("# TYPE %s counter" % name)
+                typed.add(name)
+            lines.append("%s%s %s" % (name, fmt_labels(c["labels"]), c["value"]))
+        for h in snapshot["histograms"]:
+            name = "precip_" + h["name"]
+            if name not in typed:
+                lines.append("# TYPE %s histogram" % name)
+                typed.add(name)
+            for bound in self._buckets + ["+Inf"]:
+                lines.append("%s_bucket%s %d" % (name, fmt_labels(h["labels"], [("le", str(bound))]),
+                                                 h["buckets"][str(bound)]))
+            lines.append("%s_sum%s %f" % (name, fmt_labels(h["labels"]), h["sum"]))
+            lines.append("%s_count%s %d" % (name, fmt_labels(h["labels"]), h["count"]))
+        return "\n".join(lines) + "\n"
+
+
+class _Timer:
     """
+    Context manager returned by _Metrics.timer()
+    """
+
+    def __init__(self, metrics, name, labels):
+        self._metrics = metrics
+        self._name = name
+        self._labels = labels
+
+    def __enter__(self):
+        self._start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        end = time.time()
+        self._metrics.observe(self._name, end - self._start, **self._labels)
+        if exc_type is not None:
+            self._metrics.inc(self._name.replace("_seconds", "") + "_errors", **self._labels)
+        tracer = self._metrics.tracer
+        if tracer is not None:
+            name = self._name.replace("_seconds", "")
+            detail = self._labels.get("op", self._labels.get("call"))
+            if detail is not None:
+                name += ":" + detail
+            args = dict(self._labels)
+            if exc_type is not None:
+                args["error"] = str(exc_value)
+            tracer.complete(name, self._start, end, **args)
+        return False
+
+
+class _Tracer:
+    """
+    Collects spans, and writes them as a Chrome trace event file which can be loaded in
+    chrome://tracing or Perfetto. Spans are shown per thread, and the boot phases of the instances
+    on a separate line per instance. Thread safe.
+    """
+
+    # process ids used to group the lines of the trace
+    _THREADS_PID = 1
+    _INSTANCES_PID = 2
+
+    def __init__(self, path, name):
+        self.path = path
+        self._lock = threading.Lock()
+        self._events = [
+            {"name": "process_name", "ph": "M", "pid": self._THREADS_PID, "tid": 0,
+             "args": {"name": "precip %s" % name}},
+            {"name": "process_name", "ph": "M", "pid": self._INSTANCES_PID, "tid": 0,
+             "args": {"name": "instances"}}]
+        self._threads = set()
+        self._lanes = {}
+
+    def complete(self, name, start, end, lane=None, **args):
+        """
+        Records a span
+        
+        :param name: name of the span
+        :param start: start time, as returned by time.time()
+        :param end: end time, as returned by time.time()
+        :param lane: instance id to show the span on the line of, instead of that of the thread
+        """
+        event = {"name": name, "ph": "X", "ts": int(start * 1000000),
+                 "dur": int((end - start) * 1000000), "args": args}
+        with self._lock:
+            if lane is None:
+                thread = threading.current_thread()
+                event["pid"] = self._THREADS_PID
+                event["tid"] = thread.ident
+                if thread.ident not in self._threads:
+                    self._threads.add(thread.ident)
+                    self._events.append({"name": "thread_name", "ph": "M", "pid": self._THREADS_PID,
+                                         "tid": thread.ident, "args": {"name": thread.name}})
+            else:
+                tid = self._lanes.get(lane)
+                if tid is None:
+                    tid = len(self._lanes) + 1
+                    self._lanes[lane] = tid
+                    self._events.append({"name": "thread_name", "ph": "M",
+                                         "pid": self._INSTANCES_PID, "tid": tid,
+                                         "args": {"name": lane}})
+                event["pid"] = self._INSTANCES_PID
+                event["tid"] = tid
+            self._events.append(event)
+
+    def write(self):
+        """
+        Writes all spans recorded so far to the trace file
+        """
+        with self._lock:
+            events = list(self._events)
+        if not os.path.exists(os.path.dirname(os.path.abspath(self.path))):
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)))
+        tmp = self.path + ".tmp"
+        f = open(tmp, "w")
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+        f.close()
+        os.rename(tmp, self.path)
+
+
+def _traced(name, write=False):
+    """
+    Decorator for Experiment methods, which records a trace span for every call when tracing is
+    enabled. If the first argument is an instance, the span is labelled with its id.
     
-    id = None
-    priv_addr = None
-    pub_addr = None
-    tags = []
-    ec2_instance = None
-    gce_boot_response = None
-    azure_boot_thread = None
-    is_fully_instanciated = False
-    not_instanciated_correctly = False
+    :param name: name of the span
+    :param write: write out the trace file after the call
+    """
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            tracer = self._metrics.tracer
+            if tracer is None:
+                return func(self, *args, **kwargs)
+            span_args = {}
+            if len(args) > 0 and isinstance(args[0], Instance):
+                span_args["instance"] = args[0].id
+            start = time.time()
+            try:
+                result = func(self, *args, **kwargs)
+            except Exception, e:
+                span_args["error"] = str(e)
+                raise
+            else:
+                if isinstance(result, bool):
+                    span_args["result"] = result
+                return result
+            finally:
+                tracer.complete(name, start, time.time(), **span_args)
+                if write:
+                    tracer.write()
+        return wrapper
+    return decorate
+
+
+def _timed_ssh_op(op):
+    """
+    Decorator for SSHConnection methods, which records their duration per host
+    """
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(self, privkey, host, user, *args, **kwargs):
+            if self._metrics is None:
+                return func(self, privkey, host, user, *args, **kwargs)
+            with self._metrics.timer("ssh_op_seconds", op=op, host=host):
+                return func(self, privkey, host, user, *args, **kwargs)
+        return wrapper
+    return decorate
+
+
+# error codes and messages of the cloud APIs for requests which came in too fast
+_THROTTLE_MARKERS = ["RequestLimitExceeded", "Throttling", "rateLimitExceeded",
+                     "userRateLimitExceeded", "TooManyRequests"]
+
+
+def _is_throttled(e):
+    """
+    :return: True if the exception is a cloud API asking us to slow down
+    """
+    status = getattr(e, "status", None) or getattr(e, "status_code", None) or \
+             getattr(getattr(e, "resp", None), "status", None)
+    if status == 429:
+        return True
+    text = "%s %s %s" % (getattr(e, "error_code", ""), getattr(e, "content", ""), e)
+    for marker in _THROTTLE_MARKERS:
+        if marker in text:
+            return True
+    return False
+
+
+class _TimedProxy:
+    """
+    Wraps a cloud API client, and records the duration of every call made through it. For clients
+    where calls build requests which are run with execute(), such as the Google API client, only
+    execute() is timed, under the name of the calls leading up to it. Calls which are throttled
+    by the cloud are retried a few times, backing off exponentially.
+    """
+
+    # number of tries for a throttled call, and the delay before the first retry
+    _throttle_max_tries = 5
+    _throttle_backoff = 1.0
+
+    def __init__(self, target, metrics, deferred=False, call=None):
+        self.__dict__["_target"] = target
+        self.__dict__["_metrics"] = metrics
+        self.__dict__["_deferred"] = deferred
+        self.__dict__["_call"] = call
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if not callable(attr):
+            return attr
+        call = name if self._call is None else self._call + "." + name
+        if self._deferred and name != "execute":
+            def build(*args, **kwargs):
+                return _TimedProxy(attr(*args, **kwargs), self._metrics, deferred=True, call=call)
+            return build
+        if name == "execute":
+            call = self._call
+        def timed(*args, **kwargs):
+            tries = 0
+            while True:
+                try:
+                    with self._metrics.timer("cloud_api_seconds", call=call):
+                        return attr(*args, **kwargs)
+                except Exception, e:
+                    tries += 1
+                    if not _is_throttled(e) or tries >= self._throttle_max_tries:
+                        raise
+                    self._metrics.inc("cloud_api_throttled", call=call)
+                    delay = self._throttle_backoff * 2 ** (tries - 1)
+                    logger.debug("Call %s was throttled - retrying in %.1f seconds" % (call, delay))
+                    time.sleep(random.uniform(0.5, 1.5) * delay)
+        return timed
+
+    def __setattr__(self, name, value):
+        setattr(self._target, name, value)
+
+
+class _LocalFS:
+    """
+    The local file system, with the subset of the paramiko.SFTPClient interface used by _sync_tree()
+    """
+
+    def open(self, path, mode):
+        return open(path, mode)
+
+    def mkdir(self, path):
+        os.mkdir(path)
+
+    def chmod(self, path, mode):
+        os.chmod(path, mode)
+
+    def remove(self, path):
+        os.remove(path)
+
+    def rmdir(self, path):
+        os.rmdir(path)
+
+    def truncate(self, path, size):
+        f = open(path, "r+b")
+        f.truncate(size)
+        f.close()
+
+
+def _read_blocks(f, indexes, block_size):
+    """
+    Reads the given blocks of a file. sftp files get all the read requests sent up front.
     
-    def __init__(self, instance_id):
-        """
-        :param instance_id: a unique identifier for the instance, for example the amazon instance id
-        """
-        self.id = instance_id
-        self.tags = []
+    :return: iterator over the data of the blocks
+    """
+    if hasattr(f, "readv"):
+        return f.readv([(k * block_size, block_size) for k in indexes])
+    def read(k):
+        f.seek(k * block_size)
+        return f.read(block_size)
+    return (read(k) for k in indexes)
+
+
+def _sync_tree(src_fs, src_root, src_manifest, dst_fs, dst_root, dst_manifest, delete=False,
+               limiter=None):
+    """
+    Brings the destination tree in line with the source tree, using manifests from blocksum.py to
+    only copy the blocks which differ. Blocks are compared by position, so data inserted in the
+    middle of a file causes the rest of the file to be copied.
     
-    def add_tag(self, tag):
-        """
-        Tagging is implemented in our own instance as some infrastructures (OpenStack, ...) have not implemented
-        tagging in their API
-        """
-        self.tags.append(tag)
-        
-    def has_tags(self, tags):
-        """
-        Checks if the instance have all the tags queried for
-        """
+    :param src_fs: _LocalFS or paramiko.SFTPClient for the source tree
+    :param dst_fs: _LocalFS or paramiko.SFTPClient for the destination tree
+    :param delete: if true, files and directories which are not in the source tree are removed
+    :param limiter: optional BandwidthLimiter to cap the transfer rate
+    :return: number of bytes copied
+    """
+    block_size = src_manifest["block_size"]
+    nbytes = 0
+    dst_dirs = set(dst_manifest["dirs"])
+    dst_files = dst_manifest["files"]
+    for d in src_manifest["dirs"]:
+        if d not in dst_dirs:
+            dst_fs.mkdir(os.path.join(dst_root, d))
+
+    for rel, entry in sorted(src_manifest["files"].items()):
+        dst_path = os.path.join(dst_root, rel)
+        old = dst_files.get(rel)
+        if old is not None and old["size"] == entry["size"] and old["blocks"] == entry["blocks"]:
+            if old["mode"] != entry["mode"]:
+                dst_fs.chmod(dst_path, entry["mode"])
+            continue
+        if old is None:
+            changed = range(len(entry["blocks"]))
+            df = dst_fs.open(dst_path, "wb")
+        else:
+            changed = [k for k in range(len(entry["blocks"]))
+                       if k >= len(old["blocks"]) or old["blocks"][k] != entry["blocks"][k]]
+            df = dst_fs.open(dst_path, "r+b")
         try:
-            for t in tags:
-                # if the tag does not exists, we fail here with a ValueException
-                self.tags.index(t)
-        except ValueError:
-            return False            
-        return True
+            if hasattr(df, "set_pipelined"):
+                df.set_pipelined(True)
+            sf = src_fs.open(os.path.join(src_root, rel), "rb")
+            try:
+                for k, data in zip(changed, _read_blocks(sf, changed, block_size)):
+                    df.seek(k * block_size)
+                    df.write(data)
+                    nbytes += len(data)
+                    if limiter is not None:
+                        limiter.consume(len(data))
+            finally:
+                sf.close()
+        finally:
+            df.close()
+        if old is not None and old["size"] > entry["size"]:
+            dst_fs.truncate(dst_path, entry["size"])
+        dst_fs.chmod(dst_path, entry["mode"])
+
+    if delete:
+        for rel in sorted(set(dst_files) - set(src_manifest["files"])):
+            dst_fs.remove(os.path.join(dst_root, rel))
+        for d in sorted(dst_dirs - set(src_manifest["dirs"]), reverse=True):
+            dst_fs.rmdir(os.path.join(dst_root, d))
+    return nbytes
+
+
+def _file_sha1(path):
+    """
+    :return: the sha1 checksum of a local file
+    """
+    digest = hashlib.sha1()
+    f = open(path, "rb")
+    try:
+        while True:
+            data = f.read(1024 * 1024)
+            if len(data) == 0:
+                break
+            digest.update(data)
+    finally:
+        f.close()
+    return digest.hexdigest()
+
+
+def _load_sidecar(path, size, mtime, chunk_size):
+    """
+    Loads the record of the chunks transferred so far. The record is only used if it is for the
+    same version of the source file, and the same chunk size.
     
-    def info(self):
-        i = {}
-        i["id"] = self.id
-        i["public_address"]  = self.pub_addr
-        i["private_address"] = self.priv_addr
-        i["tags"] = self.tags
-        return i
+    :return: dictionary with size, mtime, chunk_size and done (chunk index to checksum)
+    """
+    if os.path.exists(path):
+        try:
+            f = open(path)
+            try:
+                state = json.load(f)
+            finally:
+                f.close()
+            if state["size"] == size and state["mtime"] == mtime and state["chunk_size"] == chunk_size:
+                return state
+        except (ValueError, KeyError):
+            pass
+        logger.debug("Ignoring stale transfer record " + path)
+    return {"size": size, "mtime": mtime, "chunk_size": chunk_size, "done": {}}
 
 
-class Experiment:
+def _save_sidecar(path, state):
+    if not os.path.exists(os.path.dirname(os.path.abspath(path))):
+        os.makedirs(os.path.dirname(os.path.abspath(path)))
+    tmp_path = path + ".tmp"
+    f = open(tmp_path, "w")
+    json.dump(state, f)
+    f.close()
+    os.rename(tmp_path, path)
+
+
+class SSHConnectionPool:
     """
-    Base class for all types of cloud implementations. This is what defines the experiment API.
+    Keeps authenticated ssh connections alive so that they can be reused for running commands and
+    transferring files. Connections are keyed by (host, user, private key). Every get() borrows the
+    connection until the matching release(). Connections which have been idle for too long, or
+    which transport has died, are evicted once nobody is borrowing them any more.
     """
-    
-    def __init__(self, name = None):
+
+    def __init__(self, idle_timeout=300, metrics=None):
         """
-        Constructor for a new experiment - this will set up ~/.precip and ssh keys if they
-        do not already exist in a way that you can use precip from multiple machines or 
-        accounts at the same time. 
+        :param idle_timeout: number of seconds a connection can be unused before it is closed
+        :param metrics: optional _Metrics to record connection setup times in
+        """
+        self._idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        # key -> [connection, time of last use, number of borrowers]
+        self._connections = {}
+        # connections taken out of the pool while still borrowed: id(connection) -> (key, entry)
+        self._retired = {}
+        self.metrics = metrics
+
+    def get(self, privkey, host, user):
         """
+        Borrows a connection to the given host, either an existing one from the pool or a new one.
+        It has to be given back with release().
         
-        if name is None:
-            self._name = str(int(time.time()))
+        :return: a handle to the ssh connection
+        """
+        key = (host, user, privkey)
+        with self._lock:
+            self._evict(time.time())
+            entry = self._connections.get(key)
+            if entry is not None:
+                entry[1] = time.time()
+                entry[2] += 1
+                if self.metrics is not None:
+                    self.metrics.inc("ssh_connections_reused", host=host)
+                return entry[0]
+
+        # connect outside of the lock so that a slow host does not hold up the other hosts
+        if self.metrics is not None:
+            with self.metrics.timer("ssh_connect_seconds", host=host):
+                ssh = SSHConnection.new_connection(privkey, host, user)
         else:
-            self._name = name
+            ssh = SSHConnection.new_connection(privkey, host, user)
+
+        with self._lock:
+            entry = self._connections.get(key)
+            if entry is not None and self._is_alive(entry[0]):
+                # another thread raced us to it - use that connection instead
+                ssh.close()
+                entry[1] = time.time()
+                entry[2] += 1
+                return entry[0]
+            if entry is not None:
+                self._retire(key, entry)
+            self._connections[key] = [ssh, time.time(), 1]
+        return ssh
 
-        self._instances = []
-        
-        self._conf_dir = os.path.join(os.environ["HOME"], ".precip")
-        
-        # checking/creating conf directory
-        if not os.path.exists(self._conf_dir):
-            os.makedirs(self._conf_dir)
-        
-        uid = self._get_account_id()
-        
-        # ssh keys setup 
-        self._ssh_pubkey = os.path.join(self._conf_dir, "precip_"+uid+".pub")
-        self._ssh_privkey = os.path.join(self._conf_dir, "precip_"+uid)
-        if not os.path.exists(self._ssh_privkey):
-            logger.info("Creating new ssh key in " + self._conf_dir)
-            logger.info("You don't need to enter a passphrase, just leave it blank and press enter!")
-            cmd = "ssh-keygen -q -t rsa -f " + self._ssh_privkey + " </dev/null"
-            p = subprocess.Popen(cmd, shell=True)
-            stdoutdata, stderrdata = p.communicate()
-            rc = p.returncode
-            if rc != 0:
-                raise ExperimentException("Command '%s' failed with error code %s" % (cmd, rc))
+    def release(self, ssh, privkey, host, user, broken=False):
+        """
+        Gives back a connection borrowed with get()
+        
+        :param broken: if true, the connection is taken out of the pool, so that nobody borrows it
+                       again, and closed once the other borrowers have given it back
+        """
+        key = (host, user, privkey)
+        close = False
+        with self._lock:
+            entry = self._connections.get(key)
+            if entry is None or entry[0] is not ssh:
+                entry = self._retired.get(id(ssh), (None, None))[1]
+                if entry is None:
+                    # closed by close_host() or close_all() in the meantime
+                    return
+            entry[1] = time.time()
+            entry[2] -= 1
+            if broken and self._connections.get(key) is entry:
+                self._retire(key, entry)
+            if entry[2] <= 0 and id(ssh) in self._retired:
+                del self._retired[id(ssh)]
+                close = True
+        if close:
+            logger.debug("Closing broken ssh connection to %s as user %s" % (host, user))
+            ssh.close()
+
+    def close_host(self, host):
+        """
+        Closes all connections to the given host
+        """
+        with self._lock:
+            keys = [k for k in self._connections.keys() if k[0] == host]
+            entries = [self._connections.pop(k) for k in keys]
+            for ssh_id, (key, entry) in list(self._retired.items()):
+                if key[0] == host:
+                    entries.append(self._retired.pop(ssh_id)[1])
+        for entry in entries:
+            entry[0].close()
+
+    def close_all(self):
+        """
+        Closes all connections in the pool
+        """
+        with self._lock:
+            entries = list(self._connections.values()) + [r[1] for r in self._retired.values()]
+            self._connections = {}
+            self._retired = {}
+        for entry in entries:
+            entry[0].close()
+
+    def _is_alive(self, ssh):
+        transport = ssh.get_transport()
+        return transport is not None and transport.is_active()
 
-    def __del__(self):
+    def _retire(self, key, entry):
         """
-        Deprovision all instances
+        Takes a connection out of the pool. It is closed right away if nobody is borrowing it,
+        otherwise when the last borrower gives it back. Has to be called with the lock held.
         """
-        self.deprovision([])
+        del self._connections[key]
+        if entry[2] > 0:
+            self._retired[id(entry[0])] = (key, entry)
+        else:
+            entry[0].close()
 
-    def _instance_subset(self, tags):
+    def _evict(self, now):
         """
-        Returns the subset of instances matching the tags
+        Removes idle and dead connections. Has to be called with the lock held.
         """
-        subset = []
-        for i in self._instances:
-            if i.has_tags(tags):
-                subset.append(i)
-        return subset
+        for key, entry in list(self._connections.items()):
+            if (entry[2] <= 0 and now - entry[1] > self._idle_timeout) or not self._is_alive(entry[0]):
+                logger.debug("Closing ssh connection to %s as user %s" % (key[0], key[1]))
+                self._retire(key, entry)
+
+
+class SSHConnection:
+    """ 
+    Helper class for simple ssh functionality such as copying files and running commands.
     
-    def _is_valid_hostaddr(self, addr):
+    The only authentication method supported is ssh pub/priv key authentication. If a connection
+    pool is given, connections are taken from and kept in the pool instead of being set up and torn
+    down for every operation.
+    """
+
+    def __init__(self, pool=None, metrics=None):
         """
-        Checks if a host address is "external". Note that addr can be either an ip address
-        or a fqdn.
+        :param pool: an optional SSHConnectionPool to reuse connections from
+        :param metrics: optional _Metrics to record operation times in. Defaults to the metrics of
+                        the pool.
         """
-        
-        re_ip = re.compile(r'^\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}$')
-        r = re_ip.search(self._endpoint)
-        if not r:
-            # assume addr is a fqdn
-            try:
-                addr = socket.gethostbyname(addr)
-            except socket.gaierror:
-                # unable to dns look up addr
-                return False
+        self._pool = pool
+        if metrics is None and pool is not None:
+            metrics = pool.metrics
+        self._metrics = metrics
 
-        # at this point addr should be in ip format
-        
-        # private up addresses are not valid (there is probably a better way to check this)
-        if addr[:3] == "10." or addr[:4] == "192." or addr[:4] == "172.":
-            return False 
-        
-        # make sure addr is a valid ip address
-        try:
-            socket.inet_aton(addr)
-            # valid
-        except socket.error:
-            return False
-        return True
-    
-    def _get_account_id(self):
-        
-        """
-        Checks if account_id with uid stored in it exists.
-        Returns the uid for this machine.
+    @staticmethod
+    def new_connection(privkey, host, user):
         """
+        Sets up a new ssh connection. As the instances come up with different
+        host keys all the time, the host key validation has been disabled.
         
-        self._account_id = os.path.join(self._conf_dir, "account_id")
+        :param host: host name or address, optionally followed by :port
+        :return: a handle to the ssh connection
+        """ 
+        port = 22
+        if host.count(":") == 1:
+            host, port = host.split(":")
+            port = int(port)
+        ssh = paramiko.SSHClient()
+        hkeys = ssh.get_host_keys()
+        hkeys.clear()
+        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        ssh.connect(host, port, username=user, key_filename=privkey, allow_agent=False, look_for_keys=False)
+        transport = ssh.get_transport()
+        transport.set_keepalive(30)
+        return ssh
+
+    def _new_connection(self, privkey, host, user):
+        """
+        Internal method for getting a ssh connection, from the pool if we have one
         
-        if not os.path.exists(self._account_id):
-            f = open(self._account_id,'w')
-            uid = str(uuid.uuid4().get_hex())
-            f.write(uid)
-            f.close()
-            
-        else:
-            f = open(self._account_id, 'r')
-            uid = f.read().rstrip('\n')
+        :return: a handle to the ssh connection
+        """ 
+        if self._pool is not None:
+            return self._pool.get(privkey, host, user)
+        return SSHConnection.new_connection(privkey, host, user)
+
+    def _release(self, ssh, privkey, host, user, error=None):
+        """
+        Internal method for giving back a connection after use. Unpooled connections are closed.
+        A pooled connection is only taken out of the pool if the operation failed with an ssh or
+        socket error, or its transport has died. Other errors, like a failing output callback or
+        local file, leave it to the other operations using it.
+        
+        :param error: the exception the operation failed with, if any
+        """
+        if self._pool is None:
+            ssh.close()
+            return
+        broken = False
+        if error is not None:
+            transport = ssh.get_transport()
+            broken = isinstance(error, (paramiko.SSHException, socket.error, EOFError)) or \
+                     transport is None or not transport.is_active()
+        self._pool.release(ssh, privkey, host, user, broken=broken)
+
+    def _open_session(self, privkey, host, user):
+        """
+        Opens a new session channel. A pooled connection which has gone stale is replaced once.
+        
+        :return: the connection and the channel
+        """
+        ssh = self._new_connection(privkey, host, user)
+        try:
+            return ssh, ssh.get_transport().open_session()
+        except Exception, e:
+            self._release(ssh, privkey, host, user, error=e)
+            if self._pool is None or not isinstance(e, paramiko.SSHException):
+                raise
+        ssh = self._new_connection(privkey, host, user)
+        try:
+            return ssh, ssh.get_transport().open_session()
+        except Exception, e:
+            self._release(ssh, privkey, host, user, error=e)
+            raise
+
+    def _open_sftp(self, privkey, host, user):
+        """
+        Opens a new sftp session. A pooled connection which has gone stale is replaced once.
+        
+        :return: the connection and the sftp client
+        """
+        ssh, chan = self._open_session(privkey, host, user)
+        try:
+            chan.invoke_subsystem("sftp")
+            return ssh, paramiko.SFTPClient(chan)
+        except Exception, e:
+            chan.close()
+            self._release(ssh, privkey, host, user, error=e)
+            raise
+
+    @_timed_ssh_op("run")
+    def run(self, privkey, host, user, cmd, pty=True, out_callback=None, err_callback=None,
+            max_capture=None, stdin=None):
+        """
+        Runs a command on the remote machine. stdout and stderr are read while the command is
+        running, and can be handed to callbacks as the data arrives.
+        
+        :param pty: if true, a pty is allocated for the command. Note that with a pty, most
+                    ssh servers merge stderr into stdout. Without a pty the streams are kept
+                    separate and the data is passed through untouched.
+        :param out_callback: optional function which is called with each chunk of stdout
+        :param err_callback: optional function which is called with each chunk of stderr
+        :param max_capture: if given, only the last max_capture bytes of stdout and stderr are
+                            kept in memory and returned
+        :param stdin: optional string to send to the command's stdin, which is closed afterwards.
+                      Use together with pty=False, as a pty does not pass on the end of input.
+        :return: exit code, stdout and stderr from the command
+        """
+        logger.debug("Running command on host %s as user %s: %s" % (host, user, cmd))
+        out = _OutputTail(max_capture)
+        err = _OutputTail(max_capture)
+        ssh, chan = self._open_session(privkey, host, user)
+        try:
+            if pty:
+                chan.get_pty()
+            chan.exec_command(cmd)
+            # stdin is sent from the read loop, so that a command producing output before it has
+            # read all its input can not block us
+            stdin_offset = 0
+            if stdin is not None and len(stdin) == 0:
+                chan.shutdown_write()
+                stdin = None
+            while True:
+                got_data = False
+                if stdin is not None and chan.send_ready():
+                    got_data = True
+                    try:
+                        stdin_offset += chan.send(stdin[stdin_offset:stdin_offset + self._RECV_SIZE])
+                        if stdin_offset >= len(stdin):
+                            chan.shutdown_write()
+                            stdin = None
+                    except socket.error:
+                        # the command has gone away without reading all of its input
+                        stdin = None
+                if chan.recv_ready():
+                    got_data = True
+                    self._handle_data(chan.recv(self._RECV_SIZE), out, out_callback)
+                if chan.recv_stderr_ready():
+                    got_data = True
+                    self._handle_data(chan.recv_stderr(self._RECV_SIZE), err, err_callback)
+                if got_data:
+                    continue
+                if chan.exit_status_ready():
+                    break
+                select.select([chan], [], [], 1)
+            # the remaining data is followed by eof, after which recv returns empty strings
+            for recv, tail, callback in [(chan.recv, out, out_callback),
+                                         (chan.recv_stderr, err, err_callback)]:
+                while True:
+                    data = recv(self._RECV_SIZE)
+                    if len(data) == 0:
+                        break
+                    self._handle_data(data, tail, callback)
+            exit_code = chan.recv_exit_status()
+            chan.close()
+        except Exception, e:
+            chan.close()
+            self._release(ssh, privkey, host, user, error=e)
+            raise
+        self._release(ssh, privkey, host, user)
+        return exit_code, out.value(), err.value()
+
+    _RECV_SIZE = 32768
+
+    def _handle_data(self, data, tail, callback):
+        tail.add(data)
+        if callback is not None:
+            callback(data)
+
+    # paramiko limits sftp reads and writes to 32k
+    _SFTP_BLOCK_SIZE = 32768
+
+    @_timed_ssh_op("put")
+    def put(self, privkey, host, user, local_path, remote_path, limiter=None):
+        """
+        Copies file from the local machine to the remote machine. Writes are pipelined, which means
+        that we do not wait for the server to acknowledge each block before sending the next one.
+        
+        :param limiter: optional BandwidthLimiter to cap the transfer rate
+        :return: number of bytes transferred
+        """
+        ssh, ftp = self._open_sftp(privkey, host, user)
+        try:
+            nbytes = 0
+            lf = open(local_path, "rb")
+            try:
+                rf = ftp.open(remote_path, "wb")
+                rf.set_pipelined(True)
+                try:
+                    while True:
+                        data = lf.read(self._SFTP_BLOCK_SIZE)
+                        if len(data) == 0:
+                            break
+                        rf.write(data)
+                        nbytes += len(data)
+                        if limiter is not None:
+                            limiter.consume(len(data))
+                finally:
+                    # waits for all the outstanding writes to be acknowledged
+                    rf.close()
+            finally:
+                lf.close()
+            remote_size = ftp.stat(remote_path).st_size
+            if remote_size != nbytes:
+                raise IOError("size mismatch in put!  %d != %d" % (remote_size, nbytes))
+        except Exception, e:
+            self._release(ssh, privkey, host, user, error=e)
+            raise
+        finally:
+            ftp.close()
+        self._release(ssh, privkey, host, user)
+        return nbytes
+
+    @_timed_ssh_op("get")
+    def get(self, privkey, host, user, remote_path, local_path, limiter=None):
+        """
+        Copies file from the remote machine to the local machine. The remote file is read ahead,
+        which means that read requests for the whole file are sent before the data is consumed.
+        
+        :param limiter: optional BandwidthLimiter to cap the transfer rate
+        :return: number of bytes transferred
+        """
+        ssh, ftp = self._open_sftp(privkey, host, user)
+        try:
+            nbytes = 0
+            rf = ftp.open(remote_path, "rb")
+            try:
+                remote_size = rf.stat().st_size
+                rf.prefetch()
+                lf = open(local_path, "wb")
+                try:
+                    while True:
+                        data = rf.read(self._SFTP_BLOCK_SIZE)
+                        if len(data) == 0:
+                            break
+                        lf.write(data)
+                        nbytes += len(data)
+                        if limiter is not None:
+                            limiter.consume(len(data))
+                finally:
+                    lf.close()
+            finally:
+                rf.close()
+            if remote_size != nbytes:
+                raise IOError("size mismatch in get!  %d != %d" % (remote_size, nbytes))
+        except Exception, e:
+            self._release(ssh, privkey, host, user, error=e)
+            raise
+        finally:
+            ftp.close()
+        self._release(ssh, privkey, host, user)
+        return nbytes
+
+    @_timed_ssh_op("sha1")
+    def _remote_sha1(self, privkey, host, user, path, offset=None, length=None):
+        """
+        Computes the sha1 checksum of a remote file, or of a range of it
+        """
+        cmd = "sha1sum <%s" % pipes.quote(path)
+        if offset is not None:
+            # dd can only skip whole blocks, so the chunks have to be aligned on the block size
+            cmd = "dd if=%s bs=%d skip=%d count=1 2>/dev/null | sha1sum" \
+                  % (pipes.quote(path), length, offset / length)
+        exit_code, out, err = self.run(privkey, host, user, cmd, pty=False)
+        if exit_code != 0:
+            raise IOError("Unable to checksum %s on %s: %s" % (path, host, err))
+        return out.split()[0]
+
+    @_timed_ssh_op("get_chunked")
+    def get_chunked(self, privkey, host, user, remote_path, local_path, sidecar,
+                    chunk_size=64 * 1024 * 1024, channels=4, limiter=None):
+        """
+        Copies a file from the remote machine in chunks, which are fetched over several sftp
+        channels at the same time. Every chunk is checked against a checksum computed on the remote
+        machine, and recorded in the sidecar file when it is done. If the transfer fails, calling
+        this again with the same sidecar only fetches the missing chunks. At the end the checksum
+        of the whole file is checked, and the sidecar is removed.
+        
+        :param sidecar: local file to record the completed chunks in
+        :param chunk_size: size of the chunks
+        :param channels: number of chunks to transfer at the same time
+        :param limiter: optional BandwidthLimiter to cap the transfer rate
+        :return: number of bytes transferred
+        """
+        ssh, ftp = self._open_sftp(privkey, host, user)
+        try:
+            st = ftp.stat(remote_path)
+        except Exception, e:
+            self._release(ssh, privkey, host, user, error=e)
+            raise
+        finally:
+            ftp.close()
+        self._release(ssh, privkey, host, user)
+
+        state = _load_sidecar(sidecar, st.st_size, st.st_mtime, chunk_size)
+        if len(state["done"]) == 0 or not os.path.exists(local_path):
+            state["done"] = {}
+            f = open(local_path, "wb")
+            f.truncate(st.st_size)
             f.close()
-        return uid   
+        nchunks = max(1, (st.st_size + chunk_size - 1) / chunk_size)
+        pending = [k for k in range(nchunks) if str(k) not in state["done"]]
+        if len(pending) < nchunks:
+            logger.info("Resuming transfer of %s: %d of %d chunks left" % (remote_path, len(pending), nchunks))
+        lock = threading.Lock()
+
+        def fetch(k):
+            offset = k * chunk_size
+            length = min(chunk_size, st.st_size - offset)
+            digest = hashlib.sha1()
+            ssh, ftp = self._open_sftp(privkey, host, user)
+            try:
+                rf = ftp.open(remote_path, "rb")
+                lf = open(local_path, "r+b")
+                try:
+                    lf.seek(offset)
+                    blocks = [(o, min(self._SFTP_BLOCK_SIZE, offset + length - o))
+                              for o in range(offset, offset + length, self._SFTP_BLOCK_SIZE)]
+                    for data in rf.readv(blocks):
+                        lf.write(data)
+                        digest.update(data)
+                        if limiter is not None:
+                            limiter.consume(len(data))
+                finally:
+                    lf.close()
+                    rf.close()
+            except Exception, e:
+                self._release(ssh, privkey, host, user, error=e)
+                raise
+            finally:
+                ftp.close()
+            self._release(ssh, privkey, host, user)
+            remote_sum = self._remote_sha1(privkey, host, user, remote_path, offset, chunk_size)
+            if digest.hexdigest() != remote_sum:
+                raise IOError("checksum mismatch in chunk %d of %s" % (k, remote_path))
+            with lock:
+                state["done"][str(k)] = remote_sum
+                _save_sidecar(sidecar, state)
+            return length
+
+        nbytes = sum(_parallel_map(fetch, pending, channels))
+        if _file_sha1(local_path) != self._remote_sha1(privkey, host, user, remote_path):
+            # the chunks can not be trusted either - start over next time
+            os.remove(sidecar)
+            raise IOError("checksum mismatch in get of %s" % remote_path)
+        if os.path.exists(sidecar):
+            os.remove(sidecar)
+        return nbytes
+
+    @_timed_ssh_op("put_chunked")
+    def put_chunked(self, privkey, host, user, local_path, remote_path, sidecar,
+                    chunk_size=64 * 1024 * 1024, channels=4, limiter=None):
+        """
+        Copies a file to the remote machine in chunks, which are sent over several sftp channels at
+        the same time. Works like get_chunked(), but in the other direction.
+        
+        :param sidecar: local file to record the completed chunks in
+        :param chunk_size: size of the chunks
+        :param channels: number of chunks to transfer at the same time
+        :param limiter: optional BandwidthLimiter to cap the transfer rate
+        :return: number of bytes transferred
+        """
+        st = os.stat(local_path)
+        state = _load_sidecar(sidecar, st.st_size, st.st_mtime, chunk_size)
+        ssh, ftp = self._open_sftp(privkey, host, user)
+        try:
+            if len(state["done"]) == 0:
+                ftp.open(remote_path, "wb").close()
+                ftp.truncate(remote_path, st.st_size)
+            elif ftp.stat(remote_path).st_size != st.st_size:
+                # somebody else has been at the remote file
+                state["done"] = {}
+                ftp.truncate(remote_path, st.st_size)
+        except Exception, e:
+            self._release(ssh, privkey, host, user, error=e)
+            raise
+        finally:
+            ftp.close()
+        self._release(ssh, privkey, host, user)
+
+        nchunks = max(1, (st.st_size + chunk_size - 1) / chunk_size)
+        pending = [k for k in range(nchunks) if str(k) not in state["done"]]
+        if len(pending) < nchunks:
+            logger.info("Resuming transfer of %s: %d of %d chunks left" % (local_path, len(pending), nchunks))
+        lock = threading.Lock()
+
+        def send(k):
+            offset = k * chunk_size
+            length = min(chunk_size, st.st_size - offset)
+            digest = hashlib.sha1()
+            ssh, ftp = self._open_sftp(privkey, host, user)
+            try:
+                lf = open(local_path, "rb")
+                rf = ftp.open(remote_path, "r+b")
+                rf.set_pipelined(True)
+                try:
+                    lf.seek(offset)
+                    rf.seek(offset)
+                    left = length
+                    while left > 0:
+                        data = lf.read(min(self._SFTP_BLOCK_SIZE, left))
+                        if len(data) == 0:
+                            raise IOError("%s changed during the transfer" % local_path)
+                        rf.write(data)
+                        digest.update(data)
+                        left -= len(data)
+                        if limiter is not None:
+                            limiter.consume(len(data))
+                finally:
+                    rf.close()
+                    lf.close()
+            except Exception, e:
+                self._release(ssh, privkey, host, user, error=e)
+                raise
+            finally:
+                ftp.close()
+            self._release(ssh, privkey, host, user)
+            if digest.hexdigest() != self._remote_sha1(privkey, host, user, remote_path, offset, chunk_size):
+                raise IOError("checksum mismatch in chunk %d of %s" % (k, local_path))
+            with lock:
+                state["done"][str(k)] = digest.hexdigest()
+                _save_sidecar(sidecar, state)
+            return length
+
+        nbytes = sum(_parallel_map(send, pending, channels))
+        if _file_sha1(local_path) != self._remote_sha1(privkey, host, user, remote_path):
+            if os.path.exists(sidecar):
+                os.remove(sidecar)
+            raise IOError("checksum mismatch in put of %s" % local_path)
+        if os.path.exists(sidecar):
+            os.remove(sidecar)
+        return nbytes
+
+    @_timed_ssh_op("pipe_to")
+    def pipe_to(self, privkey, host, user, cmd, source, limiter=None):
+        """
+        Runs a command on the remote machine, streaming data from a local file object to its stdin
+        
+        :param source: file object to read the data from, until end of file
+        :param limiter: optional BandwidthLimiter to cap the transfer rate
+        :return: exit code, number of bytes sent and stderr from the command
+        """
+        logger.debug("Streaming to command on host %s as user %s: %s" % (host, user, cmd))
+        out = _OutputTail(self._RECV_SIZE)
+        err = _OutputTail(self._RECV_SIZE)
+        nbytes = 0
+        ssh, chan = self._open_session(privkey, host, user)
+        try:
+            chan.exec_command(cmd)
+            while True:
+                data = source.read(self._RECV_SIZE)
+                if len(data) == 0:
+                    break
+                try:
+                    chan.sendall(data)
+                except socket.error:
+                    # the command has gone away - the exit code tells why
+                    break
+                nbytes += len(data)
+                if limiter is not None:
+                    limiter.consume(len(data))
+                # keep the window open for output from the command
+                while chan.recv_ready():
+                    out.add(chan.recv(self._RECV_SIZE))
+                while chan.recv_stderr_ready():
+                    err.add(chan.recv_stderr(self._RECV_SIZE))
+            chan.shutdown_write()
+            for recv, tail in [(chan.recv, out), (chan.recv_stderr, err)]:
+                while True:
+                    data = recv(self._RECV_SIZE)
+                    if len(data) == 0:
+                        break
+                    tail.add(data)
+            exit_code = chan.recv_exit_status()
+            chan.close()
+        except Exception, e:
+            chan.close()
+            self._release(ssh, privkey, host, user, error=e)
+            raise
+        self._release(ssh, privkey, host, user)
+        return exit_code, nbytes, err.value()
+
+    @_timed_ssh_op("pipe_from")
+    def pipe_from(self, privkey, host, user, cmd, sink, limiter=None):
+        """
+        Runs a command on the remote machine, streaming its stdout to a local file object
+        
+        :param sink: file object to write the data to
+        :param limiter: optional BandwidthLimiter to cap the transfer rate
+        :return: exit code, number of bytes received and stderr from the command
+        """
+        logger.debug("Streaming from command on host %s as user %s: %s" % (host, user, cmd))
+        err = _OutputTail(self._RECV_SIZE)
+        counter = [0]
+        def write(data):
+            sink.write(data)
+            counter[0] += len(data)
+            if limiter is not None:
+                limiter.consume(len(data))
+        ssh, chan = self._open_session(privkey, host, user)
+        try:
+            chan.exec_command(cmd)
+            while True:
+                if chan.recv_ready():
+                    write(chan.recv(self._RECV_SIZE))
+                    continue
+                if chan.recv_stderr_ready():
+                    err.add(chan.recv_stderr(self._RECV_SIZE))
+                    continue
+                if chan.exit_status_ready():
+                    break
+                select.select([chan], [], [], 1)
+            for recv, handle in [(chan.recv, write), (chan.recv_stderr, err.add)]:
+                while True:
+                    data = recv(self._RECV_SIZE)
+                    if len(data) == 0:
+                        break
+                    handle(data)
+            exit_code = chan.recv_exit_status()
+            chan.close()
+        except Exception, e:
+            chan.close()
+            self._release(ssh, privkey, host, user, error=e)
+            raise
+        self._release(ssh, privkey, host, user)
+        return exit_code, counter[0], err.value()
+
+    @_timed_ssh_op("sync_dir")
+    def sync_dir(self, privkey, host, user, src_root, src_manifest, dst_root, dst_manifest,
+                 upload=True, delete=False, limiter=None):
+        """
+        Syncs a directory tree to or from the remote machine, only copying the blocks which differ.
+        See _sync_tree().
         
-    def provision(self, image_id, instance_type='m1.small', count=1, tags=None, boot_timeout=600, boot_max_tries=3):
+        :param upload: if true, the source tree is local and the destination is remote, otherwise
+                       the other way around
+        :return: number of bytes transferred
         """
-        Provision a new instance. Note that this method starts the provisioning cycle, but does not
-        block for the instance to finish booting - for that, see wait()
+        ssh, ftp = self._open_sftp(privkey, host, user)
+        try:
+            if upload:
+                nbytes = _sync_tree(_LocalFS(), src_root, src_manifest, ftp, dst_root, dst_manifest,
+                                    delete=delete, limiter=limiter)
+            else:
+                nbytes = _sync_tree(ftp, src_root, src_manifest, _LocalFS(), dst_root, dst_manifest,
+                                    delete=delete, limiter=limiter)
+        except Exception, e:
+            self._release(ssh, privkey, host, user, error=e)
+            raise
+        finally:
+            ftp.close()
+        self._release(ssh, privkey, host, user)
+        return nbytes
+
+
+class _RemoteAgent:
+    """
+    Client for the agent in resources/agent.py, which runs commands on an instance over a single
+    long lived ssh channel. The agent gets its own ssh connection, so that it is not closed along
+    with idle or broken connections in the pool.
+    """
+
+    # reads the agent code from the channel and runs it - the rest of stdin is then for the agent
+    _loader_cmd = "P=$(command -v python3 || command -v python) && exec $P -u -c " \
+                  "'import sys; f = getattr(sys.stdin, \"buffer\", sys.stdin); exec(f.read(int(f.readline())))'"
+
+    def __init__(self, privkey, host, user, timeout=30):
+        """
+        Starts the agent on the given host
         
-        :param image_id: The image id as specified by the cloud infrastructure
-        :param instance_type: The instance type (m1.small, m1.large, ...)
-        :param count: Number of instances to provision. The default is 1.
-        :param tags: Tags to add to the instance - this is important as tags are used throughout the API 
-                     to find and manipulate instances
-        :param boot_timeout: The amount of allowed time in seconds for an instance to boot
-        :param boot_max_tries: The number of tries an instance is given to successfully boot
-        """                                                                   
-        pass
+        :param timeout: number of seconds to wait for the agent to start
+        """
+        f = open(os.path.join(_RESOURCES_DIR, "agent.py"), "rb")
+        code = f.read()
+        f.close()
+        self._ssh = SSHConnection.new_connection(privkey, host, user)
+        try:
+            self._chan = self._ssh.get_transport().open_session()
+            self._chan.exec_command(self._loader_cmd)
+            self._chan.sendall("%d\n%s" % (len(code), code))
+            self._chan.settimeout(timeout)
+            self._rfile = self._chan.makefile("rb")
+            hello = self._rfile.readline()
+            if len(hello) == 0 or not json.loads(hello).get("ready"):
+                raise ExperimentException("The agent on %s did not start" % host)
+            self._chan.settimeout(None)
+        except Exception:
+            self._ssh.close()
+            raise
+        self._host = host
+        self._lock = threading.Lock()
+        self._next_id = 0
+        self._pending = {}
+        self._alive = True
+        t = threading.Thread(target=self._read)
+        t.daemon = True
+        t.start()
+
+    def _read(self):
+        """
+        Hands the responses from the agent to the requests waiting for them
+        """
+        try:
+            while True:
+                line = self._rfile.readline()
+                if len(line) == 0:
+                    break
+                msg = json.loads(line)
+                with self._lock:
+                    queue = self._pending.get(msg["id"])
+                if queue is not None:
+                    queue.put(msg)
+        except Exception, e:
+            logger.debug("Lost the agent on %s: %s" % (self._host, e))
+        with self._lock:
+            self._alive = False
+            pending = self._pending.values()
+            self._pending = {}
+        for queue in pending:
+            queue.put(None)
+
+    def is_alive(self):
+        return self._alive
+
+    def run(self, cmd, out_callback=None, err_callback=None, max_capture=None):
+        """
+        Runs a command through the agent. Takes the same arguments as SSHConnection.run(), but the
+        command does not get a pty.
+        
+        :return: exit code, stdout and stderr from the command
+        """
+        logger.debug("Running command on host %s through the agent: %s" % (self._host, cmd))
+        out = _OutputTail(max_capture)
+        err = _OutputTail(max_capture)
+        queue = Queue.Queue()
+        with self._lock:
+            if not self._alive:
+                raise ExperimentException("The agent on %s has gone away" % self._host)
+            self._next_id += 1
+            request_id = self._next_id
+            self._pending[request_id] = queue
+            self._chan.sendall(json.dumps({"id": request_id, "cmd": cmd}) + "\n")
+        try:
+            while True:
+                try:
+                    # time out now and then, so that the wait can be interrupted
+                    msg = queue.get(True, 1)
+                except Queue.Empty:
+                    continue
+                if msg is None:
+                    raise ExperimentException("The agent on %s went away while running %s" % (self._host, cmd))
+                if "exit" in msg:
+                    return msg["exit"], out.value(), err.value()
+                data = base64.b64decode(msg["data"])
+                if msg["stream"] == "stdout":
+                    out.add(data)
+                    if out_callback is not None:
+                        out_callback(data)
+                else:
+                    err.add(data)
+                    if err_callback is not None:
+                        err_callback(data)
+        finally:
+            with self._lock:
+                self._pending.pop(request_id, None)
+
+    def close(self):
+        self._alive = False
+        self._ssh.close()
+
+
+class ExperimentException(Exception):
+    """
+    Class for grouping the most common experiment failures 
+    """
+    pass
+
+
+class Instance:
+    """
+    Representation of an instance, and a few common attributes of that instance
+    """
     
-    def wait(self, tags=[]):
+    id = None
+    priv_addr = None
+    pub_addr = None
+    tags = []
+    ec2_instance = None
+    gce_boot_response = None
+    allocated_addr = None
+    azure_boot_thread = None
+    azure_boot_error = None
+    is_fully_instanciated = False
+    not_instanciated_correctly = False
+    next_poll = 0
+    polls = 0
+    bootstrapping = False
+    facts = None
+    
+    def __init__(self, instance_id):
         """
-        Barrier for all currently instances to finish booting and be accessible via external addresses.
+        :param instance_id: a unique identifier for the instance, for example the amazon instance id
+        """
+        self.id = instance_id
+        self.tags = []
+        self._tag_set = set()
+        # set when the instance belongs to an experiment
+        self._tag_index = None
+    
+    def add_tag(self, tag):
+        """
+        Tagging is implemented in our own instance as some infrastructures (OpenStack, ...) have not implemented
+        tagging in their API
+        """
+        self.tags.append(tag)
+        self._tag_set.add(tag)
+        if self._tag_index is not None:
+            self._tag_index.add(tag, self)
+            self._tag_index.changed(self)
+
+    def replace_tag(self, old_tag, new_tag):
+        """
+        Replaces a tag, keeping its position in the tag list
+        """
+        self.tags = [new_tag if t == old_tag else t for t in self.tags]
+        self._tag_set.discard(old_tag)
+        self._tag_set.add(new_tag)
+        if self._tag_index is not None:
+            self._tag_index.remove(old_tag, self)
+            self._tag_index.add(new_tag, self)
+            self._tag_index.changed(self)
         
-        :param tags: set of tags to match against
-        :param timeout: maximum timeout to wait for instances to come up
-        :param maxretrycount: The number of retries in case of failure of provisioning the instances 
+    def has_tags(self, tags):
         """
-        return True
+        Checks if the instance have all the tags queried for
+        """
+        return self._tag_set.issuperset(tags)
+    
+    # attributes which are recorded in the experiment journal, if the instance has them
+    _journal_attrs = ["id", "pub_addr", "priv_addr", "tags", "is_fully_instanciated",
+                      "num_starts", "boot_time", "boot_timeout", "boot_max_tries",
+                      "image_id", "instance_type", "ebs_size", "disk_size", "inst_param",
+                      "gce_boot_response", "allocated_addr", "pool_config", "facts"]
 
-    def list(self, tags=[]):
+    def to_record(self):
         """
-        Provides a list of instances, and instance details, with the matching tags
+        :return: a dictionary describing the instance, which can be stored in the journal
+        """
+        record = {}
+        for attr in self._journal_attrs:
+            if hasattr(self, attr):
+                record[attr] = getattr(self, attr)
+        return record
+
+    @staticmethod
+    def from_record(record):
+        """
+        Recreates an instance from a journal record
+        """
+        instance = Instance(record["id"])
+        for attr in Instance._journal_attrs:
+            if attr in record and attr not in ["id", "tags"]:
+                setattr(instance, attr, record[attr])
+        for t in record.get("tags", []):
+            instance.add_tag(t)
+        return instance
+
+    def info(self):
+        i = {}
+        i["id"] = self.id
+        i["public_address"]  = self.pub_addr
+        i["private_address"] = self.priv_addr
+        i["tags"] = self.tags
+        i["facts"] = self.facts
+        return i
+
+
+class _TagIndex:
+    """
+    Maps tags to the set of instances having them, so that subsets of instances can be found
+    without looking at every instance
+    """
+
+    def __init__(self, on_change=None):
+        """
+        :param on_change: optional function which is called with an instance after its tags have
+                          been changed through the instance
+        """
+        self._index = {}
+        # registration order of the instances, so that subsets can be returned in that order
+        self._order = {}
+        self._next = 0
+        self._on_change = on_change
+
+    def register(self, instance):
+        """
+        Adds an instance and its current tags. Later tag changes are picked up through the instance.
+        """
+        self._order[instance] = self._next
+        self._next += 1
+        for t in instance.tags:
+            self.add(t, instance)
+        instance._tag_index = self
+
+    def unregister(self, instance):
+        """
+        Removes an instance and all of its tags
+        """
+        for t in instance.tags:
+            self.remove(t, instance)
+        del self._order[instance]
+        instance._tag_index = None
+
+    def add(self, tag, instance):
+        self._index.setdefault(tag, set()).add(instance)
+
+    def remove(self, tag, instance):
+        instances = self._index.get(tag)
+        if instances is not None:
+            instances.discard(instance)
+            if len(instances) == 0:
+                del self._index[tag]
+
+    def changed(self, instance):
+        if self._on_change is not None:
+            self._on_change(instance)
+
+    def lookup(self, tags):
+        """
+        Finds the instances having all the given tags
         
-        :param tags: set of tags to match against
-        :return: list of instance descriptions
+        :return: list of instances, in registration order
         """
-        l = []
-        for i in self._instance_subset(tags):
-            l.append(i.info())
-        return l
+        sets = []
+        for t in set(tags):
+            instances = self._index.get(t)
+            if instances is None:
+                return []
+            sets.append(instances)
+        # intersect starting with the smallest set
+        sets.sort(key=len)
+        subset = sets[0].intersection(*sets[1:])
+        return sorted(subset, key=self._order.get)
+
+
+class _WarmPool:
+    """
+    Instances which were parked instead of terminated when an experiment was deprovisioned, so
+    that later experiments can reuse them. The pool is stored in a file shared by all experiments,
+    and entries are keyed by cloud and by instance configuration (image, instance type, ...).
+    """
+
+    def __init__(self, path, ttl, max_size):
+        """
+        :param path: file to store the pool in
+        :param ttl: number of seconds an instance can stay parked
+        :param max_size: maximum number of parked instances per cloud
+        """
+        self._path = path
+        self._ttl = ttl
+        self._max_size = max_size
+
+    def park(self, key, config, record):
+        """
+        Adds an instance to the pool, if there is room for it
         
-    def deprovision(self, tags=[]):
+        :return: True if the instance was parked, and a list of expired entries to terminate
         """
-        Deprovisions (terminates) instances with the matching tags
+        lock = self._lock()
+        try:
+            expired, entries = self._expire(self._load(), key)
+            parked = len([e for e in entries if e["key"] == key]) < self._max_size
+            if parked:
+                entries.append({"key": key, "config": config, "parked_at": time.time(),
+                                "record": record})
+            self._store(entries)
+        finally:
+            lock.close()
+        return parked, expired
+
+    def take(self, key, config, count):
+        """
+        Removes up to count instances with the given configuration from the pool
         
-        :param tags: set of tags to match against
+        :return: list of entries taken, and a list of expired entries to terminate
         """
-        pass
+        lock = self._lock()
+        try:
+            expired, entries = self._expire(self._load(), key)
+            taken = [e for e in entries if e["key"] == key and e["config"] == config][:count]
+            entries = [e for e in entries if e not in taken]
+            self._store(entries)
+        finally:
+            lock.close()
+        return taken, expired
+
+    def _expire(self, entries, key):
+        """
+        Splits out the entries for the given cloud which are too old, or do not fit in the pool.
+        Entries for other clouds are left alone as we can not terminate them from here.
+        """
+        now = time.time()
+        mine = [e for e in entries if e["key"] == key]
+        others = [e for e in entries if e["key"] != key]
+        mine.sort(key=lambda e: e["parked_at"], reverse=True)
+        keep = [e for e in mine if now - e["parked_at"] <= self._ttl][:self._max_size]
+        expired = [e for e in mine if e not in keep]
+        return expired, others + keep
+
+    def _lock(self):
+        f = open(self._path + ".lock", "a")
+        fcntl.flock(f, fcntl.LOCK_EX)
+        return f
+
+    def _load(self):
+        if not os.path.exists(self._path):
+            return []
+        f = open(self._path)
+        try:
+            return json.load(f)
+        except ValueError:
+            logger.warn("Ignoring corrupt warm pool file " + self._path)
+            return []
+        finally:
+            f.close()
+
+    def _store(self, entries):
+        tmp_path = self._path + ".tmp"
+        f = open(tmp_path, "w")
+        json.dump(entries, f, indent=1)
+        f.close()
+        os.rename(tmp_path, self._path)
+
+
+def _flush_journal(ref):
+    """
+    Writes out the journal of an experiment at exit, if it has changed since it was last written,
+    for example by tags added after the last wait()
     
-    def get_public_hostnames(self, tags=[]):
+    :param ref: weak reference to the experiment
+    """
+    experiment = ref()
+    if experiment is not None:
+        experiment._save_journal()
+
+
+class Experiment:
+    """
+    Base class for all types of cloud implementations. This is what defines the experiment API.
+    """
+
+    # bounds, in seconds, on how often wait() checks on an instance
+    _poll_min_interval = 2
+    _poll_max_interval = 30
+
+    # how long an instance usually takes to become ready, until we have seen some boot
+    _expected_boot_time = 60
+
+    # maximum number of instances to bootstrap at the same time
+    _max_bootstrap_threads = 10
+
+    # the cloud label of the metrics
+    _cloud_name = "none"
+    
+    def __init__(self, name = None):
+        """
+        Constructor for a new experiment - this will set up ~/.precip and ssh keys if they
+        do not already exist in a way that you can use precip from multiple machines or 
+        accounts at the same time. 
         """
-        Get the set of public hostnames (or IP addresses) for instances matching 'tags'
         
-        :param tags: set of tags to match against
+        if name is None:
+            self._name = str(int(time.time()))
+        else:
+            self._name = name
+
+        self._instances = []
+        # the index only holds a weak reference to us, as a reference cycle would keep __del__
+        # from ever running
+        def tags_changed(instance, ref=weakref.ref(self)):
+            if ref() is not None:
+                ref()._tags_changed(instance)
+        self._tag_index = _TagIndex(on_change=tags_changed)
+        self._journal_dirty = False
+        atexit.register(_flush_journal, weakref.ref(self))
+        self._warm_pool = None
+        
+        # counters and timings, see stats()
+        self._metrics = _Metrics({"cloud": self._cloud_name})
+        self._phases_seen = set()
+        self._phase_start = {}
+
+        # ssh connections are kept open and reused for the lifetime of the instances
+        self._ssh_pool = SSHConnectionPool(metrics=self._metrics)
+
+        # remote agents, by instance id and user - None if the agent could not be started
+        self._use_agent = False
+        self._agents = {}
+        self._agents_lock = threading.Lock()
+
+        # wait() state - set when an instance changes state in the background
+        self._wait_event = threading.Event()
+        self._boot_durations = []
+
+        # transfer rate seen so far, and which instances have zstd, for picking tar compression
+        self._link_speed = None
+        self._remote_zstd = {}
+
+        # instances are bootstrapped in the background while wait() keeps checking the others
+        self._bootstrap_pool = _WorkerPool(self._max_bootstrap_threads)
+        self._bootstrap_results = Queue.Queue()
+        
+        self._conf_dir = os.path.join(os.environ["HOME"], ".precip")
+        
+        # checking/creating conf directory
+        if not os.path.exists(self._conf_dir):
+            os.makedirs(self._conf_dir)
+        
+        uid = self._get_account_id()
+        
+        # ssh keys setup 
+        self._ssh_pubkey = os.path.join(self._conf_dir, "precip_"+uid+".pub")
+        self._ssh_privkey = os.path.join(self._conf_dir, "precip_"+uid)
+        if not os.path.exists(self._ssh_privkey):
+            logger.info("Creating new ssh key in " + self._conf_dir)
+            logger.info("You don't need to enter a passphrase, just leave it blank and press enter!")
+            cmd = "ssh-keygen -q -t rsa -f " + self._ssh_privkey + " </dev/null"
+            p = subprocess.Popen(cmd, shell=True)
+            stdoutdata, stderrdata = p.communicate()
+            rc = p.returncode
+            if rc != 0:
+                raise ExperimentException("Command '%s' failed with error code %s" % (cmd, rc))
+
+        # the journal records the instances, so that the experiment can be reattached if the
+        # script driving it dies
+        if name is not None and os.path.exists(self._journal_path(name)):
+            logger.warn("There is a journal for an earlier experiment named %s - use reattach() to" \
+                        " pick up its instances, or it will be overwritten" % name)
+
+    def __del__(self):
         """
-        addresses = []
-        for i in self._instance_subset(tags):
-            addresses.append(i.pub_addr)
-        return addresses
+        Deprovision all instances
+        """
+        self.deprovision([])
 
-    def get_private_hostnames(self, tags=[]):
+    def _journal_path(self, name):
+        return os.path.join(self._conf_dir, "experiments", name + ".json")
+
+    def _save_journal(self, force=False):
         """
-        Get the set of private hostnames (or IP addresses) for instances matching 'tags'
+        Writes the experiment journal if the instances have changed since it was last written.
+        The journal is removed when the experiment has no instances left.
+        """
+        if not self._journal_dirty and not force:
+            return
+        path = self._journal_path(self._name)
+        if len(self._instances) == 0:
+            if os.path.exists(path):
+                os.remove(path)
+            self._journal_dirty = False
+            return
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        journal = {"name": self._name,
+                   "cloud": self.__class__.__name__,
+                   "counter": getattr(self, "counter", None),
+                   "instances": [i.to_record() for i in self._instances]}
+        # write to a temporary file first, so that a crash does not leave a partial journal
+        tmp_path = path + ".tmp"
+        f = open(tmp_path, "w")
+        json.dump(journal, f, indent=1)
+        f.close()
+        os.rename(tmp_path, path)
+        self._journal_dirty = False
+
+    def _tags_changed(self, instance):
+        """
+        Marks the journal dirty when the tags of an instance change. The tags are written out with
+        the next wait() or deprovision(), or at exit.
+        """
+        self._journal_dirty = True
+
+    def reattach(self, name):
+        """
+        Picks up the instances of an earlier experiment with the given name, for example after the
+        script driving the experiment has died. The instances are checked against the cloud, and
+        the ones which no longer exist are dropped. Instances which had not finished booting can be
+        waited for with wait().
+        
+        :param name: the name of the earlier experiment
+        :return: the number of instances reattached
+        """
+        path = self._journal_path(name)
+        if not os.path.exists(path):
+            raise ExperimentException("No journal found for experiment %s" % name)
+        try:
+            f = open(path)
+            journal = json.load(f)
+            f.close()
+        except ValueError, e:
+            raise ExperimentException("Unable to read journal " + path, e)
+        if journal["cloud"] != self.__class__.__name__:
+            raise ExperimentException("Experiment %s was run on %s, not %s" \
+                                      % (name, journal["cloud"], self.__class__.__name__))
+
+        self._name = name
+        if journal.get("counter") is not None:
+            self.counter = journal["counter"]
+        instances = [Instance.from_record(r) for r in journal["instances"]]
+        for i in self._reattach_instances(instances):
+            logger.info("Reattached instance %s" % i.id)
+            self._add_instance(i)
+        self._save_journal(force=True)
+        return len(self._instances)
+
+    def _reattach_instances(self, instances):
+        """
+        Checks instances from the journal against the cloud, and restores cloud specific state
         
-        :param tags: set of tags to match against
+        :param instances: the instances from the journal
+        :return: the instances which still exist
         """
-        addresses = []
-        for i in self._instance_subset(tags):
-            addresses.append(i.priv_addr)
-        return addresses
-    
-    def get(self, tags, remote_path, local_path, user="root"):
+        return instances
+
+    def detach(self):
         """
-        Transfers a file from a set of remote machines matching the tags, and stores the file locally.
-        If more than one instance matches the tags, an instance id will be appended to the local_path. 
+        Lets go of the instances without deprovisioning them. They can be picked up again later
+        with reattach().
+        """
+        self._save_journal(force=True)
+        for i in list(self._instances):
+            self._instances.remove(i)
+            self._tag_index.unregister(i)
+        self._ssh_pool.close_all()
+        logger.info("Detached from experiment %s" % self._name)
+
+    def use_warm_pool(self, ttl=3600, max_size=10, scrub_cmd="rm -rf /tmp/remote-exec.*"):
+        """
+        Enables the warm pool. With the pool enabled, deprovisioned instances are scrubbed and
+        parked instead of terminated, and later provision() calls for the same cloud, image and
+        instance type get parked instances handed back instead of starting new ones. The pool is
+        shared with other experiments on this machine.
         
-        :param tags: set of tags to match against
-        :param remote_path: location of the file on the remote instance
-        :param local_path: local location for where to store the file
+        :param ttl: number of seconds an instance can stay parked before it is terminated
+        :param max_size: maximum number of parked instances for this cloud
+        :param scrub_cmd: command run as root on instances before they are parked
+        """
+        if self._warm_pool_key() is None:
+            raise ExperimentException("%s does not support warm pools" % self.__class__.__name__)
+        self._warm_pool = _WarmPool(os.path.join(self._conf_dir, "warm-pool.json"), ttl, max_size)
+        self._warm_pool_scrub_cmd = scrub_cmd
+
+    def _warm_pool_key(self):
+        """
+        :return: a string identifying the cloud and account, or None if warm pools are not supported
+        """
+        return None
+
+    def stats(self):
+        """
+        Returns the metrics collected so far: counters, and histograms of the time spent in each
+        phase of booting the instances, in cloud API calls, in ssh operations and in run(), put(),
+        get() and the other operations. Every metric is labelled with the cloud, and most with the
+        instance or host.
+        
+        :return: dictionary with a list of counters and a list of histograms
+        """
+        return self._metrics.snapshot()
+
+    def export_stats(self, format="json", path=None):
+        """
+        Exports the metrics collected so far
+        
+        :param format: "json", or "prometheus" for the Prometheus text exposition format
+        :param path: optional file to write the metrics to
+        :return: the exported metrics
+        """
+        if format == "json":
+            text = json.dumps(self._metrics.snapshot(), indent=1, sort_keys=True)
+        elif format == "prometheus":
+            text = self._metrics.to_prometheus()
+        else:
+            raise ExperimentException("Unknown stats format: %s" % format)
+        if path is not None:
+            f = open(path, "w")
+            f.write(text)
+            f.close()
+        return text
+
+    def enable_tracing(self, path=None):
+        """
+        Records a timeline of the experiment - provisioning, every check on a booting instance,
+        retries, ssh operations, cloud API calls and deprovisioning, and how long each instance
+        spent in each phase of booting. The timeline is written as a Chrome trace event file,
+        which can be loaded in chrome://tracing or https://ui.perfetto.dev, after every
+        provision(), wait() and deprovision().
+        
+        :param path: the trace file. The default is ~/.precip/experiments/<name>.trace.json
+        :return: the path of the trace file
+        """
+        if path is None:
+            path = os.path.join(self._conf_dir, "experiments", self._name + ".trace.json")
+        self._metrics.tracer = _Tracer(path, self._name)
+        return path
+
+    def disable_tracing(self):
+        """
+        Stops recording the timeline, and writes out what has been recorded so far
+        """
+        tracer = self._metrics.tracer
+        if tracer is not None:
+            self._metrics.tracer = None
+            tracer.write()
+
+    # names of the trace spans ending when an instance reaches a phase
+    _phase_spans = {"running": "pending",
+                    "address": "waiting for address",
+                    "booted": "booting",
+                    "bootstrapped": "bootstrapping",
+                    "ready": "finishing"}
+
+    def _phase(self, instance, phase):
+        """
+        Records the time from the start of an instance until it reached a phase of booting, such
+        as "running" or "bootstrapped". Only the first time a phase is reached is recorded.
+        """
+        key = (instance.id, phase)
+        if key in self._phases_seen or instance.boot_time is None:
+            return
+        self._phases_seen.add(key)
+        now = time.time()
+        self._metrics.observe("instance_phase_seconds", now - instance.boot_time,
+                              phase=phase, instance=instance.id)
+        start = max(self._phase_start.get(instance.id, instance.boot_time), instance.boot_time)
+        self._phase_start[instance.id] = now
+        tracer = self._metrics.tracer
+        if tracer is not None:
+            tracer.complete(self._phase_spans.get(phase, phase), start, now, lane=instance.id,
+                            instance=instance.id, phase=phase)
+
+    def use_agent(self, enabled=True):
+        """
+        Enables the remote agent. With the agent enabled, an agent is started on every instance
+        when it has been bootstrapped, and run() sends commands through the agent instead of
+        setting up a new ssh session for every command. Instances where the agent can not be
+        started, for example because python is missing, fall back to plain ssh.
+        
+        :param enabled: set to False to stop using the agents
+        """
+        self._use_agent = enabled
+        if not enabled:
+            self._close_agents(lambda key: True)
+
+    def _get_agent(self, instance, user):
+        """
+        :return: the agent for the given instance and user, started if needed, or None if the agent
+                 is not enabled or could not be started
+        """
+        if not self._use_agent:
+            return None
+        key = (instance.id, user)
+        with self._agents_lock:
+            agent = self._agents.get(key, False)
+        if agent is None or (agent is not False and agent.is_alive()):
+            return agent
+        try:
+            agent = _RemoteAgent(self._ssh_privkey, instance.pub_addr, user)
+        except Exception, e:
+            logger.info("Unable to start the agent on %s - using plain ssh: %s" % (instance.id, e))
+            agent = None
+        with self._agents_lock:
+            existing = self._agents.get(key)
+            if existing is not None and existing.is_alive():
+                # another thread raced us to it - use that agent instead
+                if agent is not None:
+                    agent.close()
+                return existing
+            self._agents[key] = agent
+        return agent
+
+    def _close_agents(self, match):
+        """
+        Closes the agents which keys (instance id, user) match the given function
+        """
+        with self._agents_lock:
+            keys = [k for k in self._agents.keys() if match(k)]
+            agents = [self._agents.pop(k) for k in keys]
+        for agent in agents:
+            if agent is not None:
+                agent.close()
+
+    def _admin_user(self):
         """
-        ssh = SSHConnection()
-        iset = self._instance_subset(tags)
-        
-        # if the instance set is larger than one, enable the appending of 
-        # instance id to the local path
-        append_instance_id = True
-        if len(iset) == 1:
-            append_instance_id = False
-            
-        for i in self._instance_subset(tags):
-            modified_local_path = local_path
-            if append_instance_id:
-                modified_local_path = local_path + "." + i.id
-            # should we do checks on the target path? Directory check? Existing file check?
-            ssh.get(self._ssh_privkey, i.pub_addr, user, remote_path, modified_local_path)
+        :return: the user to log in as for administrative tasks such as bootstrapping
+        """
+        return "root"
 
-    def put(self, tags, local_path, remote_path, user="root", priv=False):
+    def _admin_cmd(self, cmd):
         """
-        Transfers a local file to a set of instances matching the given tags
-        
-        :param tags: set of tags to match against
-        :param local_path: local location for the source file
-        :param remote_path: location of where to copy the file to
-        :param user: user to transfer as, default is 'root'
+        Wraps a command so that it runs as root, when logging in as a non-root user
         """
-        ssh = SSHConnection()
-        for i in self._instance_subset(tags):
-            logger.info("Copying %s to %s on %s" % (local_path, remote_path, i.id))
-            addr = i.pub_addr if priv is False else i.priv_addr
-            ssh.put(self._ssh_privkey, addr, user, local_path, remote_path)
-    
-    def run(self, tags, cmd, user="root", check_exit_code=True, output_base_name=None, priv=False):
+        if self._admin_user() == "root":
+            return cmd
+        return "sudo sh -c '%s'" % cmd.replace("'", "'\\''")
+
+    def _park_instances(self, instances):
         """
-        Runs a command on set of instances matching the tags given.
+        Scrubs and parks instances in the warm pool, if it is enabled and has room
         
-        :param tags: set of tags to match against
-        :param cmd: command to run
-        :param user: the user to run the command as
-        :param check_exit_code: if true, non-zero exit codes will be considered fatal
-        :param output_base_name: redirects output to a file instead of stdout
+        :param instances: instances which are being deprovisioned
+        :return: the instances which were parked - the others should be terminated
         """
-        exit_code_list = []
-        out_list = []
-        err_list = []
-        ssh = SSHConnection()
-        for i in self._instance_subset(tags):
-            if not i.is_fully_instanciated:
-                raise ExperimentException("Can't ssh a not fully instanciated instance "+ i.id)
-            logger.info("Scheduling command execution on %s: %s" % (i.id, cmd))
-            exit_code = -1
-            out = ""
-            err = ""
+        if self._warm_pool is None:
+            return []
+        key = self._warm_pool_key()
+        ssh = SSHConnection(self._ssh_pool)
+        parked = []
+        for i in instances:
+            if not i.is_fully_instanciated or getattr(i, "pool_config", None) is None:
+                continue
             try:
-                addr = i.pub_addr if priv is False else i.priv_addr
-                exit_code, out, err = ssh.run(self._ssh_privkey, addr, user, cmd)
+                exit_code, out, err = ssh.run(self._ssh_privkey, i.pub_addr, self._admin_user(),
+                                              self._admin_cmd(self._warm_pool_scrub_cmd))
             except Exception, e:
-                raise ExperimentException("Error running ssh command", e)
+                logger.debug("Unable to scrub instance %s: %s" % (i.id, e))
+                continue
+            if exit_code != 0:
+                logger.debug("Unable to scrub instance %s: %s %s" % (i.id, out, err))
+                continue
+            record = i.to_record()
+            del record["tags"]
+            is_parked, expired = self._warm_pool.park(key, i.pool_config, record)
+            self._terminate_parked([e["record"] for e in expired])
+            if not is_parked:
+                break
+            logger.info("Parked instance %s in the warm pool" % i.id)
+            self._tag_parked(i)
+            parked.append(i)
+        return parked
+
+    def _take_from_warm_pool(self, config, count):
+        """
+        Takes parked instances with the given configuration from the warm pool. The instances are
+        checked against the cloud and over ssh before they are handed out.
+        
+        :param config: the instance configuration, as recorded in instance.pool_config
+        :param count: the maximum number of instances to take
+        :return: list of instances, which still have to be tagged and completed by the caller
+        """
+        if self._warm_pool is None or count == 0:
+            return []
+        entries, expired = self._warm_pool.take(self._warm_pool_key(), config, count)
+        self._terminate_parked([e["record"] for e in expired])
+        if len(entries) == 0:
+            return []
+        instances = [Instance.from_record(e["record"]) for e in entries]
+        alive = self._reattach_instances(instances)
+        ssh = SSHConnection(self._ssh_pool)
+        taken = []
+        for i in alive:
+            try:
+                exit_code, out, err = ssh.run(self._ssh_privkey, i.pub_addr, self._admin_user(), "true")
+            except Exception, e:
+                exit_code = -1
+            if exit_code != 0:
+                logger.info("Parked instance %s is not reachable - terminating it" % i.id)
+                self._terminate_parked([i.to_record()])
+                continue
+            logger.info("Reusing instance %s from the warm pool" % i.id)
+            i.pool_config = config
+            taken.append(i)
+        return taken
 
-            if len(out) > 0:
-                if output_base_name is not None:
-                    fname = "%s.%s.stdout" %(output_base_name, i.id)
-                    try:
-                        f = open(fname, 'w')
-                        f.write(out)
-                        f.close()
-                    except Exception, e:
-                        raise ExperimentException("Unable to write to " + fname, e)
-                else:
-                    logger.info("  stdout: %s" % out)
+    def _tag_parked(self, instance):
+        """
+        Marks a parked instance in the cloud, on clouds supporting that
+        """
+        pass
 
-            if len(err) > 0:
-                if output_base_name is not None:
-                    fname = "%s.%s.stderr" %(output_base_name, i.id)
-                    try:
-                        f = open(fname, 'w')
-                        f.write(err)
-                        f.close()
-                    except Exception, e:
-                        raise ExperimentException("Unable to write to " + fname, e)
-                else:
-                    logger.info("  stderr: %s" % err)
-            
-            exit_code_list.append(exit_code)
-            out_list.append(out)
-            err_list.append(err)
-                
-            if check_exit_code and exit_code != 0:
-                print out_list, err_list
-                raise ExperimentException("Command exited with exit code %d" % exit_code)
-        
-        return exit_code_list, out_list, err_list
-                
-    def copy_and_run(self, tags, local_script, args=[], user="root", check_exit_code=True):
+    def _terminate_parked(self, records):
         """
-        Runs a local script on the remote instances matching the tags
+        Terminates instances which were parked in the warm pool
         
-        :param tags: set of tags to match against
-        :param local_script: local script to copy and run
-        :param args: list of arguments to pass to the script
-        :param user: user to run the script as
+        :param records: the warm pool records of the instances
         """
-        fname = "/tmp/remote-exec.%d" % (random.randint(1, 10000000000)) 
-        self.put(tags, local_script, fname, user=user)
-        cmd = "cd /tmp && chmod 755 %s && %s" % (fname, fname)
-        for a in args:
-            cmd = cmd + " '" + a + "'"
-        cmd = cmd + " && rm -f " + fname
-        exit_codes, outs, errs = self.run(tags, cmd, user=user, check_exit_code=check_exit_code)
-        return exit_codes, outs, errs
+        pass
 
+    def _add_instance(self, instance):
+        """
+        Adds a newly provisioned instance to the experiment
+        """
+        self._metrics.inc("instances_added")
+        self._instances.append(instance)
+        self._tag_index.register(instance)
+        self._journal_dirty = True
 
-class AzureExperiment(Experiment):
-    def __init__(self, azure_config, skip_setup = False, name = None):
-        Experiment.__init__(self, name = name)
-        
-        self.config = azure_config
-        self.skip_setup = skip_setup
-        
-        self._conn = None
-        self._get_connection()
-        
-        self.counter = 0
-        
-    def _get_connection(self):
+    def _forget_instance(self, instance):
         """
-        Establishes a connection to the cloud endpoint
+        Removes a deprovisioned instance from the experiment, and closes any ssh connections to it
         """
-        if (self._conn != None):
-            return
-        
-        self._conn = AzureResourceManager(
-            self.config,
-            self.skip_setup
-        )
-        
-    def _start_instance(self, name, tags, has_public_ip):
-        self._conn.create_vm(
-            name,
-            self._ssh_pubkey,
-            tags=tags,
-            has_public_ip=has_public_ip
-        )
+        self._instances.remove(instance)
+        self._tag_index.unregister(instance)
+        self._journal_dirty = True
+        self._close_agents(lambda key: key[0] == instance.id)
+        self._metrics.inc("instances_removed")
+        self._phase_start.pop(instance.id, None)
+        for addr in [instance.pub_addr, instance.priv_addr]:
+            if addr is not None:
+                self._ssh_pool.close_host(addr)
+        if len(self._instances) == 0:
+            self._ssh_pool.close_all()
+
+    def _instance_subset(self, tags):
+        """
+        Returns the subset of instances matching the tags
+        """
+        if len(tags) == 0:
+            return list(self._instances)
+        return self._tag_index.lookup(tags)
     
-    def _finish_instanciation(self, instance):
+    def _is_valid_hostaddr(self, addr):
         """
-        Finishes booting and bootstraps an instace
-        
-        :param instance: the instance to check
-        :return: True if the instance is ready, otherwise False
+        Checks if a host address is "external". Note that addr can be either an ip address
+        or a fqdn.
         """
         
-        # check if we are already done
-        if instance.is_fully_instanciated:
-            return True
-        
-        if instance.not_instanciated_correctly:
-            instance.boot_timeout = 0
-            return False
-        
-        try:
-            instance.azure_boot_thread.join()
-        except Exception as e:
-            logger.debug("Instance %s state is 'error - scheduling for possible retry" %instance.id)
-            logger.debug("%s" % str(e))
-            instance.not_instanciated_correctly = True
-            return False
-        
-        # DONE
-        
-        # get public and private addresses
-        instance.pub_addr = self._conn.get_pub_addr(instance.id)
-        instance.priv_addr = self._conn.get_priv_addr(instance.id) 
-        
-        if instance.pub_addr != '':    
-            # bootstrap the image
-            exit_code = -1
-            out = ""
-            err = ""
+        re_ip = re.compile(r'^\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}$')
+        r = re_ip.search(self._endpoint)
+        if not r:
+            # assume addr is a fqdn
             try:
-                logger.debug("Will try to ssh to " + instance.id + " (" + instance.pub_addr + ")")
-                ssh = SSHConnection()
-                script_path = os.path.dirname(os.path.abspath(__file__)) + "/resources/vm-bootstrap.sh"
-                ssh.put(self._ssh_privkey, instance.pub_addr, self.config.admin_username, script_path, "/tmp/vm-bootstrap.sh")
-                exit_code, out, err = ssh.run(self._ssh_privkey, instance.pub_addr, self.config.admin_username, "sudo chmod 755 /tmp/vm-bootstrap.sh && sudo /tmp/vm-bootstrap.sh")
-            except paramiko.SSHException, e:
-                logger.debug("Failed to run bootstrap script on instance %s. Will retry later." % instance.id)
-                logger.debug(str(e))
-                return False
-            except paramiko.SFTPError:
-                logger.debug("Unable to ssh connect to instance %s. Will retry later." % instance.id)
-                return False
-            except socket.error:
-                logger.debug("Unable to ssh connect to instance %s. Will retry later." % instance.id)
+                addr = socket.gethostbyname(addr)
+            except socket.gaierror:
+                # unable to dns look up addr
                 return False
-            
-            
-            if len(out) > 0:
-                logger.debug("  stdout: %s" % out)
-            if len(err) > 0:
-                logger.debug("  stderr: %s" % err)
-            if exit_code != 0:
-                raise ExperimentException("Bootstrap script exited with error %d" % exit_code)
+
+        # at this point addr should be in ip format
         
+        # private up addresses are not valid (there is probably a better way to check this)
+        if addr[:3] == "10." or addr[:4] == "192." or addr[:4] == "172.":
+            return False 
         
-        logger.info("Instance %s has booted, priv address: %s, public address: %s" % (instance.id, instance.priv_addr, instance.pub_addr))
-
-        instance.add_tag(instance.pub_addr)
-        instance.is_fully_instanciated = True
+        # make sure addr is a valid ip address
+        try:
+            socket.inet_aton(addr)
+            # valid
+        except socket.error:
+            return False
         return True
-
-    def _retry(self, instance):
+    
+    def _get_account_id(self):
         
         """
-        In case of reaching timeout for an instance, retry will terminate the previous instance and 
-        replace it with a new instance.
-        
-        :param instance: the instance to terminate and replace with a new one
-        :param image_id: The image id as specified by the cloud infrastructure
-        :param instance_type: The instance type (m1.small, m1.large, ...)
-        :param tags: Tags to add to the new instance - this is important as tags are used throughout the API 
-                     to find and manipulate instances
+        Checks if account_id with uid stored in it exists.
+        Returns the uid for this machine.
         """
         
-        logger.info("Instance %s has reached timeout, and will be replaced with a new instance" % instance.id)
-        try:
-            self._conn.delete_vm(instance.id)
-        except Exception as e:
-            logger.info('Could not delete instance: %s' % instance.id)
-            logger.debug("%s" % str(e))
+        self._account_id = os.path.join(self._conf_dir, "account_id")
+        
+        if not os.path.exists(self._account_id):
+            f = open(self._account_id,'w')
+            uid = str(uuid.uuid4().get_hex())
+            f.write(uid)
+            f.close()
             
-        instance.azure_boot_thread = threading.Thread(
-            target=self._start_instance,
-            args=(
-                instance.id,
-                instance.inst_param['tags'],
-                instance.inst_param['has_public_ip'],
-            ),
-        )
-        
-        instance.num_starts = instance.num_starts + 1
-        instance.boot_time = int(time.time())
-        instance.not_instanciated_correctly = False
-        
-        instance.azure_boot_thread.start()
-    
-    def provision(self, tags=None, has_public_ip=True, count=1, boot_timeout=400):
+        else:
+            f = open(self._account_id, 'r')
+            uid = f.read().rstrip('\n')
+            f.close()
+        return uid   
+        
+    def provision(self, image_id, instance_type='m1.small', count=1, tags=None, boot_timeout=600, boot_max_tries=3):
         """
         Provision a new instance. Note that this method starts the provisioning cycle, but does not
         block for the instance to finish booting - for that, see wait()
@@ -635,467 +2408,302 @@ class AzureExperiment(Experiment):
                      to find and manipulate instances
         :param boot_timeout: The amount of allowed time in seconds for an instance to boot
         :param boot_max_tries: The number of tries an instance is given to successfully boot
-        """   
-      
-        name = self._name.replace('_', '')
-        if re.search('^(?:[a-z](?:[-a-z0-9]{0,61}[a-z0-9])?)$', name) is None:
-            name = str(uuid.uuid4().get_hex())
+        """                                                                   
+        pass
     
-        for _i in range(count):
-            inst_id = name + '-' + str(self.counter)
-            self.counter += 1
-            
-            inst_tags = list(tags)
-            inst_tags.append("precip")
-            inst_tags.append(inst_id)
-            
-            instance = Instance(inst_id)
-            self._instances.append(instance)
-            for t in inst_tags:
-                instance.add_tag(t)
-            
-            instance.azure_boot_thread = threading.Thread(
-                target=self._start_instance,
-                args=(
-                    inst_id,
-                    inst_tags,
-                    has_public_ip,
-                ),
-            )
-                
-            # keep track of parameters - we might need them for restarts later
-            instance.num_starts = 1
-            instance.boot_time = int(time.time())
-            instance.boot_timeout = boot_timeout
-            instance.boot_max_tries = 3
-            instance.inst_param = {
-                'tags' : inst_tags,
-                'has_public_ip' : has_public_ip
-            }
-        
-            instance.azure_boot_thread.start()
-
-
+    @_traced("wait", write=True)
     def wait(self, tags=[]):
         """
         Barrier for all currently instances to finish booting and be accessible via external addresses.
         
+        Each instance is checked on its own schedule: often right after it has been started and
+        around the time it is expected to be ready, and less often while it is clearly still
+        booting. Instances which time out are restarted up to boot_max_tries times.
+        
         :param tags: set of tags to match against
-        :param timeout: maximum timeout to wait for instances to come up
-        :param maxretrycount: The number of retries in case of failure of provisioning the instances 
-        """
-        
-        count_pending = -1
-        while count_pending != 0:
-            count_pending = 0
-            current_time = int(time.time())
-
-            for i in self._instance_subset(tags):
-                if not self._finish_instanciation(i):
-                    count_pending += 1
-
-                    # did the instance timeout?
-                    if current_time > i.boot_time + i.boot_timeout:
-                        logger.info("Timeout reached while waiting for instances to boot")
-                        logger.info("A common cause for this that your image does not allow the" + \
-                                    " root user to login.")
-                        logger.info("Another common cause is infrastructure problems, preventing" + \
-                                    " the instance from booting correctly.")
-                        if i.num_starts < i.boot_max_tries:
-                            self._retry(i)
-                        else:
-                            raise ExperimentException("Timeout reached while waiting for instances to boot")
-
-            if count_pending > 0:
-                logger.info("Still waiting for %d instances to finish booting" % (count_pending))
-                time.sleep(20)       
-
-
-    def _deprovision(self, instance):
-        attempts=3
-        instance.is_fully_instanciated = False
-        done = False
-        while (done == False):
+        """
+        last_report = 0
+        while True:
+            now = time.time()
+            pending = [i for i in self._instance_subset(tags) if not i.is_fully_instanciated]
+            if len(pending) == 0:
+                self._save_journal()
+                break
+
+            self._wait_event.clear()
+
+            # collect the outcome of the bootstraps which have finished
+            while True:
+                try:
+                    i, bootstrapped, exc_info = self._bootstrap_results.get_nowait()
+                except Queue.Empty:
+                    break
+                i.bootstrapping = False
+                if i not in self._instances:
+                    # deprovisioned while it was being bootstrapped
+                    continue
+                if exc_info is not None:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                if bootstrapped:
+                    self._complete_instanciation(i)
+                    self._boot_durations.append(time.time() - i.boot_time)
+                    self._journal_dirty = True
+                    if i in pending:
+                        pending.remove(i)
+                elif i in pending:
+                    # not reachable over ssh yet - back off, and give up on it like on an
+                    # instance which does not come up
+                    self._check_boot_timeout(i, now)
+                    i.next_poll = now + self._poll_interval(i, now)
+            if len(pending) == 0:
+                self._save_journal()
+                break
+
+            due = [i for i in pending if i.next_poll <= now and not i.bootstrapping]
             try:
-                logger.info("Deprovisioning instance: %s" % instance.id)
-                self._conn.delete_vm(instance.id)
-                done = True
-            except Exception as e:
-                logger.info('Could not deprovision instance: %s' % instance.id)
-                logger.debug("%s" % str(e))
-                
-                if (attempts > 0):
-                    logger.info('Retrying in some secs..')
-                    time.sleep(20)
-                    attempts = attempts-1
-                else:
-                    logger.info('Not retrying anymore')
-                    done = True
-                    
+                self._refresh_instances(due)
+            except Exception, e:
+                if not _is_throttled(e):
+                    raise
+                # the cloud wants us to slow down - check on these instances later
+                logger.debug("Refreshing instances was throttled: %s" % e)
+                for i in due:
+                    i.next_poll = now + self._poll_interval(i, now)
+                due = []
+            for i in due:
+                i.polls += 1
+                try:
+                    if self._finish_instanciation(i):
+                        # reachable - bootstrap in the background, and check back when that is done
+                        self._phase(i, "booted")
+                        i.bootstrapping = True
+                        self._bootstrap_pool.submit(self._run_bootstrap, i)
+                        continue
+                    self._check_boot_timeout(i, now)
+                except Exception, e:
+                    if not _is_throttled(e):
+                        raise
+                    logger.debug("Checking instance %s was throttled: %s" % (i.id, e))
+                i.next_poll = now + self._poll_interval(i, now)
+
+            self._save_journal()
+
+            if now - last_report >= self._poll_max_interval:
+                logger.info("Still waiting for %d instances to finish booting" % (len(pending)))
+                last_report = now
+
+            # sleep until the next instance is due, or until we are notified of a change such
+            # as a finished bootstrap
+            next_polls = [i.next_poll for i in pending if not i.bootstrapping]
+            if len(next_polls) > 0:
+                delay = min(next_polls) - time.time()
+            else:
+                delay = self._poll_max_interval
+            if delay > 0:
+                self._wait_event.wait(delay)
 
-    def deprovision(self, tags=[]):
+    def _check_boot_timeout(self, instance, now):
         """
-        Deprovisions (terminates) instances with the matching tags
-        
-        :param tags: set of tags to match against
+        Restarts an instance which has not become ready within its boot timeout, or which the
+        cloud failed to start, or gives up if it has been started boot_max_tries times already
         """
-        threads = {}
-        subset = self._instance_subset(tags)
-        for i in subset:
-            threads[i] = threading.Thread(target=self._deprovision, args=(i,),)
-            threads[i].start()
-        
-        logger.info("Waiting for deprovisioning to complete")
-        for i in subset:
-            threads[i].join()
-            self._instances.remove(i)
-            
-
-        logger.info("Deprovisioning done")                 
-
+        if now <= instance.boot_time + instance.boot_timeout and \
+           not instance.not_instanciated_correctly:
+            return
+        logger.info("Timeout reached while waiting for instances to boot")
+        logger.info("A common cause for this that your image does not allow the" + \
+                    " root user to login.")
+        logger.info("Another common cause is infrastructure problems, preventing" + \
+                    " the instance from booting correctly.")
+        self._metrics.inc("instance_timeouts")
+        if instance.num_starts < instance.boot_max_tries:
+            self._metrics.inc("instance_retries")
+            self._retry(instance)
+            instance.polls = 0
+            self._journal_dirty = True
+        else:
+            raise ExperimentException("Timeout reached while waiting for instances to boot")
 
-class GCloudExperiment(Experiment):
-    
-    def __init__(self, project, zone, user, name = None):
+    def _poll_interval(self, instance, now):
         """
-        Initializes an GCloud experiment
+        Determines how long to wait before checking on an instance again
         
-        :param zone: Google Cloud zone, for example us-central1-f
-        :param project: Google Cloud project ID, for example causal-setting-00000
-
+        :param instance: the instance which was just checked
+        :param now: the time of the check
+        :return: number of seconds until the next check
         """
-        Experiment.__init__(self, name = name)
-        
-        self._zone = zone
-        self._project = project
-        self._user = user
-        
-        self._conn = None
-    
-        self._get_connection()
-        self._ssh_keys_setup()
-        
-        self.counter = 0
+        elapsed = now - instance.boot_time
+        remaining = self._expected_ready_time() - elapsed
+        if instance.polls <= 3:
+            # check often at first, as errors show up fast and some instances boot quickly
+            interval = self._poll_min_interval
+        elif remaining > self._poll_min_interval:
+            # clearly still booting - back off, but be back around the expected ready time
+            interval = remaining / 2.0
+        else:
+            # at, or past, the expected ready time - check often, and then back off more and more
+            overdue = max(0, -remaining)
+            interval = self._poll_min_interval + overdue / 4.0
+        interval = max(self._poll_min_interval, min(self._poll_max_interval, interval))
 
-    def _get_connection(self):
-        """
-        Establishes a connection to the cloud endpoint
+        # make sure we notice timeouts on time
+        deadline = instance.boot_time + instance.boot_timeout
+        if deadline > now:
+            interval = min(interval, deadline - now + 1)
+        return interval
+
+    def _expected_ready_time(self):
         """
-        if (self._conn != None):
-            return
-        
-        credentials = GoogleCredentials.get_application_default()
-        self._conn = build('compute', 'v1', credentials=credentials)
-        
-    def _ssh_keys_setup(self):
+        Estimates how long an instance takes to become ready, based on the instances of this
+        experiment which have already finished booting
         
+        :return: the expected time in seconds
+        """
+        if len(self._boot_durations) == 0:
+            return self._expected_boot_time
+        durations = sorted(self._boot_durations)
+        return durations[len(durations) / 2]
+
+    def _run_bootstrap(self, instance):
         """
-        Makes sure we have our experiment keypair registered
+        Bootstraps an instance - this is run by the bootstrap worker threads. The outcome is
+        handed back to wait(), which is notified.
         """
-        uid = self._get_account_id()
-        logger.info("Registering ssh pubkey of "+uid)
-        
-        with open(self._ssh_pubkey) as sshfile:
-            contents = sshfile.read()
-        
-        # Get metadata from the cloud
-        request = self._conn.projects().get(project=self._project)
-        response = request.execute()
-        
-        # Check keyresponse['name']
-        need_to_register = False
-        body = response['commonInstanceMetadata']
-        
-        if 'items' in body:
-            sshkey_found = False
-            for item in body['items']:
-                if item['key'] == 'sshKeys':
-                    sshkey_found = True
-                    if contents not in item['value']:
-                        need_to_register = True
-                        item['value'] = str(item['value']) + '\n' + self._user + ':' + contents
-            if not sshkey_found: 
-                body['items'].append({'value' : self._user + ':' + contents,
-                                      'key' : 'sshKeys' })
-        else:
-            need_to_register = True
-            body['items'] = [{'value' : self._user + ':' + contents,
-                              'key' : 'sshKeys' }]
-        
-        # Register key
-        # key is stored at:
-        # https://console.developers.google.com/project/<your-project>/compute/metadata/sshKeys
-        if need_to_register == True:
-            response = self._conn.projects().setCommonInstanceMetadata(project=self._project,
-                                                                       body=body).execute()
-            if 'error' in response:
-                    raise ExperimentException(response['error'])
+        bootstrapped = False
+        exc_info = None
+        try:
+            with self._metrics.timer("bootstrap_seconds", instance=instance.id):
+                bootstrapped = self._bootstrap(instance)
+        except Exception:
+            exc_info = sys.exc_info()
+        if bootstrapped:
+            self._phase(instance, "bootstrapped")
         else:
-            logger.info("pubkey is already registered")
-            
-    def _wait_for_operation(self, operation, timeout=300):
-        logger.debug('Waiting for %s to finish..' % operation)
-        
-        init_time = int(time.time())
-
-        while True:
-            response = self._conn.zoneOperations().get(
-                project=self._project,
-                zone=self._zone,
-                operation=operation).execute()
-    
-            if response['status'] == 'DONE':
-                logger.debug("%s done" % operation)
-                if 'error' in response:
-                    raise ExperimentException(response['error'])
-                return response
-            else:
-                if int(time.time()) > init_time + timeout:
-                    raise ExperimentException('Timeout for operation: ' + operation)
-                time.sleep(5)
-
-    def _start_instance(self, name, machine_type, source_disk_image, disk_size, tags):
-            
-        config = {
-            'name': name,
-            'machineType': machine_type,
-    
-            # Specify the boot disk and the image to use as a source.
-            'disks': [{
-                    'boot': True,
-                    'autoDelete': True,
-                    'initializeParams': {
-                        'sourceImage': source_disk_image,
-                        'diskSizeGb': disk_size
-                    }
-                }
-            ],
-    
-            # Specify a network interface with NAT to access the public
-            # internet.
-            'networkInterfaces': [{
-                    'network': 'global/networks/default',
-                    'accessConfigs': [{'type': 'ONE_TO_ONE_NAT',
-                                       'name': 'External NAT'}]
-                }
-            ],
-            
-            # Tags
-            'tags': {'items': list(set(tags))}
-        }
-        response = self._conn.instances().insert(project=self._project,
-                                                     zone=self._zone,
-                                                     body=config).execute()
-        logger.info("Started instance %s, type %s" % (name, machine_type))    
-        return response
+            self._metrics.inc("bootstrap_retries", instance=instance.id)
+        if bootstrapped:
+            # start the agent while we are at it, so that the first run() does not have to wait
+            self._get_agent(instance, self._admin_user())
+        self._bootstrap_results.put((instance, bootstrapped, exc_info))
+        # wait() decides when to check on the instance again
+        self._wait_event.set()
+
+    # Bootstraps an instance in a single ssh session. The script is sent along with the command,
+    # and only run if the marker on the instance does not hold its hash already. The facts about
+    # the instance are printed on the last line, with the fqdn last as it could contain spaces.
+    _bootstrap_cmd = r"""set -e
+marker=/var/lib/precip/bootstrap.sha1
+ran=false
+if [ "$(cat $marker 2>/dev/null)" != "%(hash)s" ]; then
+    script=$(mktemp /tmp/vm-bootstrap.XXXXXX)
+    echo '%(script)s' | base64 -d >$script
+    chmod 755 $script
+    $script 1>&2
+    rm -f $script
+    mkdir -p /var/lib/precip
+    echo "%(hash)s" >$marker
+    ran=true
+fi
+fqdn=$(hostname -f 2>/dev/null || hostname)
+cpus=$(getconf _NPROCESSORS_ONLN 2>/dev/null || true)
+mem=$(sed -n "s/^MemTotal: *\([0-9]*\) kB/\1/p" /proc/meminfo 2>/dev/null || true)
+printf 'precip-facts %%s %%s %%s %%s\n' "$ran" "${cpus:-0}" "${mem:-0}" "$fqdn"
+"""
 
-    def _finish_instanciation(self, instance):
+    def _bootstrap(self, instance):
         """
-        Finishes booting and bootstraps an instace
+        Bootstraps an instance which has finished booting. Called from a worker thread. Instances
+        which have been bootstrapped with the same script before, for example instances from the
+        warm pool, are left alone. Facts about the instance (fqdn, cpus and memory) are stored in
+        instance.facts.
         
-        :param instance: the instance to check
-        :return: True if the instance is ready, otherwise False
+        :param instance: the instance to bootstrap
+        :return: True if the instance is bootstrapped, False if it should be tried again later
         """
-        
-        # check if we are already done
-        if instance.is_fully_instanciated:
-            return True
-        
-        if instance.not_instanciated_correctly:
-            instance.boot_timeout = 0
-            return False
-        
-        operation = instance.gce_boot_response['name']
-        response = self._conn.zoneOperations().get(project=self._project, 
-                                                   zone=self._zone,
-                                                   operation=operation).execute()
-
-        if 'error' in response:
-            logger.debug("Instance %s state is 'error - scheduling for possible retry" %instance.id)
-            logger.debug("%s" % operation)
-            for error in response['error']['errors']:
-                logger.debug("%s : %s" % (error['code'], error['message']))
-            instance.boot_timeout = 0
-            return False
-        
-        if response['status'] in ['PENDING', 'RUNNING']: # RUNNING here means the boot script is still running, not the instance
-            logger.debug("Instance %s is still pending" % instance.id)
-            return False
-        
-        if response['status'] != 'DONE':
-            logger.debug("Unexpected instance state for instance %s: %s" % (instance.id, response['status']))
-            return False             
-        
-        # DONE
-        
-        # get instance data
-        response = self._conn.instances().get(project=self._project,
-                                              zone=self._zone,
-                                              instance=instance.id).execute()
-                
-        # get public address
-        instance.pub_addr = str(response['networkInterfaces'][0]['accessConfigs'][0]['natIP'])
-            
-        # bootstrap the image
-        exit_code = -1
-        out = ""
-        err = ""
+        f = open(os.path.join(_RESOURCES_DIR, "vm-bootstrap.sh"), "rb")
+        script = f.read()
+        f.close()
+        cmd = self._bootstrap_cmd % {"hash": hashlib.sha1(script).hexdigest(),
+                                     "script": base64.b64encode(script)}
         try:
             logger.debug("Will try to ssh to " + instance.id + " (" + instance.pub_addr + ")")
-            ssh = SSHConnection()
-            script_path = os.path.dirname(os.path.abspath(__file__)) + "/resources/vm-bootstrap.sh"
-            ssh.put(self._ssh_privkey, instance.pub_addr, self._user, script_path, "/tmp/vm-bootstrap.sh")
-            exit_code, out, err = ssh.run(self._ssh_privkey, instance.pub_addr, self._user, "sudo chmod 755 /tmp/vm-bootstrap.sh && sudo /tmp/vm-bootstrap.sh")
-            h_exit_code, fqdn, h_err = ssh.run(self._ssh_privkey, instance.pub_addr, self._user, "hostname -f")
-            fqdn = fqdn.rstrip('\n').rstrip('\r')
+            ssh = SSHConnection(self._ssh_pool)
+            # sudo needs a pty on images with requiretty set
+            exit_code, out, err = ssh.run(self._ssh_privkey, instance.pub_addr, self._admin_user(),
+                                          self._admin_cmd(cmd), pty=self._admin_user() != "root")
         except paramiko.SSHException, e:
             logger.debug("Failed to run bootstrap script on instance %s. Will retry later." % instance.id)
             logger.debug(str(e))
             return False
-        except paramiko.SFTPError:
-            logger.debug("Unable to ssh connect to instance %s. Will retry later." % instance.id)
-            return False
         except socket.error:
             logger.debug("Unable to ssh connect to instance %s. Will retry later." % instance.id)
             return False
-        
-        
-        if len(out) > 0:
-            logger.debug("  stdout: %s" % out)
+
         if len(err) > 0:
             logger.debug("  stderr: %s" % err)
-        if len(fqdn) > 0:
-            logger.debug("  hostname stdout: %s" % fqdn)
-        if len(h_err) > 0:
-            logger.debug("  hostname stderr: %s" % h_err)
         if exit_code != 0:
             raise ExperimentException("Bootstrap script exited with error %d" % exit_code)
-        if h_exit_code != 0:
-            raise ExperimentException("Bootstrap script exited with error %d" % h_exit_code)
-        
-        # fill remaining fields
-        instance.priv_addr = fqdn
+        instance.facts = self._parse_facts(out)
+        if instance.facts is None:
+            raise ExperimentException("Unable to parse the facts from instance %s: %s" % (instance.id, out))
+        if not instance.facts["bootstrapped"]:
+            logger.debug("Instance %s has already been bootstrapped with this script" % instance.id)
+        return True
+
+    def _parse_facts(self, out):
+        """
+        Picks the facts line printed by the bootstrap command out of its output. With a pty, the
+        output of the bootstrap script ends up in there as well.
         
-        logger.info("Instance %s has booted, public address: %s" % (instance.id, instance.pub_addr))
+        :return: dictionary of facts, or None if there is no facts line
+        """
+        for line in reversed(out.splitlines()):
+            fields = line.strip().split(" ", 4)
+            if len(fields) < 4 or fields[0] != "precip-facts":
+                continue
+            try:
+                return {"fqdn": fields[4] if len(fields) > 4 else "",
+                        "cpus": int(fields[2]),
+                        "memory_kb": int(fields[3]),
+                        "bootstrapped": fields[1] == "true"}
+            except ValueError:
+                return None
+        return None
 
+    def _complete_instanciation(self, instance):
+        """
+        Marks a bootstrapped instance as ready
+        """
         instance.add_tag(instance.pub_addr)
         instance.is_fully_instanciated = True
-        return True
+        self._phase(instance, "ready")
 
-    def _retry(self, instance):
-        
+    def _notify_instance(self, instance):
         """
-        In case of reaching timeout for an instance, retry will terminate the previous instance and 
-        replace it with a new instance.
-        
-        :param instance: the instance to terminate and replace with a new one
-        :param image_id: The image id as specified by the cloud infrastructure
-        :param instance_type: The instance type (m1.small, m1.large, ...)
-        :param tags: Tags to add to the new instance - this is important as tags are used throughout the API 
-                     to find and manipulate instances
+        Lets wait() know that the state of an instance has changed, so that it is checked right away
         """
-        
-        logger.info("Instance %s has reached timeout, and will be replaced with a new instance" % instance.id)
-        try:
-            request = self._conn.instances().delete(project=self._project,
-                                                    zone=self._zone,
-                                                    instance=instance.id)
-            response = request.execute()
-            self._wait_for_operation(response['name'])
-        except Exception:
-            logger.info('Could not delete instance: %s' % instance.id)
-            
-        response = self._start_instance(instance.id, instance.instance_type, instance.image_id, instance.disk_size, instance.tags)
-
-        instance.gce_boot_response = response
-        instance.num_starts = instance.num_starts + 1
-        instance.boot_time = int(time.time())
-        instance.not_instanciated_correctly = False
+        instance.next_poll = 0
+        self._wait_event.set()
 
-    def provision(self, source_disk_image, machine_type, count=1, tags=[], disk_size=10,
-                  boot_timeout=900, boot_max_tries=3):
+    def _refresh_instances(self, instances):
         """
-        Provision a new instance. Note that this method starts the provisioning cycle, but does not
-        block for the instance to finish booting - for that, see wait()
+        Called by wait() before the instances are checked, so that clouds which can get the state
+        of many instances with a single request can do that
         
-        :param image_id: The image id as specified by the cloud infrastructure
-        :param instance_type: The instance type (m1.small, m1.large, ...)
-        :param count: Number of instances to provision. The default is 1.
-        :param tags: Tags to add to the instance - this is important as tags are used throughout the API 
-                     to find and manipulate instances
-        :param boot_timeout: The amount of allowed time in seconds for an instance to boot
-        :param boot_max_tries: The number of tries an instance is given to successfully boot
-        """   
-      
-        name = 'inst-' + self._name.replace('_', '')
-        if re.search('^(?:[a-z](?:[-a-z0-9]{0,61}[a-z0-9])?)$', name) is None:
-            name = 'inst-' + str(uuid.uuid4().get_hex())
-        
-        
-        for _i in range(count):
-            inst_id = name + '-' + str(self.counter)
-            self.counter += 1
-            # add basic tags
-            inst_tags = list(tags)
-            inst_tags.append("precip")
-            inst_tags.append(inst_id)
-            
-            instance = Instance(inst_id)
-            
-            try:
-                response = self._start_instance(inst_id, machine_type, source_disk_image, disk_size, inst_tags)
-                instance.gce_boot_response = response
-            except Exception as e:
-                logger.info("%s" % str(e))
-                instance.not_instanciated_correctly = True
-            
-            # keep track of parameters - we might need them for restarts later
-            instance.num_starts = 1
-            instance.boot_time = int(time.time())
-            instance.boot_timeout = boot_timeout
-            instance.boot_max_tries = 3
-            instance.image_id = source_disk_image
-            instance.instance_type = machine_type
-            instance.disk_size = disk_size
-            
-            for t in inst_tags:
-                instance.add_tag(t)
-            
-            self._instances.append(instance)
+        :param instances: the instances about to be checked
+        """
+        pass
 
-    def wait(self, tags=[]):
+    def list(self, tags=[]):
         """
-        Barrier for all currently instances to finish booting and be accessible via external addresses.
+        Provides a list of instances, and instance details, with the matching tags
         
         :param tags: set of tags to match against
-        :param timeout: maximum timeout to wait for instances to come up
-        :param maxretrycount: The number of retries in case of failure of provisioning the instances 
-        """
-        
-        count_pending = -1
-        while count_pending != 0:
-            count_pending = 0
-            current_time = int(time.time())
-
-            for i in self._instance_subset(tags):
-                if not self._finish_instanciation(i):
-                    count_pending += 1
-
-                    # did the instance timeout?
-                    if current_time > i.boot_time + i.boot_timeout:
-                        logger.info("Timeout reached while waiting for instances to boot")
-                        logger.info("A common cause for this that your image does not allow the" + \
-                                    " root user to login.")
-                        logger.info("Another common cause is infrastructure problems, preventing" + \
-                                    " the instance from booting correctly.")
-                        if i.num_starts < i.boot_max_tries:
-                            self._retry(i)
-                        else:
-                            raise ExperimentException("Timeout reached while waiting for instances to boot")
-
-            if count_pending > 0:
-                logger.info("Still waiting for %d instances to finish booting" % (count_pending))
-                time.sleep(20)       
+        :return: list of instance descriptions
+        """
+        l = []
+        for i in self._instance_subset(tags):
+            l.append(i.info())
+        return l
         
     def deprovision(self, tags=[]):
         """
@@ -1103,501 +2711,779 @@ class GCloudExperiment(Experiment):
         
         :param tags: set of tags to match against
         """
-        responses = []
+        pass
+    
+    def get_public_hostnames(self, tags=[]):
+        """
+        Get the set of public hostnames (or IP addresses) for instances matching 'tags'
         
+        :param tags: set of tags to match against
+        """
+        addresses = []
         for i in self._instance_subset(tags):
-            try:
-                logger.info("Deprovisioning instance: %s" % i.id)
-                request = self._conn.instances().delete(project=self._project,
-                                                        zone=self._zone,
-                                                        instance=i.id)
-                response = request.execute()
-                responses.append({'response' : response, 'id' : i.id})
-            except Exception:
-                logger.info('Could not deprovision instance: %s' % i.id)
-            self._instances.remove(i)
-        
-        if len(responses) == 0:
-            return
-        
-        logger.info("Waiting for deprovisioning to complete")    
-        while len(responses) > 0:
-            r = responses.pop()
-            try:
-                self._wait_for_operation(r['response']['name'])
-            except ExperimentException, e:
-                if "RESOURCE_NOT_READY" in str(e):
-                    time.sleep(30)
-                    request = self._conn.instances().delete(project=self._project,
-                                                        zone=self._zone,
-                                                        instance=r['id'])
-                    response = request.execute()
-                else:
-                    logger.warn('Deprovisioning issued an warning: %s' %str(e))
-                
-        logger.info("Deprovisioning done")                 
-
+            addresses.append(i.pub_addr)
+        return addresses
 
-class EC2Experiment(Experiment):
-    
-    def __init__(self, region, endpoint, access_key, secret_key, name = None):
+    def get_private_hostnames(self, tags=[]):
         """
-        Initializes an EC2 experiment
+        Get the set of private hostnames (or IP addresses) for instances matching 'tags'
         
-        :param region: Amazon EC2 region, for example us-west-2c
-        :param endpoint: Amazon EC2 endpoint, for example ec2.us-west-2.amazonaws.com
-        :param access_keys: Amazon EC2 access key
-        :param secret_keys: Amazon EC2 secret key
-        """        
-        Experiment.__init__(self, name = name)
-    
-        self._region = region
-        self._endpoint = endpoint
-        self._access_key = access_key
-        self._secret_key = secret_key
+        :param tags: set of tags to match against
+        """
+        addresses = []
+        for i in self._instance_subset(tags):
+            addresses.append(i.priv_addr)
+        return addresses
     
-        self._conn = None
+    def get(self, tags, remote_path, local_path, user="root", parallelism=1, bwlimit=None,
+            resumable=False, chunk_size=64 * 1024 * 1024, channels=4):
+        """
+        Transfers a file from a set of remote machines matching the tags, and stores the file locally.
+        If more than one instance matches the tags, an instance id will be appended to the local_path. 
+        Failed transfers do not stop the transfers from the other instances - check the returned
+        results for errors.
         
-        # some infrastructures do not support security groups
-        self._security_groups_support = True
-    
-        self._get_connection()
-        self._ssh_keys_setup()
-        self._security_groups_setup()
+        :param tags: set of tags to match against
+        :param remote_path: location of the file on the remote instance
+        :param local_path: local location for where to store the file
+        :param parallelism: number of instances to transfer from at the same time
+        :param bwlimit: optional cap, in bytes per second, on the combined transfer rate
+        :param resumable: if true, the file is transferred in checksummed chunks, and the completed
+                          chunks are recorded in local_path.precip-part. Calling get() again after
+                          a failure only fetches the missing chunks.
+        :param chunk_size: size of the chunks for resumable transfers
+        :param channels: number of chunks to transfer at the same time for resumable transfers
+        :return: list of transfer results, one per instance
+        """
+        ssh = SSHConnection(self._ssh_pool)
+        iset = self._instance_subset(tags)
+        
+        # if the instance set is larger than one, enable the appending of 
+        # instance id to the local path
+        append_instance_id = True
+        if len(iset) == 1:
+            append_instance_id = False
 
-    def _get_connection(self):
-        """
-        Establishes a connection to the cloud endpoint
+        def get_from_instance(i):
+            modified_local_path = local_path
+            if append_instance_id:
+                modified_local_path = local_path + "." + i.id
+            # should we do checks on the target path? Directory check? Existing file check?
+            if resumable:
+                return ssh.get_chunked(self._ssh_privkey, i.pub_addr, user, remote_path,
+                                       modified_local_path, modified_local_path + ".precip-part",
+                                       chunk_size=chunk_size, channels=channels, limiter=limiter)
+            return ssh.get(self._ssh_privkey, i.pub_addr, user, remote_path, modified_local_path,
+                           limiter=limiter)
+
+        limiter = BandwidthLimiter(bwlimit) if bwlimit is not None else None
+        return self._transfer(iset, get_from_instance, parallelism, op="get")
+
+    def put(self, tags, local_path, remote_path, user="root", priv=False, parallelism=1, bwlimit=None,
+            broadcast=False, seeds=1, resumable=False, chunk_size=64 * 1024 * 1024, channels=4):
         """
-        if (self._conn != None):
-            return
-                                                                                                                    
-        logger.info("Connecting to endpoint " + self._endpoint)
+        Transfers a local file to a set of instances matching the given tags. Failed transfers do
+        not stop the transfers to the other instances - check the returned results for errors.
         
-        re_endpoint = re.compile(r'(([\w]+)://)?([\w\.\-]*)(?::(\d+))?(/[\S]*)?')
-        r = re_endpoint.search(self._endpoint)
-        if not r:
-            raise ExperimentException("Unable to parse endpoint: %s" % (self._endpoint))
+        :param tags: set of tags to match against
+        :param local_path: local location for the source file
+        :param remote_path: location of where to copy the file to
+        :param user: user to transfer as, default is 'root'
+        :param parallelism: number of instances to transfer to at the same time
+        :param bwlimit: optional cap, in bytes per second, on the combined transfer rate
+        :param broadcast: if true, the file is only sent to the seed instances, which then relay it
+                          to the other instances over the private network. The number of instances
+                          having the file doubles every round. bwlimit only applies to the seeding.
+        :param seeds: number of instances to send the file to directly when broadcasting
+        :param resumable: if true, the file is transferred in checksummed chunks, and the completed
+                          chunks are recorded in ~/.precip/transfers/. Calling put() again after a
+                          failure only sends the missing chunks.
+        :param chunk_size: size of the chunks for resumable transfers
+        :param channels: number of chunks to transfer at the same time for resumable transfers
+        :return: list of transfer results, one per instance
+        """
+        ssh = SSHConnection(self._ssh_pool)
+
+        def put_to_instance(i):
+            logger.info("Copying %s to %s on %s" % (local_path, remote_path, i.id))
+            addr = i.pub_addr if priv is False else i.priv_addr
+            if resumable:
+                key = "%s:%s:%s" % (i.id, remote_path, os.path.abspath(local_path))
+                sidecar = os.path.join(self._conf_dir, "transfers", hashlib.sha1(key).hexdigest() + ".json")
+                return ssh.put_chunked(self._ssh_privkey, addr, user, local_path, remote_path, sidecar,
+                                       chunk_size=chunk_size, channels=channels, limiter=limiter)
+            return ssh.put(self._ssh_privkey, addr, user, local_path, remote_path, limiter=limiter)
+
+        limiter = BandwidthLimiter(bwlimit) if bwlimit is not None else None
+        iset = self._instance_subset(tags)
+        if broadcast and len(iset) > seeds:
+            return self._broadcast(iset, put_to_instance, remote_path, user, seeds, parallelism,
+                                   priv=priv)
+        return self._transfer(iset, put_to_instance, parallelism, op="put")
+
+    # command run on a relaying instance to pass a file on to another instance. The source and
+    # the destination are quoted by _relay().
+    _relay_cmd = "scp -q -i %(key)s -o BatchMode=yes -o StrictHostKeyChecking=no " \
+                 "-o UserKnownHostsFile=/dev/null %(src)s %(dst)s"
+
+    # maximum number of relay attempts for an instance before the file is sent to it directly
+    _relay_max_tries = 2
+
+    def _relay_setup(self, ssh, iset, user, parallelism, priv=False):
+        """
+        Sets up a key pair which lets the instances scp files to each other. The key pair only
+        exists until _relay_cleanup() is called.
+        
+        :param priv: if true, the instances are reached over their private addresses
+        :return: the path of the private key on the instances, the instances which were set up,
+                 and the command to remove the key pair again
+        """
+        token = uuid.uuid4().get_hex()
+        key = paramiko.RSAKey.generate(2048)
+        buf = StringIO.StringIO()
+        key.write_private_key(buf)
+        key_path = "/tmp/precip-relay-" + token
+        setup_cmd = "umask 077 && mkdir -p ~/.ssh && echo '%s %s precip-relay-%s' >>~/.ssh/authorized_keys" \
+                    " && cat >%s" % (key.get_name(), key.get_base64(), token, key_path)
+        cleanup_cmd = "sed -i '/ precip-relay-%s$/d' ~/.ssh/authorized_keys; rm -f %s" % (token, key_path)
+
+        def setup(i):
+            try:
+                addr = i.pub_addr if priv is False else i.priv_addr
+                exit_code, out, err = ssh.run(self._ssh_privkey, addr, user, setup_cmd, pty=False,
+                                              stdin=buf.getvalue())
+            except Exception, e:
+                exit_code, err = -1, str(e)
+            if exit_code != 0:
+                logger.warn("Unable to set up relaying on %s: %s" % (i.id, err))
+            return exit_code == 0
 
-        # Parse successful
-        proto = r.group(2)
-        host = r.group(3)
-        port = r.group(4)
-        path = r.group(5)
-        
-        if proto is None:
-            proto = "http"
-        
-        if port is None:
-            if proto == "http":
-                port = 80
-            else:
-                port = 443
-        else:
-            port = int(port)
-            
-        if path is None:
-            path = ""
-            
-        is_secure=(proto == "https")
-        # Nimbus wants is_secure to be true
-        if self._region == "nimbus":
-            is_secure = True
-                                                                                  
-        region = RegionInfo(name=self._region, endpoint=host)   
-                                                
-        self._conn = boto.connect_ec2(
-                        self._access_key,
-                        self._secret_key,
-                        is_secure=is_secure,
-                        region=region,
-                        port=port,
-                        path=path)
-    
-        # this next line is due to a bug in early boto versions
-        self._conn.host = host
-    
-        # do a query to validate that the connection works
-        try:
-            self._conn.get_all_instances()
-        except EC2ResponseError, e:
-            self.ec2_conn = None
-            raise ExperimentException("Unable to talk to the service", e) 
-             
-    def _ssh_keys_setup(self):
-        
-        """
-        Makes sure we have our experiment keypair registered
-        """
-        uid = self._get_account_id()
-        keypairs = None
-        try:
-            keypairs = self._conn.get_key_pair("precip_"+uid)
+        ready = [i for i, ok in zip(iset, _parallel_map(setup, iset, parallelism)) if ok]
+        return key_path, ready, cleanup_cmd
 
-            # TODO: verify that the existing keypair matches the one in ~/.precip
-        except IndexError, ie:
-            # not found on eucalyptus
-            pass
-        except EC2ResponseError, e:
-            if e.error_code in ["InvalidKeyPair.NotFound", "KeypairNotFound", "EC2APIError"]:
-                keypairs = None
-            else:
-                raise ExperimentException("Unable to query for key pair", e)
-  
-         
-        if keypairs is None:
-            logger.info("Registering ssh pubkey as 'precip_"+uid+"'")
-            f = open(self._ssh_pubkey)
-            contents = f.read()
-            f.close()
-            self._conn.import_key_pair("precip_"+uid, contents) 
-              
-    def _security_groups_setup(self):
+    def _relay_cleanup(self, ssh, iset, user, cleanup_cmd, parallelism, priv=False):
         """
-        Sets up the default security group
+        Removes the key pair set up by _relay_setup()
         """
-        sgroups = None
-        try:
-            sgroups = self._conn.get_all_security_groups(["precip"])
-        except EC2ResponseError, e:
-            if e.error_code in ["InvalidGroup.NotFound", "SecurityGroupNotFoundForProject"]:
-                sgroups = None
-            else:
-                raise ExperimentException("Unable to find security group", e)
-        
-        if sgroups is None:
+        def cleanup(i):
             try:
-                logger.info("Registering default security group 'precip'")
-                sg = self._conn.create_security_group("precip", "FutureGrid Experiment Mangement default group")
-                sg.authorize(ip_protocol='tcp', from_port=22, to_port=22, cidr_ip='0.0.0.0/0')
-                sg.authorize(src_group=sg)
-            except Exception:
-                logger.warn("Security group seems to be broken - disabling support")
-                self._security_groups_support = False
-                pass
+                addr = i.pub_addr if priv is False else i.priv_addr
+                ssh.run(self._ssh_privkey, addr, user, cleanup_cmd, pty=False)
+            except Exception, e:
+                logger.warn("Unable to remove the relay key from %s: %s" % (i.id, e))
+        _parallel_map(cleanup, iset, parallelism)
 
-    def _start_instance(self, image_id, instance_type, ebs_size):
+    def _relay(self, ssh, src, dst, src_path, dst_path, user, key_path, priv=False):
         """
-        Creates a new instance
+        Copies a file from one instance to another, over the private address of the destination
         
-        :param instance: the instance to check
-        :return: the instance Boto object
+        :param priv: if true, the source instance is reached over its private address
+        :return: the number of bytes copied
         """
-        uid = self._get_account_id()
-        boto_instance = None
+        # older versions of scp pass the destination path through the shell on the other end, so
+        # it is quoted for that shell as well
+        cmd = self._relay_cmd % {"key": key_path, "src": pipes.quote(src_path),
+                                 "dst": pipes.quote("%s@%s:%s" % (user, dst.priv_addr,
+                                                                  pipes.quote(dst_path)))}
+        addr = src.pub_addr if priv is False else src.priv_addr
+        exit_code, out, err = ssh.run(self._ssh_privkey, addr, user,
+                                      cmd + " && wc -c <" + pipes.quote(src_path), pty=False)
+        if exit_code != 0:
+            raise ExperimentException("Relaying from %s to %s failed with exit code %d: %s"
+                                      % (src.id, dst.id, exit_code, err))
+        return int(out.strip())
+
+    def _broadcast(self, iset, put_to_instance, remote_path, user, seeds, parallelism, priv=False):
+        """
+        Distributes a file in a fan-out tree. The seed instances get the file from us, and every
+        instance having the file sends it on to one more instance per round. The relaying is done
+        with scp over the private addresses, using a key pair which only exists for the duration of
+        the broadcast. Instances which can not be reached through the tree get the file directly.
+        
+        :param priv: if true, the instances are reached over their private addresses
+        :return: list of transfer results, one per instance, with the id of the instance the file
+                 came from as "source" (None when it came from us). seconds is the time from the
+                 start of the broadcast until the file arrived.
+        """
+        ssh = SSHConnection(self._ssh_pool)
+        start = time.time()
+        results = {}
+        for i in iset:
+            results[i.id] = {"id": i.id, "bytes": 0, "seconds": 0.0, "error": None, "source": None}
+
+        def direct(i):
+            result = results[i.id]
+            try:
+                result["bytes"] = put_to_instance(i)
+                result["error"] = None
+            except Exception, e:
+                logger.warn("Transfer failed for instance %s: %s" % (i.id, e))
+                result["error"] = e
+            result["seconds"] = time.time() - start
+            return result["error"] is None
+
+        def relay(pair):
+            src, dst = pair
+            logger.info("Relaying %s from %s to %s" % (remote_path, src.id, dst.id))
+            try:
+                nbytes = self._relay(ssh, src, dst, remote_path, remote_path, user, key_path,
+                                     priv=priv)
+            except Exception, e:
+                return e
+            result = results[dst.id]
+            result["bytes"] = nbytes
+            result["source"] = src.id
+            result["seconds"] = time.time() - start
+            return None
+
+        key_path, ready, cleanup_cmd = self._relay_setup(ssh, iset, user, parallelism, priv=priv)
         try:
-            # block device maps is only needed if the user wants to specify ebs_size
-            block_device_map = None
-            if ebs_size is not None:
-                dev_sda1 = EBSBlockDeviceType(delete_on_termination = True)
-                dev_sda1.size = int(ebs_size)
-                block_device_map = BlockDeviceMapping()
-                block_device_map['/dev/sda1'] = dev_sda1
-            #else:
-            #    block_device_map = self._conn.get_image_attribute(image_id, 
-            #                                                      attribute = 'blockDeviceMapping')
-
-            # create a boto image object from the image id          
-            image_obj = self._conn.get_image(image_id)
-            if image_obj is None:
-                raise ExperimentException("Image %s does not exist" %(image_id))
-
-            if self._security_groups_support:
-                res = image_obj.run(instance_type = instance_type,
-                                    key_name = "precip_"+uid,
-                                    instance_initiated_shutdown_behavior = "terminate",
-                                    block_device_map = block_device_map,
-                                    security_groups = ["precip"])
-            else:
-                res = image_obj.run(instance_type = instance_type,
-                                    key_name = "precip_"+uid,
-                                    instance_initiated_shutdown_behavior = "terminate",
-                                    block_device_map = block_device_map)
-            boto_instance = res.instances[0]
-
-            logger.info("Started instance %s, type %s" % (boto_instance.id, instance_type))        
-        except Exception as e:
-            raise ExperimentException("Unable to provision a new instance", e)
-        return res.instances[0]
+            unreachable = [i for i in iset if i not in ready]
+            holders = [i for i, ok in zip(ready[:seeds], _parallel_map(direct, ready[:seeds], seeds)) if ok]
+            pending = ready[seeds:]
+            tries = {}
+            while len(pending) > 0 and len(holders) > 0:
+                pairs = zip(holders, pending)
+                pending = pending[len(pairs):]
+                for (src, dst), error in zip(pairs, _parallel_map(relay, pairs, len(pairs))):
+                    if error is None:
+                        holders.append(dst)
+                        continue
+                    logger.warn("Relaying to %s failed: %s" % (dst.id, error))
+                    tries[dst] = tries.get(dst, 0) + 1
+                    if tries[dst] < self._relay_max_tries:
+                        pending.append(dst)
+                    else:
+                        unreachable.append(dst)
+            _parallel_map(direct, unreachable + pending, parallelism)
+        finally:
+            self._relay_cleanup(ssh, iset, user, cleanup_cmd, parallelism, priv=priv)
+        return [results[i.id] for i in iset]
+
+    def transfer(self, src_tags, dst_tags, path, dst_path=None, pattern="one-to-many", user="root",
+                 parallelism=10):
+        """
+        Copies a file directly between instances, over their private addresses, without passing
+        the data through this machine.
+        
+        :param src_tags: set of tags matching the instances to copy from
+        :param dst_tags: set of tags matching the instances to copy to
+        :param path: location of the file on the source instances
+        :param dst_path: location to store the file on the destination instances. Defaults to path.
+        :param pattern: "one-to-many" gives every destination the file from one of the sources,
+                        spreading the destinations over the sources. "many-to-one" collects the
+                        file from every source on a single destination instance. "all-to-all"
+                        gives every destination the file from every source. With "many-to-one"
+                        and "all-to-all", the id of the source instance is appended to dst_path.
+                        Instances never copy to themselves.
+        :param user: user to transfer as, default is 'root'
+        :param parallelism: number of copies to run at the same time
+        :return: list of dictionaries, one per pair of instances, with the source and destination
+                 ids, bytes transferred, seconds spent, the rate in bytes per second and the error
+                 (None if the transfer succeeded)
+        """
+        if dst_path is None:
+            dst_path = path
+        srcs = self._instance_subset(src_tags)
+        dsts = self._instance_subset(dst_tags)
+        if len(srcs) == 0 or len(dsts) == 0:
+            raise ExperimentException("No instances to transfer between")
+
+        pairs = []
+        if pattern == "one-to-many":
+            # the destinations which are sources have the file already
+            targets = [dst for dst in dsts if dst not in srcs]
+            for k, dst in enumerate(targets):
+                pairs.append((srcs[k % len(srcs)], dst, dst_path))
+        elif pattern in ["many-to-one", "all-to-all"]:
+            if pattern == "many-to-one" and len(dsts) > 1:
+                raise ExperimentException("The many-to-one pattern needs a single destination" \
+                                          " instance, but %d instances match" % len(dsts))
+            for src in srcs:
+                for dst in dsts:
+                    if src is not dst:
+                        pairs.append((src, dst, dst_path + "." + src.id))
+        else:
+            raise ExperimentException("Unknown transfer pattern: %s" % pattern)
+
+        ssh = SSHConnection(self._ssh_pool)
+        involved = []
+        for src, dst, _ in pairs:
+            for i in [src, dst]:
+                if i not in involved:
+                    involved.append(i)
+
+        def copy(pair):
+            src, dst, target = pair
+            logger.info("Transferring %s from %s to %s" % (path, src.id, dst.id))
+            result = {"src": src.id, "dst": dst.id, "bytes": 0, "seconds": 0.0, "rate": 0.0,
+                      "error": None}
+            start = time.time()
+            try:
+                if src not in ready or dst not in ready:
+                    raise ExperimentException("Relaying is not set up on %s or %s" % (src.id, dst.id))
+                result["bytes"] = self._relay(ssh, src, dst, path, target, user, key_path)
+            except Exception, e:
+                logger.warn("Transfer from %s to %s failed: %s" % (src.id, dst.id, e))
+                result["error"] = e
+            result["seconds"] = time.time() - start
+            if result["seconds"] > 0:
+                result["rate"] = result["bytes"] / result["seconds"]
+            self._metrics.observe("operation_seconds", result["seconds"], op="transfer", instance=dst.id)
+            self._metrics.inc("operation_bytes", result["bytes"], op="transfer", instance=dst.id)
+            return result
+
+        key_path, ready, cleanup_cmd = self._relay_setup(ssh, involved, user, parallelism)
+        try:
+            return _parallel_map(copy, pairs, parallelism)
+        finally:
+            self._relay_cleanup(ssh, involved, user, cleanup_cmd, parallelism)
 
-    def _finish_instanciation(self, instance):
+    def _transfer(self, iset, func, parallelism, op="transfer"):
         """
-        Finishes booting and bootstraps an instace
+        Runs a file transfer function for each instance, and collects results and timings
         
-        :param instance: the instance to check
-        :return: True if the instance is ready, otherwise False
+        :return: list of dictionaries with the instance id, bytes transferred, seconds spent and
+                 the error (None if the transfer succeeded)
         """
-        instance_record = []
-        count_ing = 0
-        # check if we are already done
-        if instance.is_fully_instanciated:
-            return True
-            
-        # now, let's wait until the instance i up and running        
-        ec2inst = instance.ec2_instance
-        ec2inst.update()
-        
-        if ec2inst.state == "error":
-            logger.debug("Instance %s state is 'error - scheduling for possible retry" %instance.id)
-            instance.boot_timeout = 0
-            return False
-        
-        if ec2inst.state != "pending" and ec2inst.state != "running":
-            
-            #raise ExperimentException("Unexpected instance state for instance %s: %s" % (instance.id, ec2inst.state))
-            logger.debug("Unexpected instance state for instance %s: %s" % (instance.id, ec2inst.state))
-            return False             
-        
-        if ec2inst.state == "pending":
-            logger.debug("Instance %s is still pending" % instance.id)
-            return False
-        
-        if ec2inst.public_dns_name is None or \
-           ec2inst.public_dns_name == "" or \
-           ec2inst.public_dns_name.startswith('10.'):
-            # we did not get a public address assigned to us, do it now
-
-            # first check if we have unused floating ips laying around
-            addr_to_use = None
-            addresses = self._conn.get_all_addresses()
-            for address in addresses:
-                if address.instance_id is None or address.instance_id == "":
-                    addr_to_use = address.public_ip
-                    break
+        def transfer(i):
+            result = {"id": i.id, "bytes": 0, "seconds": 0.0, "error": None}
+            start = time.time()
+            try:
+                result["bytes"] = func(i)
+            except Exception, e:
+                logger.warn("Transfer failed for instance %s: %s" % (i.id, e))
+                result["error"] = e
+                self._metrics.inc("operation_errors", op=op, instance=i.id)
+            result["seconds"] = time.time() - start
+            self._metrics.observe("operation_seconds", result["seconds"], op=op, instance=i.id)
+            self._metrics.inc("operation_bytes", result["bytes"], op=op, instance=i.id)
+            self._update_link_speed(result)
+            return result
+        return _parallel_map(transfer, iset, parallelism)
 
-            if not addr_to_use:
-                logger.debug("Requesting a new public IP address")
-                addr_to_use = self._conn.allocate_address()
+    def _update_link_speed(self, result):
+        """
+        Keeps a moving average of the transfer rate, from transfers large enough to tell
+        """
+        if result["error"] is not None or result["bytes"] < 1024 * 1024 or result["seconds"] <= 0:
+            return
+        speed = result["bytes"] / result["seconds"]
+        if self._link_speed is None:
+            self._link_speed = speed
+        else:
+            self._link_speed = 0.7 * self._link_speed + 0.3 * speed
 
-            logger.debug("Setting public ip: %s" %(addr_to_use))
-            ec2inst.use_ip(addr_to_use)
-            return False
-    
-        if not self._is_valid_hostaddr(ec2inst.public_dns_name):
-            logger.debug("Waiting for instance %s to boot and be assigned a public IP address" % instance.id)
-            return False
-        
-        # fill out instance fields
-        instance.priv_addr = ec2inst.private_dns_name
-        instance.pub_addr = ec2inst.public_dns_name
-            
-        # bootstrap the image
-        exit_code = -1
-        out = ""
-        err = ""
-        try:
-            logger.debug("Will try to ssh to " + ec2inst.public_dns_name)
-            ssh = SSHConnection()
-            script_path = os.path.dirname(os.path.abspath(__file__)) + "/resources/vm-bootstrap.sh"
-            ssh.put(self._ssh_privkey, ec2inst.public_dns_name, "root", script_path, "/root/vm-bootstrap.sh")
-            exit_code, out, err = ssh.run(self._ssh_privkey, ec2inst.public_dns_name, "root", "chmod 755 /root/vm-bootstrap.sh && /root/vm-bootstrap.sh")
-        except paramiko.SSHException:
-            logger.debug("Failed to run bootstrap script on instance %s. Will retry later." % instance.id)
-            logger.debug("Out: " + out)
-            logger.debug("Err: " + err)
-            return False
-        except paramiko.SFTPError:
-            logger.debug("Unable to ssh connect to instance %s. Will retry later." % instance.id)
-            return False
-        except socket.error:
-            logger.debug("Unable to ssh connect to instance %s. Will retry later." % instance.id)
-            return False
-        
-        if len(out) > 0:
-            logger.info("  stdout: %s" % out)
-        if len(err) > 0:
-            logger.info("  stderr: %s" % err)
-        if exit_code != 0:
-            raise ExperimentException("Bootstrap script exited with error %d" % exit_code)
-        
-        logger.info("Instance %s has booted, public address: %s" % (instance.id, ec2inst.public_dns_name))
+    # above this rate (bytes per second), compressing tar streams costs more than it saves
+    _compress_max_speed = 100 * 1024 * 1024
 
-        # add our tags
-        try:
-            ec2inst.add_tag("Name", "PRECIP - " + self._name)
-            # can only add 10 on EC2
-            tag_count = 1
-            for t in instance.tags:
-                if tag_count >= 10:
-                    break
-                ec2inst.add_tag(t, "1")
-                tag_count += 1
-        except Exception, e:
-            # ignore - the infrastructure might not support user tags
-            pass
-        
-        instance.add_tag(instance.pub_addr)
-        instance.is_fully_instanciated = True
-        return True
+    # commands to compress and decompress tar streams with
+    _compressors = {"gzip": (["gzip", "-1", "-c"], ["gzip", "-d", "-c"]),
+                    "zstd": (["zstd", "-q", "-c"], ["zstd", "-q", "-d", "-c"])}
 
-    def _retry(self, instance):
-        
+    def _tar_compression(self, ssh, instance, user, compression):
         """
-        In case of reaching timeout for an instance, retry will terminate the previous instance and 
-        replace it with a new instance.
+        Picks the compression for a tar transfer. With "auto", streams are not compressed on fast
+        links, and zstd is preferred over gzip when both ends have it.
         
-        :param instance: the instance to terminate and replace with a new one
-        :param image_id: The image id as specified by the cloud infrastructure
-        :param instance_type: The instance type (m1.small, m1.large, ...)
-        :param tags: Tags to add to the new instance - this is important as tags are used throughout the API 
-                     to find and manipulate instances
+        :return: None, "gzip" or "zstd"
         """
-        
-        uid = self._get_account_id()
-        self._get_connection()
-        
-        logger.info("Instance %s has reached timeout, and will be replaced with a new instance" % instance.id)
-        try:
-            self._conn.terminate_instances(instance_ids=[instance.id])
-        except AttributeError as e:
-            logger.warn("Terminating issued an attribute warning")
-        except Exception as e:
-            logger.warn("Ignoring error while terminating instance", e)
-
-        boto_inst = self._start_instance(instance.image_id, instance.instance_type, instance.ebs_size)
-        instance.id = boto_inst.id
-        instance.ec2_instance = boto_inst
-        instance.num_starts = instance.num_starts + 1
-        instance.boot_time = int(time.time())
+        if compression == "auto":
+            if self._link_speed is not None and self._link_speed > self._compress_max_speed:
+                return None
+            if find_executable("zstd") is None:
+                return "gzip"
+            if instance.id not in self._remote_zstd:
+                exit_code, out, err = ssh.run(self._ssh_privkey, instance.pub_addr, user,
+                                              "command -v zstd", pty=False)
+                self._remote_zstd[instance.id] = exit_code == 0
+            return "zstd" if self._remote_zstd[instance.id] else "gzip"
+        if compression not in [None, "none", "gzip", "zstd"]:
+            raise ExperimentException("Unknown compression: %s" % compression)
+        return None if compression == "none" else compression
 
-            
-    def provision(self, image_id, instance_type='m1.small', count=1, ebs_size=None, tags=None,
-                  boot_timeout=900, boot_max_tries=3):
+    def put_tar(self, tags, local_dir, remote_dir, paths=["."], user="root", compression="auto",
+                parallelism=1, bwlimit=None):
         """
-        Provision a new instance. Note that this method starts the provisioning cycle, but does not
-        block for the instance to finish booting - for that, see wait()
-        
-        :param image_id: The image id as specified by the cloud infrastructure
-        :param instance_type: The instance type (m1.small, m1.large, ...)
-        :param count: Number of instances to provision. The default is 1.
-        :param tags: Tags to add to the instance - this is important as tags are used throughout the API 
-                     to find and manipulate instances
-        :param boot_timeout: The amount of allowed time in seconds for an instance to boot
-        :param boot_max_tries: The number of tries an instance is given to successfully boot
-        """   
+        Transfers files and directories to the instances matching the given tags, as a tar stream
+        over a single ssh channel per instance. This is a lot faster than put() for many small
+        files.
         
-        uid = self._get_account_id()
-        
-        self._get_connection()
-               
-        for i in range(count):
-            boto_inst = self._start_instance(image_id, instance_type, ebs_size)
-
-            instance = Instance(boto_inst.id)
-            instance.ec2_instance = boto_inst
-
-            # keep track of parameters - we might need them for restarts later
-            instance.num_starts = 1
-            instance.boot_time = int(time.time())
-            instance.boot_timeout = boot_timeout
-            instance.boot_max_tries = 3
-            instance.image_id = image_id
-            instance.instance_type = instance_type
-            instance.ebs_size = ebs_size
-            
-            # add basic tags
-            instance.add_tag("precip")
-            instance.add_tag(instance.id)
-            for t in tags:
-                instance.add_tag(t)
-            
-            self._instances.append(instance)
+        :param tags: set of tags to match against
+        :param local_dir: the local directory the paths are relative to
+        :param remote_dir: the directory on the instances to unpack in. It is created if it does
+                           not exist.
+        :param paths: files and directories to transfer, relative to local_dir
+        :param user: user to transfer as, default is 'root'
+        :param compression: "gzip", "zstd", "none", or "auto" to pick based on the transfer rate
+                            seen so far and on what the instances support
+        :param parallelism: number of instances to transfer to at the same time
+        :param bwlimit: optional cap, in bytes per second, on the combined transfer rate
+        :return: list of transfer results, one per instance. bytes is the size of the stream sent.
+        """
+        ssh = SSHConnection(self._ssh_pool)
+
+        def put_tar_to_instance(i):
+            logger.info("Streaming %s to %s on %s" % (local_dir, remote_dir, i.id))
+            comp = self._tar_compression(ssh, i, user, compression)
+            remote_cmd = "tar -x -f -"
+            if comp is not None:
+                remote_cmd = " ".join(self._compressors[comp][1]) + " | " + remote_cmd
+            remote_cmd = "mkdir -p %s && cd %s && %s" % (pipes.quote(remote_dir),
+                                                        pipes.quote(remote_dir), remote_cmd)
+            errf = tempfile.TemporaryFile()
+            procs = [subprocess.Popen(["tar", "-C", local_dir, "-c", "-f", "-"] + list(paths),
+                                      stdout=subprocess.PIPE, stderr=errf)]
+            if comp is not None:
+                procs.append(subprocess.Popen(self._compressors[comp][0], stdin=procs[0].stdout,
+                                              stdout=subprocess.PIPE, stderr=errf))
+                procs[0].stdout.close()
+            try:
+                exit_code, nbytes, err = ssh.pipe_to(self._ssh_privkey, i.pub_addr, user, remote_cmd,
+                                                     procs[-1].stdout, limiter=limiter)
+            finally:
+                procs[-1].stdout.close()
+                local_codes = [p.wait() for p in procs]
+            # a failing remote end makes the local tar fail too, so report the remote error first
+            if exit_code != 0:
+                raise ExperimentException("Remote tar failed on %s: %s" % (i.id, err))
+            errf.seek(0)
+            if max(local_codes) != 0:
+                raise ExperimentException("Local tar failed: %s" % errf.read())
+            return nbytes
 
+        limiter = BandwidthLimiter(bwlimit) if bwlimit is not None else None
+        return self._transfer(self._instance_subset(tags), put_tar_to_instance, parallelism, op="put_tar")
 
-    def wait(self, tags=[]):
+    def get_tar(self, tags, remote_dir, local_dir, paths=["."], user="root", compression="auto",
+                parallelism=1, bwlimit=None):
         """
-        Barrier for all currently instances to finish booting and be accessible via external addresses.
+        Transfers files and directories from the instances matching the given tags, as a tar stream
+        over a single ssh channel per instance. If more than one instance matches the tags, an
+        instance id will be appended to the local_dir.
         
         :param tags: set of tags to match against
-        :param timeout: maximum timeout to wait for instances to come up
-        :param maxretrycount: The number of retries in case of failure of provisioning the instances 
+        :param remote_dir: the directory on the instances the paths are relative to
+        :param local_dir: the local directory to unpack in. It is created if it does not exist.
+        :param paths: files and directories to transfer, relative to remote_dir
+        :param user: user to transfer as, default is 'root'
+        :param compression: "gzip", "zstd", "none", or "auto" to pick based on the transfer rate
+                            seen so far and on what the instances support
+        :param parallelism: number of instances to transfer from at the same time
+        :param bwlimit: optional cap, in bytes per second, on the combined transfer rate
+        :return: list of transfer results, one per instance. bytes is the size of the stream received.
         """
+        ssh = SSHConnection(self._ssh_pool)
+        iset = self._instance_subset(tags)
+
+        def get_tar_from_instance(i):
+            logger.info("Streaming %s on %s to %s" % (remote_dir, i.id, local_dir))
+            modified_local_dir = local_dir
+            if len(iset) > 1:
+                modified_local_dir = local_dir + "." + i.id
+            if not os.path.isdir(modified_local_dir):
+                os.makedirs(modified_local_dir)
+            comp = self._tar_compression(ssh, i, user, compression)
+            # the exit code of a pipeline is the one of the last command, so a failing tar is
+            # reported on stderr
+            remote_cmd = "cd %s && { tar -c -f - %s || echo 'precip: tar failed' >&2; }" \
+                         % (pipes.quote(remote_dir), " ".join([pipes.quote(p) for p in paths]))
+            if comp is not None:
+                remote_cmd += " | " + " ".join(self._compressors[comp][0])
+            errf = tempfile.TemporaryFile()
+            procs = []
+            if comp is not None:
+                procs.append(subprocess.Popen(self._compressors[comp][1], stdin=subprocess.PIPE,
+                                              stdout=subprocess.PIPE, stderr=errf))
+            procs.append(subprocess.Popen(["tar", "-C", modified_local_dir, "-x", "-f", "-"],
+                                          stdin=procs[0].stdout if comp is not None else subprocess.PIPE,
+                                          stderr=errf))
+            if comp is not None:
+                procs[0].stdout.close()
+            try:
+                exit_code, nbytes, err = ssh.pipe_from(self._ssh_privkey, i.pub_addr, user, remote_cmd,
+                                                       procs[0].stdin, limiter=limiter)
+            finally:
+                procs[0].stdin.close()
+                local_codes = [p.wait() for p in procs]
+            if exit_code != 0 or "precip: tar failed" in err:
+                raise ExperimentException("Remote tar failed on %s: %s" % (i.id, err))
+            errf.seek(0)
+            if max(local_codes) != 0:
+                raise ExperimentException("Local tar failed: %s" % errf.read())
+            return nbytes
+
+        limiter = BandwidthLimiter(bwlimit) if bwlimit is not None else None
+        return self._transfer(iset, get_tar_from_instance, parallelism, op="get_tar")
+
+    def put_dir(self, tags, local_dir, remote_dir, user="root", delete=False, block_size=65536,
+                parallelism=1, bwlimit=None):
+        """
+        Syncs a local directory to the instances matching the given tags. Only new files and the
+        blocks of files which have changed are sent. Checksums are cached on both sides, so files
+        which have not been modified since the last sync are not read again.
         
-        count_pending = -1
-        while count_pending != 0:
-            count_pending = 0
-            current_time = int(time.time())
+        :param tags: set of tags to match against
+        :param local_dir: the local directory
+        :param remote_dir: the directory on the instances. It is created if it does not exist.
+        :param user: user to transfer as, default is 'root'
+        :param delete: if true, remote files which do not exist locally are removed
+        :param block_size: size of the blocks which are compared
+        :param parallelism: number of instances to transfer to at the same time
+        :param bwlimit: optional cap, in bytes per second, on the combined transfer rate
+        :return: list of transfer results, one per instance
+        """
+        local_manifest = _blocksum.scan(local_dir, block_size, _blocksum.cache_path(local_dir))
+        if not local_manifest["exists"]:
+            raise ExperimentException("%s is not a directory" % local_dir)
+        ssh = SSHConnection(self._ssh_pool)
 
-            for i in self._instance_subset(tags):
-                if not self._finish_instanciation(i):
-                    count_pending += 1
+        def put_dir_to_instance(i):
+            logger.info("Syncing %s to %s on %s" % (local_dir, remote_dir, i.id))
+            remote_manifest = self._remote_manifest(ssh, i, user, remote_dir, block_size, create=True)
+            return ssh.sync_dir(self._ssh_privkey, i.pub_addr, user, local_dir, local_manifest,
+                                remote_dir, remote_manifest, upload=True, delete=delete, limiter=limiter)
 
-                    # did the instance timeout?
-                    if current_time > i.boot_time + i.boot_timeout:
-                        logger.info("Timeout reached while waiting for instances to boot")
-                        logger.info("A common cause for this that your image does not allow the" + \
-                                    " root user to login.")
-                        logger.info("Another common cause is infrastructure problems, preventing" + \
-                                    " the instance from booting correctly.")
-                        if i.num_starts < i.boot_max_tries:
-                            self._retry(i)
-                        else:
-                            raise ExperimentException("Timeout reached while waiting for instances to boot")
+        limiter = BandwidthLimiter(bwlimit) if bwlimit is not None else None
+        return self._transfer(self._instance_subset(tags), put_dir_to_instance, parallelism, op="put_dir")
 
-            if count_pending > 0:
-                logger.info("Still waiting for %d instances to finish booting" % (count_pending))
-                time.sleep(30)       
+    def get_dir(self, tags, remote_dir, local_dir, user="root", delete=False, block_size=65536,
+                parallelism=1, bwlimit=None):
+        """
+        Syncs a directory from the instances matching the tags to the local machine. Only new files
+        and the blocks of files which have changed are fetched. If more than one instance matches
+        the tags, an instance id will be appended to the local_dir.
         
+        :param tags: set of tags to match against
+        :param remote_dir: the directory on the instances
+        :param local_dir: the local directory. It is created if it does not exist.
+        :param user: user to transfer as, default is 'root'
+        :param delete: if true, local files which do not exist on the instance are removed
+        :param block_size: size of the blocks which are compared
+        :param parallelism: number of instances to transfer from at the same time
+        :param bwlimit: optional cap, in bytes per second, on the combined transfer rate
+        :return: list of transfer results, one per instance
+        """
+        ssh = SSHConnection(self._ssh_pool)
+        iset = self._instance_subset(tags)
 
-    def deprovision(self, tags=[]):
+        def get_dir_from_instance(i):
+            logger.info("Syncing %s on %s to %s" % (remote_dir, i.id, local_dir))
+            modified_local_dir = local_dir
+            if len(iset) > 1:
+                modified_local_dir = local_dir + "." + i.id
+            remote_manifest = self._remote_manifest(ssh, i, user, remote_dir, block_size)
+            if not remote_manifest["exists"]:
+                raise ExperimentException("%s is not a directory on %s" % (remote_dir, i.id))
+            if not os.path.isdir(modified_local_dir):
+                os.makedirs(modified_local_dir)
+            local_manifest = _blocksum.scan(modified_local_dir, block_size,
+                                            _blocksum.cache_path(modified_local_dir))
+            return ssh.sync_dir(self._ssh_privkey, i.pub_addr, user, remote_dir, remote_manifest,
+                                modified_local_dir, local_manifest, upload=False, delete=delete,
+                                limiter=limiter)
+
+        limiter = BandwidthLimiter(bwlimit) if bwlimit is not None else None
+        return self._transfer(iset, get_dir_from_instance, parallelism, op="get_dir")
+
+    def _remote_manifest(self, ssh, instance, user, remote_dir, block_size, create=False):
+        """
+        Runs blocksum.py on an instance to get the manifest of a remote directory
+        
+        :param create: if true, the directory is created if it does not exist
+        """
+        f = open(os.path.join(_RESOURCES_DIR, "blocksum.py"))
+        helper = f.read()
+        f.close()
+        cmd = "P=$(command -v python3 || command -v python) && $P - %s %d" \
+              % (pipes.quote(remote_dir), block_size)
+        if create:
+            cmd = "mkdir -p %s && %s" % (pipes.quote(remote_dir), cmd)
+        exit_code, out, err = ssh.run(self._ssh_privkey, instance.pub_addr, user, cmd, pty=False,
+                                      stdin=helper)
+        if exit_code != 0:
+            raise ExperimentException("Unable to list %s on %s: %s" % (remote_dir, instance.id, err))
+        return json.loads(out)
+
+    def run(self, tags, cmd, user="root", check_exit_code=True, output_base_name=None, priv=False,
+            parallelism=1, output_callback=None, max_output=None, pty=True):
         """
-        Deprovisions (terminates) instances with the matching tags
+        Runs a command on set of instances matching the tags given.
         
         :param tags: set of tags to match against
+        :param cmd: command to run
+        :param user: the user to run the command as
+        :param check_exit_code: if true, non-zero exit codes will be considered fatal
+        :param output_base_name: redirects output to a file instead of stdout. The files are written
+                                 as the output arrives.
+        :param parallelism: number of instances to run the command on at the same time. The default
+                            is 1, which runs the command on one instance after the other. When a
+                            command fails, it is not started on any more instances.
+        :param output_callback: optional function which is called as output arrives, with the
+                                instance id, the stream name ("stdout" or "stderr") and the data
+        :param max_output: if given, only the last max_output bytes of stdout and stderr are kept
+                           in memory and returned for each instance
+        :param pty: if true (default), the command is run with a pty. Set to false to get separate,
+                    untouched stdout and stderr streams, for example for binary output. Commands
+                    run through the agent (see use_agent()) never get a pty.
+        :return: lists of exit codes, stdout and stderr, in instance order
         """
-        self._get_connection()
-        for i in self._instance_subset(tags):
-            logger.info("Deprovisioning instance: %s" % i.id)
+        iset = self._instance_subset(tags)
+        for i in iset:
+            if not i.is_fully_instanciated:
+                raise ExperimentException("Can't ssh a not fully instanciated instance "+ i.id)
+
+        ssh = SSHConnection(self._ssh_pool)
+
+        def run_on_instance(i):
+            logger.info("Scheduling command execution on %s: %s" % (i.id, cmd))
+            with self._metrics.timer("operation_seconds", op="run", instance=i.id):
+                return run_command(i)
+
+        def run_command(i):
+            writer = _OutputWriter(i.id, output_base_name, output_callback)
             try:
-                self._conn.terminate_instances(instance_ids=[i.id])
-            except AttributeError as e:
-                logger.warn("Deprovisioning issued an attribute warning")
-            self._instances.remove(i)
+                agent = self._get_agent(i, user) if priv is False else None
+                if agent is not None:
+                    exit_code, out, err = agent.run(cmd, out_callback=writer.stdout,
+                                                    err_callback=writer.stderr,
+                                                    max_capture=max_output)
+                else:
+                    addr = i.pub_addr if priv is False else i.priv_addr
+                    exit_code, out, err = ssh.run(self._ssh_privkey, addr, user, cmd, pty=pty,
+                                                  out_callback=writer.stdout,
+                                                  err_callback=writer.stderr,
+                                                  max_capture=max_output)
+            except ExperimentException:
+                raise
+            except Exception, e:
+                raise ExperimentException("Error running ssh command", e)
+            finally:
+                writer.close()
 
+            if output_base_name is None and output_callback is None:
+                if len(out) > 0:
+                    logger.info("  stdout: %s" % out)
+                if len(err) > 0:
+                    logger.info("  stderr: %s" % err)
 
-class OpenStackExperiment(EC2Experiment):
-    """
-    A class defining an experiment running on top of OpenStack
-    """
-    
-    def __init__(self, endpoint, access_key, secret_key, name = None):
-        """
-        Initializes an OpenStack experiment
-        
-        :param endpoint: OpenStack endpoint
-        :param access_keys: OpenStack access key
-        :param secret_keys: OpenStack secret key
-        """        
-        EC2Experiment.__init__(self, "openstack", endpoint, access_key, secret_key)
+            if check_exit_code and exit_code != 0:
+                raise ExperimentException("Command exited with exit code %d on %s" % (exit_code, i.id))
+            return exit_code, out, err
 
+        results = _parallel_map(run_on_instance, iset, parallelism)
 
-class EucalyptusExperiment(EC2Experiment):
-    """
-    A class defining an experiment running on top of Eucalyptus
-    """
-    
-    def __init__(self, endpoint, access_key, secret_key, name = None):
+        exit_code_list = [r[0] for r in results]
+        out_list = [r[1] for r in results]
+        err_list = [r[2] for r in results]
+        return exit_code_list, out_list, err_list
+                
+    def run_many(self, tags, cmds, user="root", check_exit_code=True, stop_on_error=True, priv=False,
+                 parallelism=1):
         """
-        Initializes an Eucalyptus experiment
+        Runs a list of commands on the instances matching the tags, in a single ssh session per
+        instance. The commands are run one after the other, each in its own subshell and without a
+        pty, like run() with pty=False.
         
-        :param endpoint: Eucalyptus endpoint
-        :param access_keys: Eucalyptus access key
-        :param secret_keys: Eucalyptus secret key
-        """        
-        EC2Experiment.__init__(self, "eucalyptus", endpoint, access_key, secret_key)
+        :param tags: set of tags to match against
+        :param cmds: list of commands to run
+        :param user: the user to run the commands as
+        :param check_exit_code: if true, non-zero exit codes will be considered fatal
+        :param stop_on_error: if true, the remaining commands are not run on an instance once a
+                              command has failed there
+        :param parallelism: number of instances to run the commands on at the same time
+        :return: lists of exit codes, stdout and stderr, in instance order. Each entry is a list
+                 with one element per command. Commands which were not run have None as exit code.
+        """
+        iset = self._instance_subset(tags)
+        for i in iset:
+            if not i.is_fully_instanciated:
+                raise ExperimentException("Can't ssh a not fully instanciated instance "+ i.id)
 
+        # every command is followed by a frame header giving its exit code and the sizes of its
+        # stdout and stderr, which come right after the header
+        script = ["d=$(mktemp -d /tmp/precip-batch.XXXXXX) || exit 1",
+                  "trap 'rm -rf $d' EXIT"]
+        for k, cmd in enumerate(cmds):
+            script.append("(eval %s) >$d/out 2>$d/err </dev/null" % pipes.quote(cmd))
+            script.append("rc=$?")
+            script.append("echo \"precip-frame %d $rc $(wc -c <$d/out) $(wc -c <$d/err)\"" % k)
+            script.append("cat $d/out $d/err")
+            if stop_on_error:
+                script.append("[ $rc -eq 0 ] || exit 0")
+        script = "\n".join(script) + "\n"
+
+        ssh = SSHConnection(self._ssh_pool)
+
+        def run_on_instance(i):
+            logger.info("Running %d commands on %s" % (len(cmds), i.id))
+            with self._metrics.timer("operation_seconds", op="run_many", instance=i.id):
+                return run_commands(i)
+
+        def run_commands(i):
+            addr = i.pub_addr if priv is False else i.priv_addr
+            try:
+                exit_code, out, err = ssh.run(self._ssh_privkey, addr, user, "sh -s", pty=False,
+                                              stdin=script)
+            except Exception, e:
+                raise ExperimentException("Error running ssh command", e)
+            if exit_code != 0:
+                raise ExperimentException("Command batch exited with exit code %d on %s: %s"
+                                          % (exit_code, i.id, err))
+            results = [(None, "", "")] * len(cmds)
+            pos = 0
+            while pos < len(out):
+                end = out.index("\n", pos)
+                marker, k, rc, nout, nerr = out[pos:end].split()
+                if marker != "precip-frame":
+                    raise ExperimentException("Unexpected output from command batch on %s" % i.id)
+                k, nout, nerr = int(k), int(nout), int(nerr)
+                pos = end + 1
+                results[k] = (int(rc), out[pos:pos + nout], out[pos + nout:pos + nout + nerr])
+                pos += nout + nerr
+                logger.debug("  command %d exited with %s on %s" % (k, rc, i.id))
+            if check_exit_code:
+                for k, r in enumerate(results):
+                    if r[0] is not None and r[0] != 0:
+                        raise ExperimentException("Command %d (%s) exited with exit code %d on %s"
+                                                  % (k, cmds[k], r[0], i.id))
+            return results
+
+        results = _parallel_map(run_on_instance, iset, parallelism)
+
+        exit_code_list = [[r[0] for r in rs] for rs in results]
+        out_list = [[r[1] for r in rs] for rs in results]
+        err_list = [[r[2] for r in rs] for rs in results]
+        return exit_code_list, out_list, err_list
 
-class NimbusExperiment(EC2Experiment):
-    """
-    A class defining an experiment running on top of Nimbus
-    """
-    
-    def __init__(self, endpoint, access_key, secret_key, name = None):
+    def copy_and_run(self, tags, local_script, args=[], user="root", check_exit_code=True, parallelism=1,
+                     broadcast=False):
         """
-        Initializes a Nimbus experiment
+        Runs a local script on the remote instances matching the tags
         
-        :param endpoint: Nimbus endpoint
-        :param access_keys: Nimbus access key
-        :param secret_keys: Nimbus secret key
-        """       
-        EC2Experiment.__init__(self, "nimbus", endpoint, access_key, secret_key)
+        :param tags: set of tags to match against
+        :param local_script: local script to copy and run
+        :param args: list of arguments to pass to the script
+        :param user: user to run the script as
+        :param parallelism: number of instances to run the script on at the same time
+        :param broadcast: if true, the script is distributed with a broadcast put
+        """
+        fname = "/tmp/remote-exec.%d" % (random.randint(1, 10000000000)) 
+        for result in self.put(tags, local_script, fname, user=user, parallelism=parallelism,
+                               broadcast=broadcast):
+            if result["error"] is not None:
+                raise ExperimentException("Unable to copy %s to %s" % (local_script, result["id"]),
+                                          result["error"])
+        cmd = "cd /tmp && chmod 755 %s && %s" % (fname, fname)
+        for a in args:
+            cmd = cmd + " '" + a + "'"
+        cmd = cmd + " && rm -f " + fname
+        exit_codes, outs, errs = self.run(tags, cmd, user=user, check_exit_code=check_exit_code,
+                                          parallelism=parallelism)
+        return exit_codes, outs, errs
+
+
+# the cloud backends have their own modules, which import the cloud SDKs when first used
+from precip.ec2 import EC2Experiment, OpenStackExperiment, EucalyptusExperiment, NimbusExperiment
+from precip.gcloud import GCloudExperiment
+from precip.azure import AzureExperiment
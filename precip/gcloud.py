@@ -0,0 +1,417 @@
+"""
+
+Copyright 2012 University Of Southern California
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+                                                                                                                             
+Unless required by applicable law or agreed to in writing,                                                                 
+software distributed under the License is distributed on an "AS IS" BASIS,                                                 
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.                                                   
+See the License for the specific language governing permissions and                                                        
+limitations under the License. 
+
+"""
+
+import re
+import time
+import uuid
+
+from precip.experiment import Experiment, ExperimentException, Instance, _TimedProxy, _traced, \
+                              logger
+
+
+class GCloudExperiment(Experiment):
+
+    _cloud_name = "gce"
+    _poll_max_interval = 20
+    _expected_boot_time = 60
+    
+    def __init__(self, project, zone, user, name = None):
+        """
+        Initializes an GCloud experiment
+        
+        :param zone: Google Cloud zone, for example us-central1-f
+        :param project: Google Cloud project ID, for example causal-setting-00000
+
+        """
+        Experiment.__init__(self, name = name)
+        
+        self._zone = zone
+        self._project = project
+        self._user = user
+        
+        self._conn = None
+    
+        self._get_connection()
+        self._ssh_keys_setup()
+        
+        self.counter = 0
+
+    def _get_connection(self):
+        """
+        Establishes a connection to the cloud endpoint
+        """
+        if (self._conn != None):
+            return
+        
+        # the Google SDK is only imported when it is needed
+        from oauth2client.client import GoogleCredentials
+        from googleapiclient.discovery import build
+
+        credentials = GoogleCredentials.get_application_default()
+        self._conn = _TimedProxy(build('compute', 'v1', credentials=credentials), self._metrics,
+                                 deferred=True)
+        
+    def _ssh_keys_setup(self):
+        
+        """
+        Makes sure we have our experiment keypair registered
+        """
+        uid = self._get_account_id()
+        logger.info("Registering ssh pubkey of "+uid)
+        
+        with open(self._ssh_pubkey) as sshfile:
+            contents = sshfile.read()
+        
+        # Get metadata from the cloud
+        request = self._conn.projects().get(project=self._project)
+        response = request.execute()
+        
+        # Check keyresponse['name']
+        need_to_register = False
+        body = response['commonInstanceMetadata']
+        
+        if 'items' in body:
+            sshkey_found = False
+            for item in body['items']:
+                if item['key'] == 'sshKeys':
+                    sshkey_found = True
+                    if contents not in item['value']:
+                        need_to_register = True
+                        item['value'] = str(item['value']) + '\n' + self._user + ':' + contents
+            if not sshkey_found: 
+                body['items'].append({'value' : self._user + ':' + contents,
+                                      'key' : 'sshKeys' })
+        else:
+            need_to_register = True
+            body['items'] = [{'value' : self._user + ':' + contents,
+                              'key' : 'sshKeys' }]
+        
+        # Register key
+        # key is stored at:
+        # https://console.developers.google.com/project/<your-project>/compute/metadata/sshKeys
+        if need_to_register == True:
+            response = self._conn.projects().setCommonInstanceMetadata(project=self._project,
+                                                                       body=body).execute()
+            if 'error' in response:
+                    raise ExperimentException(response['error'])
+        else:
+            logger.info("pubkey is already registered")
+            
+    def _wait_for_operation(self, operation, timeout=300):
+        logger.debug('Waiting for %s to finish..' % operation)
+        
+        init_time = int(time.time())
+
+        while True:
+            response = self._conn.zoneOperations().get(
+                project=self._project,
+                zone=self._zone,
+                operation=operation).execute()
+    
+            if response['status'] == 'DONE':
+                logger.debug("%s done" % operation)
+                if 'error' in response:
+                    raise ExperimentException(response['error'])
+                return response
+            else:
+                if int(time.time()) > init_time + timeout:
+                    raise ExperimentException('Timeout for operation: ' + operation)
+                time.sleep(5)
+
+    def _start_instance(self, name, machine_type, source_disk_image, disk_size, tags):
+            
+        config = {
+            'name': name,
+            'machineType': machine_type,
+    
+            # Specify the boot disk and the image to use as a source.
+            'disks': [{
+                    'boot': True,
+                    'autoDelete': True,
+                    'initializeParams': {
+                        'sourceImage': source_disk_image,
+                        'diskSizeGb': disk_size
+                    }
+                }
+            ],
+    
+            # Specify a network interface with NAT to access the public
+            # internet.
+            'networkInterfaces': [{
+                    'network': 'global/networks/default',
+                    'accessConfigs': [{'type': 'ONE_TO_ONE_NAT',
+                                       'name': 'External NAT'}]
+                }
+            ],
+            
+            # Tags
+            'tags': {'items': list(set(tags))}
+        }
+        response = self._conn.instances().insert(project=self._project,
+                                                     zone=self._zone,
+                                                     body=config).execute()
+        logger.info("Started instance %s, type %s" % (name, machine_type))    
+        return response
+
+    @_traced("finish_instanciation")
+    def _finish_instanciation(self, instance):
+        """
+        Checks if an instance has finished booting, and fills in its addresses
+        
+        :param instance: the instance to check
+        :return: True if the instance is ready to be bootstrapped, otherwise False
+        """
+        
+        # check if we are already done
+        if instance.is_fully_instanciated:
+            return True
+        
+        if instance.not_instanciated_correctly:
+            return False
+        
+        operation = instance.gce_boot_response['name']
+        response = self._conn.zoneOperations().get(project=self._project, 
+                                                   zone=self._zone,
+                                                   operation=operation).execute()
+
+        if 'error' in response:
+            logger.debug("Instance %s state is 'error - scheduling for possible retry" %instance.id)
+            logger.debug("%s" % operation)
+            for error in response['error']['errors']:
+                logger.debug("%s : %s" % (error['code'], error['message']))
+            instance.not_instanciated_correctly = True
+            return False
+        
+        if response['status'] in ['PENDING', 'RUNNING']: # RUNNING here means the boot script is still running, not the instance
+            logger.debug("Instance %s is still pending" % instance.id)
+            return False
+        
+        if response['status'] != 'DONE':
+            logger.debug("Unexpected instance state for instance %s: %s" % (instance.id, response['status']))
+            return False             
+        
+        # DONE
+        self._phase(instance, "running")
+        
+        # get instance data
+        response = self._conn.instances().get(project=self._project,
+                                              zone=self._zone,
+                                              instance=instance.id).execute()
+                
+        # get public address
+        instance.pub_addr = str(response['networkInterfaces'][0]['accessConfigs'][0]['natIP'])
+        self._phase(instance, "address")
+        return True
+
+    def _bootstrap(self, instance):
+        """
+        Bootstraps an instance which has finished booting, and uses its fqdn as private address
+        """
+        if not Experiment._bootstrap(self, instance):
+            return False
+        instance.priv_addr = str(instance.facts["fqdn"])
+        return True
+
+    def _complete_instanciation(self, instance):
+        """
+        Marks a bootstrapped instance as ready
+        """
+        logger.info("Instance %s has booted, public address: %s" % (instance.id, instance.pub_addr))
+        Experiment._complete_instanciation(self, instance)
+
+    @_traced("retry")
+    def _retry(self, instance):
+        
+        """
+        In case of reaching timeout for an instance, retry will terminate the previous instance and 
+        replace it with a new instance.
+        
+        :param instance: the instance to terminate and replace with a new one
+        :param image_id: The image id as specified by the cloud infrastructure
+        :param instance_type: The instance type (m1.small, m1.large, ...)
+        :param tags: Tags to add to the new instance - this is important as tags are used throughout the API 
+                     to find and manipulate instances
+        """
+        
+        logger.info("Instance %s has reached timeout, and will be replaced with a new instance" % instance.id)
+        try:
+            request = self._conn.instances().delete(project=self._project,
+                                                    zone=self._zone,
+                                                    instance=instance.id)
+            response = request.execute()
+            self._wait_for_operation(response['name'])
+        except Exception:
+            logger.info('Could not delete instance: %s' % instance.id)
+            
+        response = self._start_instance(instance.id, instance.instance_type, instance.image_id, instance.disk_size, instance.tags)
+
+        instance.gce_boot_response = response
+        instance.num_starts = instance.num_starts + 1
+        instance.boot_time = int(time.time())
+        instance.not_instanciated_correctly = False
+
+    @_traced("provision", write=True)
+    def provision(self, source_disk_image, machine_type, count=1, tags=[], disk_size=10,
+                  boot_timeout=900, boot_max_tries=3):
+        """
+        Provision a new instance. Note that this method starts the provisioning cycle, but does not
+        block for the instance to finish booting - for that, see wait()
+        
+        :param image_id: The image id as specified by the cloud infrastructure
+        :param instance_type: The instance type (m1.small, m1.large, ...)
+        :param count: Number of instances to provision. The default is 1.
+        :param tags: Tags to add to the instance - this is important as tags are used throughout the API 
+                     to find and manipulate instances
+        :param boot_timeout: The amount of allowed time in seconds for an instance to boot
+        :param boot_max_tries: The number of tries an instance is given to successfully boot
+        """   
+      
+        name = 'inst-' + self._name.replace('_', '')
+        if re.search('^(?:[a-z](?:[-a-z0-9]{0,61}[a-z0-9])?)$', name) is None:
+            name = 'inst-' + str(uuid.uuid4().get_hex())
+        
+        pool_config = {"image_id": source_disk_image, "instance_type": machine_type, "disk_size": disk_size}
+        for instance in self._take_from_warm_pool(pool_config, count):
+            instance.num_starts = 1
+            instance.boot_time = int(time.time())
+            instance.boot_timeout = boot_timeout
+            instance.boot_max_tries = 3
+            instance.add_tag("precip")
+            instance.add_tag(instance.id)
+            for t in tags:
+                instance.add_tag(t)
+            self._add_instance(instance)
+            self._complete_instanciation(instance)
+            count -= 1
+        
+        for _i in range(count):
+            inst_id = name + '-' + str(self.counter)
+            self.counter += 1
+            # add basic tags
+            inst_tags = list(tags)
+            inst_tags.append("precip")
+            inst_tags.append(inst_id)
+            
+            instance = Instance(inst_id)
+            
+            try:
+                response = self._start_instance(inst_id, machine_type, source_disk_image, disk_size, inst_tags)
+                instance.gce_boot_response = response
+            except Exception as e:
+                logger.info("%s" % str(e))
+                instance.not_instanciated_correctly = True
+            
+            # keep track of parameters - we might need them for restarts later
+            instance.num_starts = 1
+            instance.boot_time = int(time.time())
+            instance.boot_timeout = boot_timeout
+            instance.boot_max_tries = 3
+            instance.image_id = source_disk_image
+            instance.instance_type = machine_type
+            instance.disk_size = disk_size
+            instance.pool_config = pool_config
+            
+            for t in inst_tags:
+                instance.add_tag(t)
+            
+            self._add_instance(instance)
+
+        self._save_journal()
+
+    def _warm_pool_key(self):
+        return "gce:%s:%s" % (self._project, self._zone)
+
+    def _admin_user(self):
+        return self._user
+
+    def _terminate_parked(self, records):
+        for instance_id in [r["id"] for r in records]:
+            logger.info("Terminating parked instance %s" % instance_id)
+            try:
+                self._conn.instances().delete(project=self._project,
+                                              zone=self._zone,
+                                              instance=instance_id).execute()
+            except Exception as e:
+                logger.info('Could not terminate instance %s: %s' % (instance_id, str(e)))
+
+    def _reattach_instances(self, instances):
+        """
+        Checks that the journaled instances still exist
+        """
+        alive = []
+        for i in instances:
+            try:
+                response = self._conn.instances().get(project=self._project,
+                                                      zone=self._zone,
+                                                      instance=i.id).execute()
+            except Exception as e:
+                logger.info("Instance %s no longer exists" % i.id)
+                logger.debug("%s" % str(e))
+                continue
+            if response['status'] in ['STOPPING', 'TERMINATED']:
+                logger.info("Instance %s is %s" % (i.id, response['status']))
+                continue
+            alive.append(i)
+        return alive
+
+    @_traced("deprovision", write=True)
+    def deprovision(self, tags=[]):
+        """
+        Deprovisions (terminates) instances with the matching tags
+        
+        :param tags: set of tags to match against
+        """
+        responses = []
+        
+        subset = self._instance_subset(tags)
+        parked = self._park_instances(subset)
+        for i in subset:
+            if i in parked:
+                self._forget_instance(i)
+                continue
+            try:
+                logger.info("Deprovisioning instance: %s" % i.id)
+                request = self._conn.instances().delete(project=self._project,
+                                                        zone=self._zone,
+                                                        instance=i.id)
+                response = request.execute()
+                responses.append({'response' : response, 'id' : i.id})
+            except Exception:
+                logger.info('Could not deprovision instance: %s' % i.id)
+            self._forget_instance(i)
+        self._save_journal()
+        
+        if len(responses) == 0:
+            return
+        
+        logger.info("Waiting for deprovisioning to complete")    
+        while len(responses) > 0:
+            r = responses.pop()
+            try:
+                self._wait_for_operation(r['response']['name'])
+            except ExperimentException, e:
+                if "RESOURCE_NOT_READY" in str(e):
+                    time.sleep(30)
+                    request = self._conn.instances().delete(project=self._project,
+                                                        zone=self._zone,
+                                                        instance=r['id'])
+                    response = request.execute()
+                else:
+                    logger.warn('Deprovisioning issued an warning: %s' %str(e))
+                
+        logger.info("Deprovisioning done")
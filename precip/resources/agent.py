@@ -0,0 +1,103 @@
+"""
+
+Copyright 2012 University Of Southern California
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing,
+software distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+# Remote agent, which runs commands for precip over a single long lived ssh channel. precip starts
+# it with a small loader which reads this file from the channel, and the agent then reads requests
+# from the rest of its stdin and writes responses to stdout. Both are framed as one JSON object per
+# line:
+#
+#   request:   {"id": 1, "cmd": "uname -a"}
+#   responses: {"id": 1, "stream": "stdout", "data": "<base64>"}
+#              {"id": 1, "exit": 0}
+#
+# Commands are run concurrently, each with its own shell, and their output is streamed back as it
+# is produced. The agent exits when its stdin is closed, which is when the ssh channel goes away.
+#
+# This file has to work with both Python 2 and 3, and only use the standard library.
+
+import base64
+import json
+import os
+import subprocess
+import sys
+import threading
+
+CHUNK_SIZE = 32768
+
+
+class Agent:
+
+    def __init__(self, stdin, stdout):
+        self._stdin = stdin
+        self._stdout = stdout
+        self._lock = threading.Lock()
+
+    def send(self, msg):
+        line = (json.dumps(msg) + "\n").encode("utf-8")
+        self._lock.acquire()
+        try:
+            self._stdout.write(line)
+            self._stdout.flush()
+        finally:
+            self._lock.release()
+
+    def run(self, request_id, cmd):
+        devnull = open(os.devnull, "rb")
+        try:
+            p = subprocess.Popen(cmd, shell=True, stdin=devnull, stdout=subprocess.PIPE,
+                                 stderr=subprocess.PIPE, close_fds=True)
+        except OSError as e:
+            self.send({"id": request_id, "stream": "stderr",
+                       "data": base64.b64encode(str(e).encode("utf-8")).decode("ascii")})
+            self.send({"id": request_id, "exit": 127})
+            return
+        finally:
+            devnull.close()
+        readers = []
+        for name, pipe in [("stdout", p.stdout), ("stderr", p.stderr)]:
+            t = threading.Thread(target=self.forward, args=(request_id, name, pipe))
+            t.daemon = True
+            t.start()
+            readers.append(t)
+        for t in readers:
+            t.join()
+        self.send({"id": request_id, "exit": p.wait()})
+
+    def forward(self, request_id, name, pipe):
+        while True:
+            data = os.read(pipe.fileno(), CHUNK_SIZE)
+            if len(data) == 0:
+                break
+            self.send({"id": request_id, "stream": name,
+                       "data": base64.b64encode(data).decode("ascii")})
+        pipe.close()
+
+    def serve(self):
+        self.send({"ready": True, "pid": os.getpid()})
+        while True:
+            line = self._stdin.readline()
+            if len(line) == 0:
+                break
+            request = json.loads(line.decode("utf-8"))
+            t = threading.Thread(target=self.run, args=(request["id"], request["cmd"]))
+            t.daemon = True
+            t.start()
+
+
+if __name__ == "__main__":
+    Agent(getattr(sys.stdin, "buffer", sys.stdin), getattr(sys.stdout, "buffer", sys.stdout)).serve()
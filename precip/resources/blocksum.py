@@ -0,0 +1,129 @@
+"""
+
+Copyright 2012 University Of Southern California
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing,
+software distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+# Builds a manifest of a directory tree, with a checksum for every block of every file. Used by
+# put_dir() and get_dir() to find out which blocks differ between the local and the remote copy of
+# a tree. The checksums are cached, and only files which have changed size or modification time
+# since the last scan are read again.
+#
+# This file is imported locally, and sent to the instances and run there with:
+#
+#     python - <directory> <block size>
+#
+# so it has to work with both Python 2 and 3, and only use the standard library.
+
+import hashlib
+import json
+import os
+import sys
+
+
+def cache_path(root):
+    """
+    :return: the default location of the checksum cache for the given directory
+    """
+    path = os.path.abspath(root)
+    if not isinstance(path, bytes):
+        path = path.encode("utf-8")
+    key = hashlib.sha1(path).hexdigest()
+    return os.path.join(os.path.expanduser("~"), ".precip", "manifests", key + ".json")
+
+
+def block_sums(path, block_size):
+    """
+    :return: list of sha1 checksums, one for each block of the file
+    """
+    sums = []
+    f = open(path, "rb")
+    try:
+        while True:
+            data = f.read(block_size)
+            if len(data) == 0:
+                break
+            sums.append(hashlib.sha1(data).hexdigest())
+    finally:
+        f.close()
+    return sums
+
+
+def scan(root, block_size, cache=None):
+    """
+    Builds the manifest for a directory. Symlinks are not followed, and are left out.
+
+    :param root: the directory to scan
+    :param block_size: size of the checksummed blocks
+    :param cache: file to keep the checksums in between scans, or None to not cache
+    :return: dictionary with "exists", "dirs" (list of relative directory paths) and "files"
+             (relative path to size, mtime, mode and blocks)
+    """
+    manifest = {"exists": os.path.isdir(root), "block_size": block_size, "dirs": [], "files": {}}
+    if not manifest["exists"]:
+        return manifest
+
+    cached = {}
+    if cache is not None and os.path.exists(cache):
+        try:
+            f = open(cache)
+            try:
+                old = json.load(f)
+            finally:
+                f.close()
+            if old.get("block_size") == block_size:
+                cached = old["files"]
+        except ValueError:
+            pass
+
+    for dirpath, dirnames, filenames in os.walk(root):
+        rel_dir = os.path.relpath(dirpath, root)
+        for d in sorted(dirnames):
+            if not os.path.islink(os.path.join(dirpath, d)):
+                manifest["dirs"].append(os.path.normpath(os.path.join(rel_dir, d)))
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            if os.path.islink(path) or not os.path.isfile(path):
+                continue
+            rel = os.path.normpath(os.path.join(rel_dir, name))
+            st = os.stat(path)
+            entry = cached.get(rel)
+            if entry is None or entry["size"] != st.st_size or entry["mtime"] != st.st_mtime:
+                entry = {"size": st.st_size, "mtime": st.st_mtime,
+                         "blocks": block_sums(path, block_size)}
+            entry["mode"] = st.st_mode & 0o7777
+            manifest["files"][rel] = entry
+    manifest["dirs"].sort()
+
+    if cache is not None:
+        try:
+            if not os.path.exists(os.path.dirname(cache)):
+                os.makedirs(os.path.dirname(cache))
+            tmp = cache + ".tmp"
+            f = open(tmp, "w")
+            try:
+                json.dump(manifest, f)
+            finally:
+                f.close()
+            os.rename(tmp, cache)
+        except (IOError, OSError):
+            # the cache only saves time - carry on without it
+            pass
+    return manifest
+
+
+if __name__ == "__main__":
+    root = sys.argv[1]
+    sys.stdout.write(json.dumps(scan(root, int(sys.argv[2]), cache_path(root))))
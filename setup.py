@@ -20,5 +20,5 @@ setup(
         "License :: OSI Approved :: Apache Software License",
     ],
     packages=["precip"],
-    package_data={"precip": ["resources/vm-bootstrap.sh"]}
+    package_data={"precip": ["resources/vm-bootstrap.sh", "resources/blocksum.py", "resources/agent.py"]}
 )
@@ -0,0 +1,151 @@
+#!/usr/bin/python
+
+"""
+Benchmarks provision(), wait() and deprovision() against the fake control plane in fakecloud.py,
+for growing numbers of instances. For every phase it reports the number of API requests, the
+wall time and the CPU time, so that regressions in the wait loops show up without paying for
+instances. Boot times are scaled down, together with the polling intervals, so that a run takes
+minutes instead of hours.
+
+    python test/bench_control_plane.py --clouds ec2,gce,azure --sizes 10,100,500
+"""
+
+import json
+import logging
+import optparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import fakecloud
+from precip.experiment import logger
+
+
+def cpu_time():
+    t = os.times()
+    return t[0] + t[1]
+
+
+def timed_phase(cloud, func):
+    """
+    :return: dictionary with the requests, throttled requests, wall time and CPU time of a call
+    """
+    requests = dict(cloud.requests)
+    throttled = cloud.throttled
+    wall = time.time()
+    cpu = cpu_time()
+    func()
+    result = {"wall": time.time() - wall,
+              "cpu": cpu_time() - cpu,
+              "requests": {},
+              "throttled": cloud.throttled - throttled}
+    for name, count in cloud.requests.items():
+        if count > requests.get(name, 0):
+            result["requests"][name] = count - requests.get(name, 0)
+    return result
+
+
+def describe(e):
+    return "%s: %s" % (e.__class__.__name__, str(e).split("\n")[0])
+
+
+def new_experiment(kind, cloud, options):
+    if kind == "ec2":
+        exp = fakecloud.FakeEC2Experiment(cloud, name="bench-ec2")
+    elif kind == "openstack":
+        exp = fakecloud.FakeEC2Experiment(cloud, auto_address=False, name="bench-openstack")
+    elif kind == "gce":
+        exp = fakecloud.FakeGCloudExperiment(cloud, name="bench-gce")
+    elif kind == "azure":
+        exp = fakecloud.FakeAzureExperiment(cloud, name="bench-azure")
+    else:
+        raise ValueError("Unknown cloud: %s" % kind)
+
+    # scale the polling down with the boot times
+    scale = options.time_scale
+    exp._poll_min_interval = exp._poll_min_interval * scale
+    exp._poll_max_interval = exp._poll_max_interval * scale
+    exp._expected_boot_time = exp._expected_boot_time * scale
+    return exp
+
+
+def provision(kind, exp, count):
+    if kind in ["ec2", "openstack"]:
+        exp.provision("ami-fake", tags=["bench"], count=count)
+    elif kind == "gce":
+        exp.provision("fake-image", "n1-standard-1", tags=["bench"], count=count)
+    else:
+        exp.provision(tags=["bench"], count=count)
+
+
+def bench(kind, count, options):
+    scale = options.time_scale
+    cloud = fakecloud.FakeCloud(boot_latency=(options.boot_time * scale * 0.5,
+                                              options.boot_time * scale * 1.5),
+                                address_latency=(0, 10 * scale),
+                                error_rate=options.error_rate,
+                                max_requests_per_second=options.max_requests_per_second,
+                                seed=options.seed)
+    results = {"cloud": kind, "instances": count}
+    exp = new_experiment(kind, cloud, options)
+    # errors which precip gives up on, such as calls which stay throttled, end up as failures
+    try:
+        results["provision"] = timed_phase(cloud, lambda: provision(kind, exp, count))
+        results["wait"] = timed_phase(cloud, exp.wait)
+    except Exception, e:
+        results["error"] = describe(e)
+    try:
+        results["deprovision"] = timed_phase(cloud, exp.deprovision)
+    except Exception, e:
+        results.setdefault("error", describe(e))
+    return results
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("--clouds", default="ec2,openstack,gce,azure",
+                      help="comma separated list of ec2, openstack, gce and azure")
+    parser.add_option("--sizes", default="10,50,100,250,500",
+                      help="comma separated list of numbers of instances")
+    parser.add_option("--boot-time", type="float", default=60,
+                      help="average time, in unscaled seconds, for an instance to boot")
+    parser.add_option("--time-scale", type="float", default=0.05,
+                      help="factor applied to boot times and polling intervals")
+    parser.add_option("--error-rate", type="float", default=0.0,
+                      help="fraction of instances which fail to boot")
+    parser.add_option("--max-requests-per-second", type="float", default=None,
+                      help="request rate above which the fake cloud throttles")
+    parser.add_option("--seed", type="int", default=0)
+    parser.add_option("--json", default=None, help="also write the results to this file")
+    options, args = parser.parse_args()
+
+    logger.setLevel(logging.WARN)
+
+    all_results = []
+    print "%-10s %6s  %-12s %9s %9s %9s %9s" % \
+          ("cloud", "size", "phase", "requests", "throttled", "wall s", "cpu s")
+    for kind in options.clouds.split(","):
+        for count in [int(n) for n in options.sizes.split(",")]:
+            results = bench(kind, count, options)
+            all_results.append(results)
+            for phase in ["provision", "wait", "deprovision"]:
+                if phase not in results:
+                    continue
+                r = results[phase]
+                print "%-10s %6d  %-12s %9d %9d %9.2f %9.2f" % \
+                      (kind, count, phase, sum(r["requests"].values()), r["throttled"],
+                       r["wall"], r["cpu"])
+            if "error" in results:
+                print "%-10s %6d  failed: %s" % (kind, count, results["error"])
+            sys.stdout.flush()
+
+    if options.json is not None:
+        f = open(options.json, "w")
+        json.dump(all_results, f, indent=1, sort_keys=True)
+        f.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+#!/usr/bin/python
+
+"""
+Benchmarks how long it takes to start a driver script: a bare interpreter, importing precip, an
+EC2-only script which also pulls in the SDKs it needs, and importing every cloud SDK up front
+like precip used to. Every case is run in a fresh interpreter, and the median is reported
+together with which SDKs ended up imported.
+
+    python test/bench_import.py --runs 10
+"""
+
+import json
+import optparse
+import os
+import subprocess
+import sys
+
+_TOP = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+_SDKS = ["paramiko", "boto", "oauth2client", "googleapiclient", "azure_resource_manager"]
+
+_CASES = [
+    ("python startup", "pass"),
+    ("from precip import *", "from precip import *"),
+    ("EC2-only script",
+     "from precip import *\n"
+     "import precip.ec2, precip.experiment\n"
+     "precip.ec2._import_boto()\n"
+     "precip.experiment.paramiko.SSHClient\n"),
+    ("all SDKs up front",
+     "import paramiko, boto\n"
+     "from boto.ec2.regioninfo import RegionInfo\n"
+     "from boto.ec2.blockdevicemapping import EBSBlockDeviceType, BlockDeviceMapping\n"
+     "from boto.exception import EC2ResponseError\n"
+     "from oauth2client.client import GoogleCredentials\n"
+     "from googleapiclient.discovery import build\n"
+     "from azure_resource_manager import AzureResourceManager\n"
+     "from precip import *\n"),
+]
+
+_WRAPPER = """
+import json, sys, time
+start = time.time()
+%s
+elapsed = time.time() - start
+sys.stdout.write(json.dumps({"seconds": elapsed,
+                             "sdks": [m for m in %r if m in sys.modules]}) + "\\n")
+"""
+
+
+def run_case(code):
+    """
+    :return: the wall time of the whole interpreter, the time spent in the code, and the SDKs
+             imported, or None if the case could not run
+    """
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join([_TOP] + [p for p in [env.get("PYTHONPATH")] if p])
+    start = os.times()[4]
+    p = subprocess.Popen([sys.executable, "-c", _WRAPPER % (code, _SDKS)],
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+    out, err = p.communicate()
+    total = os.times()[4] - start
+    if p.returncode != 0:
+        return None
+    result = json.loads(out.strip().splitlines()[-1])
+    return total, result["seconds"], result["sdks"]
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) / 2]
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("--runs", type="int", default=10,
+                      help="number of fresh interpreters to run each case in")
+    options, args = parser.parse_args()
+
+    print "%-24s %10s %10s  %s" % ("case", "total s", "import s", "SDKs imported")
+    for name, code in _CASES:
+        runs = [run_case(code) for n in range(options.runs)]
+        if None in runs:
+            print "%-24s %10s %10s  %s" % (name, "-", "-", "unable to run - SDK missing?")
+            continue
+        print "%-24s %10.3f %10.3f  %s" % (name, median([r[0] for r in runs]),
+                                           median([r[1] for r in runs]),
+                                           ", ".join(runs[0][2]) or "none")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,243 @@
+#!/usr/bin/python
+
+"""
+Benchmarks the ssh paths of precip - run(), copy_and_run(), put(), get(), the bootstrap and the
+ssh handshake - against local ssh servers from sshserver.py, each posing as an instance. The
+servers run in a separate process, so that their CPU time does not count against precip. It
+reports commands per second, handshake cost, MB/s for small and large files, and the peak
+memory used for capturing the output of a command.
+
+    python test/bench_ssh.py --instances 8
+"""
+
+import json
+import logging
+import optparse
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from precip.experiment import Experiment, Instance, SSHConnection, _parallel_map, logger
+
+MB = 1024 * 1024
+
+
+class BenchExperiment(Experiment):
+    """
+    An experiment with the local ssh servers as instances. The bootstrap command is sent the
+    bootstrap script and reports facts, like the real one, but does not run the script.
+    """
+
+    _bootstrap_cmd = "echo '%(script)s' >/dev/null && echo 'precip-facts true 1 0 localhost' " \
+                     "# %(hash)s"
+
+    def __init__(self, ports, name="bench-ssh"):
+        Experiment.__init__(self, name=name)
+        for n, port in enumerate(ports):
+            i = Instance("local-%d" % n)
+            i.pub_addr = i.priv_addr = "127.0.0.1:%d" % port
+            i.boot_time = time.time()
+            i.is_fully_instanciated = True
+            i.add_tag("precip")
+            i.add_tag("bench")
+            i.add_tag(i.id)
+            self._add_instance(i)
+
+    def _admin_cmd(self, cmd):
+        # the servers run everything as the user running the benchmark
+        return cmd
+
+    def deprovision(self, tags=[]):
+        for i in self._instance_subset(tags):
+            self._forget_instance(i)
+        self._save_journal()
+
+
+def start_servers(count, root):
+    """
+    :return: the server process, and the ports of the servers
+    """
+    p = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(__file__), "sshserver.py"),
+                          str(count), root], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    return p, json.loads(p.stdout.readline())
+
+
+def peak_rss():
+    # kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def timed(func, *args, **kwargs):
+    start = time.time()
+    func(*args, **kwargs)
+    return time.time() - start
+
+
+def bench_handshake(exp, rounds):
+    instances = exp._instance_subset(["bench"])
+    start = time.time()
+    for n in range(rounds):
+        ssh = SSHConnection.new_connection(exp._ssh_privkey, instances[n % len(instances)].pub_addr,
+                                           "root")
+        ssh.close()
+    seconds = time.time() - start
+    return [("handshake", rounds, seconds, 1000.0 * seconds / rounds, "ms each")]
+
+
+def bench_bootstrap(exp):
+    instances = exp._instance_subset(["bench"])
+    exp._ssh_pool.close_all()
+    seconds = timed(_parallel_map, exp._bootstrap, instances, exp._max_bootstrap_threads)
+    return [("bootstrap", len(instances), seconds, len(instances) / seconds, "instances/s")]
+
+
+def bench_run(exp, rounds, agent=False):
+    name = "run"
+    if agent:
+        name = "run (agent)"
+        exp.use_agent()
+        for i in exp._instance_subset(["bench"]):
+            exp._get_agent(i, "root")
+    count = len(exp._instance_subset(["bench"]))
+    # the first round sets up the connections
+    exp.run(["bench"], "true", parallelism=count)
+    seconds = timed(lambda: [exp.run(["bench"], "true", parallelism=count) for n in range(rounds)])
+    exp.use_agent(False)
+    return [(name, rounds * count, seconds, rounds * count / seconds, "commands/s")]
+
+
+def bench_copy_and_run(exp, tmp, rounds):
+    script = os.path.join(tmp, "script.sh")
+    f = open(script, "w")
+    f.write("#!/bin/sh\necho hello from $(hostname)\n")
+    f.close()
+    count = len(exp._instance_subset(["bench"]))
+    seconds = timed(lambda: [exp.copy_and_run(["bench"], script, parallelism=count)
+                             for n in range(rounds)])
+    return [("copy_and_run", rounds * count, seconds, rounds * count / seconds, "scripts/s")]
+
+
+def bench_transfers(exp, tmp, small_count, small_size, large_size):
+    count = len(exp._instance_subset(["bench"]))
+    results = []
+
+    small = os.path.join(tmp, "small")
+    f = open(small, "wb")
+    f.write(os.urandom(small_size))
+    f.close()
+    seconds = timed(lambda: [exp.put(["bench"], small, "/tmp/small.%d" % n, parallelism=count)
+                             for n in range(small_count)])
+    nbytes = small_count * count * small_size
+    results.append(("put %dKB" % (small_size / 1024), small_count * count, seconds,
+                    nbytes / seconds / MB, "MB/s"))
+    seconds = timed(lambda: [exp.get(["bench"], "/tmp/small.%d" % n, os.path.join(tmp, "got"),
+                                     parallelism=count)
+                             for n in range(small_count)])
+    results.append(("get %dKB" % (small_size / 1024), small_count * count, seconds,
+                    nbytes / seconds / MB, "MB/s"))
+
+    large = os.path.join(tmp, "large")
+    f = open(large, "wb")
+    for n in range(large_size / MB):
+        f.write(os.urandom(MB))
+    f.close()
+    seconds = timed(exp.put, ["bench"], large, "/tmp/large", parallelism=count)
+    results.append(("put %dMB" % (large_size / MB), count, seconds,
+                    large_size * count / seconds / MB, "MB/s"))
+    seconds = timed(exp.get, ["bench"], "/tmp/large", os.path.join(tmp, "large.got"),
+                    parallelism=count)
+    results.append(("get %dMB" % (large_size / MB), count, seconds,
+                    large_size * count / seconds / MB, "MB/s"))
+    return results
+
+
+def bench_capture(port, output_size, max_output):
+    """
+    Runs a command with a lot of output, and reports how much the peak memory grew. Run in a
+    process of its own, as the peak can only go up.
+    """
+    logger.setLevel(logging.WARN)
+    exp = BenchExperiment([port], name="bench-ssh-capture")
+    exp.run(["bench"], "true")
+    before = peak_rss()
+    seconds = timed(exp.run, ["bench"], "head -c %d /dev/zero" % output_size,
+                    max_output=max_output, pty=False)
+    print json.dumps({"seconds": seconds, "peak_growth": peak_rss() - before})
+    exp.deprovision()
+
+
+def capture_results(port, output_size):
+    results = []
+    for max_output in [None, MB]:
+        out = subprocess.check_output([sys.executable, __file__, "--capture-port", str(port),
+                                       "--capture-size", str(output_size),
+                                       "--capture-max", str(max_output or 0)])
+        r = json.loads(out.strip().splitlines()[-1])
+        name = "capture %dMB" % (output_size / MB)
+        if max_output is not None:
+            name += ", max_output=%dMB" % (max_output / MB)
+        results.append((name, 1, r["seconds"], r["peak_growth"] / float(MB), "MB peak growth"))
+    return results
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("--instances", type="int", default=8,
+                      help="number of local ssh servers posing as instances")
+    parser.add_option("--rounds", type="int", default=20,
+                      help="number of times each command is run on every instance")
+    parser.add_option("--small-files", type="int", default=50,
+                      help="number of small files put to and got from every instance")
+    parser.add_option("--small-size", type="int", default=4096)
+    parser.add_option("--large-size", type="int", default=64 * MB)
+    parser.add_option("--capture-size", type="int", default=100 * MB,
+                      help="bytes of output for the output capture benchmark")
+    parser.add_option("--capture-port", type="int", default=None, help=optparse.SUPPRESS_HELP)
+    parser.add_option("--capture-max", type="int", default=0, help=optparse.SUPPRESS_HELP)
+    parser.add_option("--json", default=None, help="also write the results to this file")
+    options, args = parser.parse_args()
+
+    if options.capture_port is not None:
+        bench_capture(options.capture_port, options.capture_size, options.capture_max or None)
+        return
+
+    logger.setLevel(logging.WARN)
+    tmp = tempfile.mkdtemp(prefix="precip-bench-")
+    server, ports = start_servers(options.instances, os.path.join(tmp, "servers"))
+    exp = None
+    try:
+        exp = BenchExperiment(ports)
+        results = []
+        results.extend(bench_handshake(exp, options.rounds))
+        results.extend(bench_bootstrap(exp))
+        results.extend(bench_run(exp, options.rounds))
+        results.extend(bench_run(exp, options.rounds, agent=True))
+        results.extend(bench_copy_and_run(exp, tmp, options.rounds))
+        results.extend(bench_transfers(exp, tmp, options.small_files, options.small_size,
+                                       options.large_size))
+        results.extend(capture_results(ports[0], options.capture_size))
+
+        print "%-32s %8s %9s %12s" % ("benchmark", "count", "seconds", "result")
+        for name, count, seconds, value, unit in results:
+            print "%-32s %8d %9.2f %12.2f %s" % (name, count, seconds, value, unit)
+        if options.json is not None:
+            f = open(options.json, "w")
+            json.dump([{"name": r[0], "count": r[1], "seconds": r[2], "value": r[3], "unit": r[4]}
+                       for r in results], f, indent=1)
+            f.close()
+    finally:
+        if exp is not None:
+            exp.deprovision()
+        server.stdin.close()
+        server.wait()
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
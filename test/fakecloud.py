@@ -0,0 +1,547 @@
+#!/usr/bin/python
+
+"""
+In-process stand-ins for the cloud APIs used by precip: the boto EC2 connection, the Google
+compute service and AzureResourceManager. They share a FakeCloud, which decides how long
+instances take to boot, which of them fail, and when requests are throttled, and counts every
+request made. The FakeEC2Experiment, FakeGCloudExperiment and FakeAzureExperiment classes are
+the real experiment classes, talking to the fakes instead of a cloud, and with bootstrapping
+simulated instead of done over ssh. Nothing here costs money or needs credentials.
+"""
+
+import random
+import threading
+import time
+
+from boto.exception import EC2ResponseError
+
+from precip.azure import AzureExperiment
+from precip.ec2 import EC2Experiment
+from precip.experiment import _TimedProxy
+from precip.gcloud import GCloudExperiment
+
+
+class ThrottledError(Exception):
+    """
+    Raised by the GCE and Azure fakes when a request is throttled
+    """
+    pass
+
+
+class FakeCloud:
+    """
+    State shared by the fake APIs: the instances, their boot schedules and the request counts
+    """
+
+    def __init__(self, boot_latency=(2.0, 4.0), address_latency=(0.0, 1.0),
+                 bootstrap_latency=(0.05, 0.1), error_rate=0.0, max_requests_per_second=None,
+                 seed=0):
+        """
+        :param boot_latency: range, in seconds, of the time from start until an instance runs
+        :param address_latency: range, in seconds, of the time from running until an instance
+                                gets its public address, on clouds which assign addresses
+        :param bootstrap_latency: range, in seconds, of the time a bootstrap takes
+        :param error_rate: the fraction of instances which fail to boot
+        :param max_requests_per_second: request rate above which requests are throttled, or None
+        :param seed: seed for the latencies and failures, so that runs can be compared
+        """
+        self.boot_latency = boot_latency
+        self.address_latency = address_latency
+        self.bootstrap_latency = bootstrap_latency
+        self.error_rate = error_rate
+        self.max_requests_per_second = max_requests_per_second
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._tokens = max_requests_per_second
+        self._last_refill = time.time()
+        self._next_id = 0
+        self._num_addresses = 0
+        self.instances = {}
+        # floating ips, and the instances they are associated with
+        self.addresses = {}
+        self.requests = {}
+        self.throttled = 0
+
+    def request(self, name, throttled_error):
+        """
+        Counts a request, and throttles it if requests come in faster than allowed
+
+        :param name: name of the API call
+        :param throttled_error: function returning the exception to raise when throttled
+        """
+        with self._lock:
+            self.requests[name] = self.requests.get(name, 0) + 1
+            if self.max_requests_per_second is None:
+                return
+            now = time.time()
+            self._tokens = min(self.max_requests_per_second,
+                               self._tokens + (now - self._last_refill) * self.max_requests_per_second)
+            self._last_refill = now
+            if self._tokens < 1:
+                self.throttled += 1
+                raise throttled_error()
+            self._tokens -= 1
+
+    def total_requests(self):
+        with self._lock:
+            return sum(self.requests.values())
+
+    def _uniform(self, bounds):
+        return self._random.uniform(bounds[0], bounds[1])
+
+    def launch(self, prefix, auto_address=True):
+        """
+        Starts a new instance
+
+        :param prefix: prefix of the instance id
+        :param auto_address: if the instance gets a public address without asking for one
+        :return: the record of the instance
+        """
+        with self._lock:
+            self._next_id += 1
+            now = time.time()
+            running_at = now + self._uniform(self.boot_latency)
+            record = {"id": "%s-%08x" % (prefix, self._next_id),
+                      "launched": now,
+                      "running_at": running_at,
+                      "failed": self._random.random() < self.error_rate,
+                      "terminated": False,
+                      "priv_addr": "10.%d.%d.%d" % (self._next_id / 65536 % 256,
+                                                    self._next_id / 256 % 256,
+                                                    self._next_id % 256),
+                      "pub_addr": None,
+                      "address_at": None,
+                      "tags": {}}
+            if auto_address:
+                record["pub_addr"] = self._new_address()
+                record["address_at"] = running_at + self._uniform(self.address_latency)
+            self.instances[record["id"]] = record
+        return record
+
+    def _new_address(self):
+        self._num_addresses += 1
+        n = self._num_addresses
+        return "198.18.%d.%d" % (n / 256 % 256, n % 256)
+
+    def allocate_address(self):
+        with self._lock:
+            addr = self._new_address()
+            self.addresses[addr] = None
+            return addr
+
+    def associate_address(self, instance_id, addr):
+        with self._lock:
+            record = self.instances[instance_id]
+            record["pub_addr"] = addr
+            record["address_at"] = time.time()
+            self.addresses[addr] = instance_id
+
+    def disassociate_address(self, addr):
+        with self._lock:
+            instance_id = self.addresses.get(addr)
+            if instance_id is not None:
+                self.instances[instance_id]["pub_addr"] = None
+                self.instances[instance_id]["address_at"] = None
+            self.addresses[addr] = None
+
+    def release_address(self, addr):
+        with self._lock:
+            del self.addresses[addr]
+
+    def state(self, record):
+        """
+        :return: "pending", "running", "error" or "terminated"
+        """
+        if record["terminated"]:
+            return "terminated"
+        if time.time() < record["running_at"]:
+            return "pending"
+        if record["failed"]:
+            return "error"
+        return "running"
+
+    def public_address(self, record):
+        """
+        :return: the public address of an instance, or "" if it does not have one yet
+        """
+        if self.state(record) != "running" or record["address_at"] is None or \
+           time.time() < record["address_at"]:
+            return ""
+        return record["pub_addr"]
+
+    def terminate(self, instance_id):
+        with self._lock:
+            record = self.instances[instance_id]
+            record["terminated"] = True
+            if record["pub_addr"] in self.addresses:
+                self.addresses[record["pub_addr"]] = None
+
+    def bootstrap(self, instance):
+        """
+        Stands in for bootstrapping an instance over ssh
+        """
+        time.sleep(self._uniform(self.bootstrap_latency))
+        instance.facts = {"fqdn": "%s.fake.internal" % instance.id, "cpus": 2,
+                          "memory_kb": 4046848, "bootstrapped": True}
+        return True
+
+
+# ---------------------------------------------------------------------------------------------
+# EC2
+
+
+def _ec2_error(status, code, message):
+    return EC2ResponseError(status, message,
+                            "<Response><Errors><Error><Code>%s</Code><Message>%s</Message>" \
+                            "</Error></Errors><RequestID>fake</RequestID></Response>"
+                            % (code, message))
+
+
+def _ec2_throttled():
+    return _ec2_error(503, "RequestLimitExceeded", "Request limit exceeded.")
+
+
+class FakeEC2Object:
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class FakeEC2Instance:
+    """
+    A snapshot of an instance, like the boto Instance objects
+    """
+
+    def __init__(self, conn, record):
+        self.connection = conn
+        self.id = record["id"]
+        self._refresh(record)
+
+    def _refresh(self, record):
+        cloud = self.connection.cloud
+        self.state = cloud.state(record)
+        self.public_dns_name = cloud.public_address(record)
+        self.ip_address = self.public_dns_name
+        self.private_dns_name = record["priv_addr"]
+        self.private_ip_address = record["priv_addr"]
+        self.tags = dict(record["tags"])
+
+    def update(self):
+        self.connection.cloud.request("DescribeInstances", _ec2_throttled)
+        self._refresh(self.connection.cloud.instances[self.id])
+        return self.state
+
+    def use_ip(self, ip_address):
+        if not isinstance(ip_address, str):
+            ip_address = ip_address.public_ip
+        return self.connection.associate_address(self.id, ip_address)
+
+    def add_tag(self, key, value=""):
+        self.connection.cloud.request("CreateTags", _ec2_throttled)
+        self.connection.cloud.instances[self.id]["tags"][key] = value
+
+    def remove_tag(self, key, value=None):
+        self.connection.cloud.request("DeleteTags", _ec2_throttled)
+        self.connection.cloud.instances[self.id]["tags"].pop(key, None)
+
+
+class FakeSecurityGroup:
+
+    def __init__(self, conn, name):
+        self.connection = conn
+        self.name = name
+
+    def authorize(self, **kwargs):
+        self.connection.cloud.request("AuthorizeSecurityGroupIngress", _ec2_throttled)
+        return True
+
+
+class FakeEC2Connection:
+    """
+    Stands in for the connection returned by boto.connect_ec2(). Instances do not get public
+    addresses of their own if auto_address is False, like on OpenStack, and precip has to
+    allocate and associate floating ips.
+    """
+
+    def __init__(self, cloud, auto_address=True):
+        self.cloud = cloud
+        self.auto_address = auto_address
+        self.host = None
+        self._key_pairs = {}
+        self._security_groups = {}
+
+    def _request(self, name):
+        self.cloud.request(name, _ec2_throttled)
+
+    def get_all_instances(self, instance_ids=None):
+        self._request("DescribeInstances")
+        if instance_ids is None:
+            instance_ids = self.cloud.instances.keys()
+        instances = []
+        for instance_id in instance_ids:
+            if instance_id not in self.cloud.instances:
+                raise _ec2_error(400, "InvalidInstanceID.NotFound",
+                                 "The instance ID '%s' does not exist" % instance_id)
+            instances.append(FakeEC2Instance(self, self.cloud.instances[instance_id]))
+        return [FakeEC2Object(instances=instances)]
+
+    def get_key_pair(self, name):
+        self._request("DescribeKeyPairs")
+        return self._key_pairs.get(name)
+
+    def import_key_pair(self, name, material):
+        self._request("ImportKeyPair")
+        self._key_pairs[name] = FakeEC2Object(name=name)
+        return self._key_pairs[name]
+
+    def get_all_security_groups(self, groupnames=None):
+        self._request("DescribeSecurityGroups")
+        for name in groupnames or []:
+            if name not in self._security_groups:
+                raise _ec2_error(400, "InvalidGroup.NotFound",
+                                 "The security group '%s' does not exist" % name)
+        return [self._security_groups[name] for name in groupnames or []]
+
+    def create_security_group(self, name, description):
+        self._request("CreateSecurityGroup")
+        self._security_groups[name] = FakeSecurityGroup(self, name)
+        return self._security_groups[name]
+
+    def get_image(self, image_id):
+        self._request("DescribeImages")
+        return FakeEC2Object(id=image_id)
+
+    def run_instances(self, image_id, min_count=1, max_count=1, **kwargs):
+        self._request("RunInstances")
+        instances = [FakeEC2Instance(self, self.cloud.launch("i", self.auto_address))
+                     for _i in range(max_count)]
+        return FakeEC2Object(instances=instances)
+
+    def terminate_instances(self, instance_ids=None):
+        self._request("TerminateInstances")
+        for instance_id in instance_ids:
+            self.cloud.terminate(instance_id)
+        return [FakeEC2Object(id=instance_id) for instance_id in instance_ids]
+
+    def get_all_addresses(self):
+        self._request("DescribeAddresses")
+        return [FakeEC2Object(public_ip=addr, instance_id=instance_id)
+                for addr, instance_id in self.cloud.addresses.items()]
+
+    def allocate_address(self):
+        self._request("AllocateAddress")
+        return FakeEC2Object(public_ip=self.cloud.allocate_address(), instance_id=None)
+
+    def associate_address(self, instance_id, public_ip):
+        self._request("AssociateAddress")
+        self.cloud.associate_address(instance_id, public_ip)
+        return True
+
+    def disassociate_address(self, public_ip=None):
+        self._request("DisassociateAddress")
+        self.cloud.disassociate_address(public_ip)
+        return True
+
+    def release_address(self, public_ip=None):
+        self._request("ReleaseAddress")
+        if public_ip not in self.cloud.addresses:
+            raise _ec2_error(400, "InvalidAddress.NotFound",
+                             "Address '%s' not found." % public_ip)
+        self.cloud.release_address(public_ip)
+        return True
+
+
+# ---------------------------------------------------------------------------------------------
+# Google Compute Engine
+
+
+def _gce_throttled():
+    return ThrottledError("403 rateLimitExceeded")
+
+
+class FakeGCERequest:
+    """
+    A request built by the fake compute service, which is only sent on execute()
+    """
+
+    def __init__(self, cloud, name, func):
+        self._cloud = cloud
+        self._name = name
+        self._func = func
+
+    def execute(self):
+        self._cloud.request(self._name, _gce_throttled)
+        return self._func()
+
+
+class FakeGCEResource:
+
+    def __init__(self, service, methods):
+        self._service = service
+        self._methods = methods
+
+    def __getattr__(self, name):
+        func = self._methods[name]
+        def build(**kwargs):
+            return FakeGCERequest(self._service.cloud, name, lambda: func(**kwargs))
+        return build
+
+
+class FakeComputeService:
+    """
+    Stands in for the service returned by googleapiclient.discovery.build('compute', 'v1')
+    """
+
+    def __init__(self, cloud):
+        self.cloud = cloud
+        self._metadata = {"kind": "compute#metadata"}
+        self._operations = {}
+        self._names = {}
+
+    def projects(self):
+        return FakeGCEResource(self, {"get": self._get_project,
+                                      "setCommonInstanceMetadata": self._set_metadata})
+
+    def instances(self):
+        return FakeGCEResource(self, {"insert": self._insert, "get": self._get_instance,
+                                      "delete": self._delete})
+
+    def zoneOperations(self):
+        return FakeGCEResource(self, {"get": self._get_operation})
+
+    def _get_project(self, project):
+        return {"name": project, "commonInstanceMetadata": dict(self._metadata)}
+
+    def _set_metadata(self, project, body):
+        self._metadata = body
+        return self._operation(time.time())
+
+    def _operation(self, done_at, record=None):
+        name = "operation-%d" % len(self._operations)
+        self._operations[name] = {"done_at": done_at, "record": record}
+        return {"name": name, "status": "PENDING"}
+
+    def _insert(self, project, zone, body):
+        record = self.cloud.launch("gce")
+        self._names[body["name"]] = record
+        return self._operation(record["running_at"], record)
+
+    def _get_operation(self, project, zone, operation):
+        op = self._operations[operation]
+        if time.time() < op["done_at"]:
+            return {"name": operation, "status": "RUNNING"}
+        response = {"name": operation, "status": "DONE"}
+        if op["record"] is not None and op["record"]["failed"]:
+            response["error"] = {"errors": [{"code": "ZONE_RESOURCE_POOL_EXHAUSTED",
+                                             "message": "The zone does not have enough resources"}]}
+        return response
+
+    def _get_instance(self, project, zone, instance):
+        record = self._names[instance]
+        return {"name": instance,
+                "status": "TERMINATED" if record["terminated"] else "RUNNING",
+                "networkInterfaces": [{"networkIP": record["priv_addr"],
+                                       "accessConfigs": [{"natIP": record["pub_addr"]}]}]}
+
+    def _delete(self, project, zone, instance):
+        record = self._names[instance]
+        self.cloud.terminate(record["id"])
+        return self._operation(time.time())
+
+
+# ---------------------------------------------------------------------------------------------
+# Azure
+
+
+class FakeAzureResourceManager:
+    """
+    Stands in for AzureResourceManager. Like the real one, create_vm() blocks until the
+    instance is up.
+    """
+
+    def __init__(self, cloud):
+        self.cloud = cloud
+        self._names = {}
+
+    def _request(self, name):
+        self.cloud.request(name, lambda: ThrottledError("429 TooManyRequests"))
+
+    def create_vm(self, name, pubkey, tags=None, has_public_ip=True):
+        self._request("create_vm")
+        record = self.cloud.launch("azure")
+        self._names[name] = record
+        time.sleep(max(0, record["address_at"] - time.time()))
+        if record["failed"]:
+            raise Exception("Provisioning of %s failed: AllocationFailed" % name)
+
+    def get_pub_addr(self, name):
+        self._request("get_pub_addr")
+        return self._names[name]["pub_addr"]
+
+    def get_priv_addr(self, name):
+        self._request("get_priv_addr")
+        return self._names[name]["priv_addr"]
+
+    def delete_vm(self, name):
+        self._request("delete_vm")
+        self.cloud.terminate(self._names[name]["id"])
+
+
+# ---------------------------------------------------------------------------------------------
+# experiments
+
+
+class _FakeBootstrap:
+    """
+    Mixin which simulates bootstrapping, instead of doing it over ssh
+    """
+
+    def _bootstrap(self, instance):
+        if not self.cloud.bootstrap(instance):
+            return False
+        if instance.priv_addr is None:
+            instance.priv_addr = str(instance.facts["fqdn"])
+        return True
+
+
+class FakeEC2Experiment(_FakeBootstrap, EC2Experiment):
+
+    def __init__(self, cloud, auto_address=True, name=None):
+        self.cloud = cloud
+        self._auto_address = auto_address
+        # an ip address endpoint keeps _is_valid_hostaddr() from doing dns lookups
+        EC2Experiment.__init__(self, "fake", "203.0.113.1", "fake-access-key", "fake-secret-key",
+                               name=name)
+
+    def _get_connection(self):
+        if self._conn is not None:
+            return
+        self._conn = _TimedProxy(FakeEC2Connection(self.cloud, self._auto_address), self._metrics)
+
+
+class FakeGCloudExperiment(_FakeBootstrap, GCloudExperiment):
+
+    def __init__(self, cloud, name=None):
+        self.cloud = cloud
+        GCloudExperiment.__init__(self, "fake-project", "fake-zone-a", "precip", name=name)
+
+    def _get_connection(self):
+        if self._conn is not None:
+            return
+        self._conn = _TimedProxy(FakeComputeService(self.cloud), self._metrics, deferred=True)
+
+
+class FakeAzureConfig:
+    admin_username = "precip"
+
+
+class FakeAzureExperiment(_FakeBootstrap, AzureExperiment):
+
+    def __init__(self, cloud, name=None):
+        self.cloud = cloud
+        AzureExperiment.__init__(self, FakeAzureConfig(), skip_setup=True, name=name)
+
+    def _get_connection(self):
+        if self._conn is not None:
+            return
+        self._conn = _TimedProxy(FakeAzureResourceManager(self.cloud), self._metrics)
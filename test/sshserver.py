@@ -0,0 +1,252 @@
+#!/usr/bin/python
+
+"""
+Minimal paramiko based ssh servers, which pose as instances for the benchmarks. They accept any
+user and any public key, run commands with /bin/sh as the user running the server, and serve
+sftp. Every server has a root directory, and /tmp in commands and sftp paths is mapped to the
+tmp directory under it, so that servers sharing a machine do not trip over each others files.
+
+Run as a script, it starts a number of servers and prints their ports as a JSON list, and keeps
+them running until its stdin is closed:
+
+    python test/sshserver.py <count> <root directory>
+"""
+
+import json
+import os
+import re
+import socket
+import subprocess
+import sys
+import threading
+
+import paramiko
+from paramiko import SFTPServer, SFTPServerInterface, SFTPAttributes, SFTPHandle, SFTP_OK
+
+_HOST_KEY = None
+
+
+def host_key():
+    global _HOST_KEY
+    if _HOST_KEY is None:
+        _HOST_KEY = paramiko.RSAKey.generate(2048)
+    return _HOST_KEY
+
+
+class _Root:
+    """
+    Maps /tmp to the tmp directory of a server
+    """
+
+    _re_tmp = re.compile(r"(?<![\w./-])/tmp(?=/|\s|$|[;&|'\"])")
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        if not os.path.exists(os.path.join(self.path, "tmp")):
+            os.makedirs(os.path.join(self.path, "tmp"))
+
+    def command(self, cmd):
+        return self._re_tmp.sub(os.path.join(self.path, "tmp"), cmd)
+
+    def file(self, path):
+        if path == "/tmp" or path.startswith("/tmp/"):
+            return self.path + path
+        return path
+
+
+class _Server(paramiko.ServerInterface):
+
+    def __init__(self, root):
+        self._root = root
+
+    def get_allowed_auths(self, username):
+        return "publickey"
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        if kind == "session":
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_pty_request(self, channel, term, width, height, pixelwidth, pixelheight,
+                                  modes):
+        return True
+
+    def check_channel_exec_request(self, channel, command):
+        t = threading.Thread(target=self._exec, args=(channel, self._root.command(command)))
+        t.daemon = True
+        t.start()
+        return True
+
+    def _exec(self, channel, command):
+        p = subprocess.Popen(["/bin/sh", "-c", command], cwd=self._root.path,
+                             stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                             close_fds=True)
+
+        def feed():
+            try:
+                while True:
+                    data = channel.recv(32768)
+                    if len(data) == 0:
+                        break
+                    p.stdin.write(data)
+                p.stdin.close()
+            except (IOError, OSError, socket.error):
+                pass
+
+        def drain(pipe, send):
+            try:
+                while True:
+                    data = os.read(pipe.fileno(), 32768)
+                    if len(data) == 0:
+                        break
+                    send(data)
+            except (IOError, OSError, socket.error):
+                pass
+
+        threads = [threading.Thread(target=feed),
+                   threading.Thread(target=drain, args=(p.stdout, channel.sendall)),
+                   threading.Thread(target=drain, args=(p.stderr, channel.sendall_stderr))]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        threads[1].join()
+        threads[2].join()
+        channel.send_exit_status(p.wait())
+        channel.close()
+
+
+class _Handle(SFTPHandle):
+
+    def stat(self):
+        try:
+            return SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+        except OSError, e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def chattr(self, attr):
+        try:
+            SFTPServer.set_file_attr(self.filename, attr)
+            return SFTP_OK
+        except OSError, e:
+            return SFTPServer.convert_errno(e.errno)
+
+
+def _sftp_errors(func):
+    def wrapper(*args):
+        try:
+            return func(*args)
+        except OSError, e:
+            return SFTPServer.convert_errno(e.errno)
+    return wrapper
+
+
+class _SFTPInterface(SFTPServerInterface):
+
+    def __init__(self, server, *args, **kwargs):
+        self._root = server._root
+
+    @_sftp_errors
+    def stat(self, path):
+        return SFTPAttributes.from_stat(os.stat(self._root.file(path)))
+
+    @_sftp_errors
+    def lstat(self, path):
+        return SFTPAttributes.from_stat(os.lstat(self._root.file(path)))
+
+    @_sftp_errors
+    def list_folder(self, path):
+        path = self._root.file(path)
+        result = []
+        for name in os.listdir(path):
+            attr = SFTPAttributes.from_stat(os.lstat(os.path.join(path, name)))
+            attr.filename = name
+            result.append(attr)
+        return result
+
+    @_sftp_errors
+    def open(self, path, flags, attr):
+        path = self._root.file(path)
+        mode = getattr(attr, "st_mode", None) or 0644
+        fd = os.open(path, flags | getattr(os, "O_BINARY", 0), mode)
+        if flags & os.O_WRONLY:
+            fmode = "ab" if flags & os.O_APPEND else "wb"
+        elif flags & os.O_RDWR:
+            fmode = "a+b" if flags & os.O_APPEND else "r+b"
+        else:
+            fmode = "rb"
+        handle = _Handle(flags)
+        handle.filename = path
+        handle.readfile = handle.writefile = os.fdopen(fd, fmode)
+        return handle
+
+    @_sftp_errors
+    def remove(self, path):
+        os.remove(self._root.file(path))
+        return SFTP_OK
+
+    @_sftp_errors
+    def rename(self, oldpath, newpath):
+        os.rename(self._root.file(oldpath), self._root.file(newpath))
+        return SFTP_OK
+
+    posix_rename = rename
+
+    @_sftp_errors
+    def mkdir(self, path, attr):
+        os.mkdir(self._root.file(path))
+        return SFTP_OK
+
+    @_sftp_errors
+    def rmdir(self, path):
+        os.rmdir(self._root.file(path))
+        return SFTP_OK
+
+    @_sftp_errors
+    def chattr(self, path, attr):
+        SFTPServer.set_file_attr(self._root.file(path), attr)
+        return SFTP_OK
+
+
+def serve(root, port=0):
+    """
+    Starts a server in background threads
+
+    :param root: directory to keep the files of the server under
+    :param port: port to listen on, or 0 to pick a free one
+    :return: the port the server listens on
+    """
+    root = _Root(root)
+    s = socket.socket()
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    s.bind(("127.0.0.1", port))
+    s.listen(128)
+
+    def handle(conn):
+        transport = paramiko.Transport(conn)
+        transport.add_server_key(host_key())
+        transport.set_subsystem_handler("sftp", SFTPServer, _SFTPInterface)
+        transport.start_server(server=_Server(root))
+
+    def accept():
+        while True:
+            conn, addr = s.accept()
+            t = threading.Thread(target=handle, args=(conn,))
+            t.daemon = True
+            t.start()
+
+    t = threading.Thread(target=accept)
+    t.daemon = True
+    t.start()
+    return s.getsockname()[1]
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1])
+    ports = [serve(os.path.join(sys.argv[2], "server-%d" % n)) for n in range(count)]
+    sys.stdout.write(json.dumps(ports) + "\n")
+    sys.stdout.flush()
+    sys.stdin.read()
+    os._exit(0)
@@ -0,0 +1,159 @@
+#!/usr/bin/python
+
+import unittest
+import json
+import os
+import shutil
+import tempfile
+
+from precip.experiment import _blocksum, _sync_tree, _LocalFS
+
+BLOCK_SIZE = 16
+
+
+class RecordingFS(_LocalFS):
+    """
+    The local file system, keeping track of the blocks written to files
+    """
+
+    def __init__(self):
+        self.writes = []
+
+    def open(self, path, mode):
+        f = _LocalFS.open(self, path, mode)
+        if "r" in mode and "+" not in mode:
+            return f
+        return RecordingFile(f, path, self.writes)
+
+
+class RecordingFile:
+
+    def __init__(self, f, path, writes):
+        self._f = f
+        self._path = path
+        self._writes = writes
+
+    def seek(self, offset):
+        self._f.seek(offset)
+
+    def write(self, data):
+        self._writes.append((os.path.basename(self._path), self._f.tell(), len(data)))
+        self._f.write(data)
+
+    def close(self):
+        self._f.close()
+
+
+class TestBlocksum(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmp, "src")
+        self.dst = os.path.join(self.tmp, "dst")
+        os.makedirs(os.path.join(self.src, "sub"))
+        self.write(self.src, "a", "".join(chr(ord("a") + k) * BLOCK_SIZE for k in range(4)))
+        self.write(self.src, "sub/b", "b" * (BLOCK_SIZE * 2 + 5))
+        shutil.copytree(self.src, self.dst)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write(self, root, rel, data):
+        f = open(os.path.join(root, rel), "wb")
+        f.write(data)
+        f.close()
+
+    def read(self, root, rel):
+        f = open(os.path.join(root, rel), "rb")
+        data = f.read()
+        f.close()
+        return data
+
+    def sync(self, delete=False):
+        src_manifest = _blocksum.scan(self.src, BLOCK_SIZE)
+        dst_manifest = _blocksum.scan(self.dst, BLOCK_SIZE)
+        fs = RecordingFS()
+        nbytes = _sync_tree(_LocalFS(), self.src, src_manifest, fs, self.dst, dst_manifest,
+                            delete=delete)
+        return nbytes, fs.writes
+
+    def assertSameTrees(self):
+        src = _blocksum.scan(self.src, BLOCK_SIZE)
+        dst = _blocksum.scan(self.dst, BLOCK_SIZE)
+        self.assertEqual(src["dirs"], dst["dirs"])
+        self.assertEqual(sorted(src["files"]), sorted(dst["files"]))
+        for rel in src["files"]:
+            self.assertEqual(self.read(self.src, rel), self.read(self.dst, rel))
+            self.assertEqual(src["files"][rel]["mode"], dst["files"][rel]["mode"])
+
+    def test_manifest(self):
+        manifest = _blocksum.scan(self.src, BLOCK_SIZE)
+        self.assertTrue(manifest["exists"])
+        self.assertEqual(manifest["block_size"], BLOCK_SIZE)
+        self.assertEqual(manifest["dirs"], ["sub"])
+        self.assertEqual(sorted(manifest["files"]), ["a", "sub/b"])
+        self.assertEqual(manifest["files"]["a"]["size"], BLOCK_SIZE * 4)
+        self.assertEqual(len(set(manifest["files"]["a"]["blocks"])), 4)
+        # a partial last block gets a checksum of its own
+        self.assertEqual(len(manifest["files"]["sub/b"]["blocks"]), 3)
+        self.assertFalse(_blocksum.scan(os.path.join(self.tmp, "missing"), BLOCK_SIZE)["exists"])
+
+    def test_manifest_cache(self):
+        cache = os.path.join(self.tmp, "cache.json")
+        manifest = _blocksum.scan(self.src, BLOCK_SIZE, cache)
+        # unchanged files are not read again, so checksums planted in the cache are kept
+        stale = _blocksum.scan(self.src, BLOCK_SIZE, None)
+        stale["files"]["a"]["blocks"] = ["planted"]
+        f = open(cache, "w")
+        json.dump(stale, f)
+        f.close()
+        self.assertEqual(_blocksum.scan(self.src, BLOCK_SIZE, cache)["files"]["a"]["blocks"],
+                         ["planted"])
+        # a different block size invalidates the cache
+        self.assertNotEqual(_blocksum.scan(self.src, BLOCK_SIZE * 2, cache)["files"]["a"]["blocks"],
+                            ["planted"])
+        self.assertEqual(len(manifest["files"]["a"]["blocks"]), 4)
+
+    def test_unchanged(self):
+        nbytes, writes = self.sync()
+        self.assertEqual(nbytes, 0)
+        self.assertEqual(writes, [])
+
+    def test_changed_block(self):
+        data = self.read(self.src, "a")
+        self.write(self.src, "a", data[:BLOCK_SIZE * 2] + "X" * BLOCK_SIZE + data[BLOCK_SIZE * 3:])
+        nbytes, writes = self.sync()
+        self.assertEqual(writes, [("a", BLOCK_SIZE * 2, BLOCK_SIZE)])
+        self.assertEqual(nbytes, BLOCK_SIZE)
+        self.assertSameTrees()
+
+    def test_appended_and_truncated(self):
+        self.write(self.src, "a", self.read(self.src, "a") + "tail")
+        self.write(self.src, "sub/b", "b" * BLOCK_SIZE)
+        nbytes, writes = self.sync()
+        # only the new partial block of a is sent, and b is cut short without sending anything
+        self.assertEqual(writes, [("a", BLOCK_SIZE * 4, 4)])
+        self.assertEqual(nbytes, 4)
+        self.assertSameTrees()
+
+    def test_new_and_deleted(self):
+        os.makedirs(os.path.join(self.src, "new"))
+        self.write(self.src, "new/c", "c" * (BLOCK_SIZE + 1))
+        os.remove(os.path.join(self.src, "sub/b"))
+        os.rmdir(os.path.join(self.src, "sub"))
+        nbytes, writes = self.sync()
+        self.assertEqual(writes, [("c", 0, BLOCK_SIZE), ("c", BLOCK_SIZE, 1)])
+        self.assertTrue(os.path.exists(os.path.join(self.dst, "sub/b")))
+        nbytes, writes = self.sync(delete=True)
+        self.assertEqual(writes, [])
+        self.assertSameTrees()
+
+    def test_mode_only(self):
+        os.chmod(os.path.join(self.src, "a"), 0700)
+        nbytes, writes = self.sync()
+        self.assertEqual(writes, [])
+        self.assertSameTrees()
+
+
+if __name__ == '__main__':
+    unittest.main()
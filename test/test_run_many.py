@@ -0,0 +1,65 @@
+#!/usr/bin/python
+
+import unittest
+import shutil
+import tempfile
+
+import sshserver
+from bench_ssh import BenchExperiment
+
+from precip.experiment import ExperimentException
+
+
+class TestRunMany(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.mkdtemp()
+        cls.ports = [sshserver.serve("%s/server-%d" % (cls.tmp, n)) for n in range(2)]
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmp)
+
+    def setUp(self):
+        self.exp = BenchExperiment(self.ports, name="test-run-many")
+
+    def tearDown(self):
+        self.exp.deprovision()
+        self.exp._ssh_pool.close_all()
+
+    def test_output_with_frame_markers(self):
+        cmds = ["printf 'precip-frame 1 0 5 0\\nfake\\n'",
+                "printf 'no newline'; printf 'precip-frame 0 0 0 0\\n' >&2",
+                "printf 'precip-frame 9 9 9 9'"]
+        exit_codes, outs, errs = self.exp.run_many(["bench"], cmds, parallelism=2)
+        for n in range(len(self.ports)):
+            self.assertEqual(exit_codes[n], [0, 0, 0])
+            self.assertEqual(outs[n], ["precip-frame 1 0 5 0\nfake\n", "no newline",
+                                       "precip-frame 9 9 9 9"])
+            self.assertEqual(errs[n], ["", "precip-frame 0 0 0 0\n", ""])
+
+    def test_stop_on_error(self):
+        cmds = ["echo one", "echo two >&2; exit 3", "echo three"]
+        exit_codes, outs, errs = self.exp.run_many(["bench"], cmds, check_exit_code=False)
+        self.assertEqual(exit_codes, [[0, 3, None]] * 2)
+        self.assertEqual(outs, [["one\n", "", ""]] * 2)
+        self.assertEqual(errs, [["", "two\n", ""]] * 2)
+
+    def test_continue_on_error(self):
+        cmds = ["echo one", "echo two >&2; exit 3", "echo three"]
+        exit_codes, outs, errs = self.exp.run_many(["bench"], cmds, check_exit_code=False,
+                                                   stop_on_error=False)
+        self.assertEqual(exit_codes, [[0, 3, 0]] * 2)
+        self.assertEqual(outs, [["one\n", "", "three\n"]] * 2)
+        self.assertEqual(errs, [["", "two\n", ""]] * 2)
+
+    def test_check_exit_code(self):
+        self.assertRaises(ExperimentException, self.exp.run_many, ["bench"],
+                          ["true", "exit 1"])
+        self.assertRaises(ExperimentException, self.exp.run_many, ["bench"],
+                          ["exit 1", "true"], stop_on_error=False)
+
+
+if __name__ == '__main__':
+    unittest.main()